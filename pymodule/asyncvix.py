@@ -0,0 +1,574 @@
+# -*- coding:utf-8 -*-
+'''
+Non-blocking job layer on top of pyvix.Vix.
+
+Jobs are submitted to the VIX library without waiting on them; the job
+handles are handed to a single JobPoller thread which sweeps every
+outstanding job with VixJob_CheckCompletion and resolves the matching
+JobFuture once the host is done.  One poller can drive thousands of
+concurrent power, copy and script jobs instead of one thread per VM.
+
+JobCallbacks does the same without polling: jobs are started with a
+VixEventProc, and the JOB_COMPLETED event libvix fires resolves the
+future, so no job waits up to a poll interval and no thread sweeps idle
+jobs.  AsyncVix(vix, callbacks = True) uses it.
+'''
+
+import threading
+import itertools
+import time
+import Queue
+import logging
+from ctypes import *
+
+from pyvix import Vix, VixException, VixEventProc, JobPolicy, getvixlib
+
+
+class JobFuture(object):
+    '''
+    Result of a submitted VIX job, resolved by the poller thread
+    '''
+    def __init__(self, opname):
+        self.opname = opname
+        self._cond = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout = None):
+        '''
+        Block until the job finished, then return its result or raise its error
+        '''
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout = None):
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        '''
+        fn(future) is called from the poller thread, or at once if already done
+        '''
+        self._cond.acquire()
+        try:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._cond.release()
+        self._callback(fn)
+
+    def set_result(self, result):
+        '''
+        False when the future was resolved already, as one whose job was
+        abandoned at its deadline is
+        '''
+        return self._finish(result, None)
+
+    def set_exception(self, exception):
+        return self._finish(None, exception)
+
+    def _wait(self, timeout):
+        self._cond.acquire()
+        try:
+            if not self._done:
+                self._cond.wait(timeout)
+            if not self._done:
+                raise VixException("%s timed out"%self.opname, Vix.VIX_E_UNFINISHED_JOB)
+        finally:
+            self._cond.release()
+
+    def _finish(self, result, exception):
+        self._cond.acquire()
+        try:
+            if self._done:
+                return False
+            self._result = result
+            self._exception = exception
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for fn in callbacks:
+            self._callback(fn)
+        return True
+
+    def _callback(self, fn):
+        try:
+            fn(self)
+        except Exception, e:
+            logging.error("%s callback failed: %s"%(self.opname, e))
+
+
+def as_completed(futures, timeout = None):
+    '''
+    Yield the given futures in the order they finish
+    '''
+    futures = list(futures)
+    finished = Queue.Queue()
+    for future in futures:
+        future.add_done_callback(finished.put)
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    for i in range(len(futures)):
+        remaining = None
+        if deadline is not None:
+            remaining = max(0, deadline - time.time())
+        try:
+            yield finished.get(True, remaining)
+        except Queue.Empty:
+            raise VixException("as_completed timed out", Vix.VIX_E_UNFINISHED_JOB)
+
+
+class JobPoller(object):
+    '''
+    Single thread checking all outstanding job handles for completion
+    '''
+    # Seconds between two sweeps over the outstanding jobs
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, interval = POLL_INTERVAL):
+        self.vix = getvixlib()
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._jobs = {}
+        self._thread = None
+
+    def submit(self, jobHandle, future, resultprop = Vix.VIX_PROPERTY_NONE):
+        '''
+        Hand over the job handle; the poller releases it once the job is done
+        '''
+        self._lock.acquire()
+        try:
+            self._jobs[jobHandle] = (future, resultprop)
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run, name = "vix-job-poller")
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+        self._wakeup.set()
+        return future
+
+    def start(self, startjob, future, resultprop = Vix.VIX_PROPERTY_NONE):
+        '''
+        Start a job with startjob(callbackProc, clientData), which returns
+        its handle, and hand it over
+        '''
+        return self.submit(startjob(None, None), future, resultprop)
+
+    def pending(self):
+        return len(self._jobs)
+
+    def _run(self):
+        while True:
+            self._lock.acquire()
+            try:
+                jobs = self._jobs.items()
+                if not jobs:
+                    self._wakeup.clear()
+            finally:
+                self._lock.release()
+            if not jobs:
+                self._wakeup.wait()
+                continue
+            for jobHandle, (future, resultprop) in jobs:
+                self._check(jobHandle, future, resultprop)
+            time.sleep(self.interval)
+
+    def _check(self, jobHandle, future, resultprop):
+        complete = c_byte(0)
+        try:
+            err = self.vix.VixJob_CheckCompletion(jobHandle, byref(complete))
+            result = None
+            if err == Vix.VIX_OK:
+                if not complete.value:
+                    return
+                err = self.vix.VixJob_GetError(jobHandle)
+            if err == Vix.VIX_OK and resultprop != Vix.VIX_PROPERTY_NONE:
+                value = c_int()
+                err = self.vix.Vix_GetProperties(jobHandle, resultprop, byref(value), Vix.VIX_PROPERTY_NONE)
+                result = value.value
+        except Exception, e:
+            self._finish(jobHandle)
+            future.set_exception(e)
+            return
+        self._finish(jobHandle)
+        if err != Vix.VIX_OK:
+            future.set_exception(VixException("%s Failed"%future.opname, err))
+        elif not future.set_result(result):
+            _abandoned(self.vix, result, resultprop)
+
+    def _finish(self, jobHandle):
+        self._lock.acquire()
+        try:
+            del self._jobs[jobHandle]
+        finally:
+            self._lock.release()
+        self.vix.Vix_ReleaseHandle(jobHandle)
+
+
+class JobCallbacks(object):
+    '''
+    Resolves JobFutures from the completion events of libvix.
+
+    Every job is started with the same VixEventProc trampoline, which lives
+    as long as this object, and a clientData number naming the job's
+    future.  The trampoline only reads the error and result off the job,
+    in the library's thread, and never lets an exception out into C; what
+    it read, or the exception it ran into, is handed to one delivery
+    thread which resolves the future, so done callbacks doing VIX work of
+    their own can not stall the library.
+    '''
+    def __init__(self):
+        self.vix = getvixlib()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        # clientData: [future, resultprop, job handle or None, completed]
+        self._jobs = {}
+        self._results = Queue.Queue()
+        self._proc = VixEventProc(self._onevent)
+        self._thread = threading.Thread(target = self._deliver, name = "vix-job-events")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def start(self, startjob, future, resultprop = Vix.VIX_PROPERTY_NONE):
+        '''
+        Start a job with startjob(callbackProc, clientData), which returns
+        its handle; the handle is released once the job is done
+        '''
+        clientData = self._ids.next()
+        entry = [future, resultprop, None, False]
+        self._lock.acquire()
+        try:
+            self._jobs[clientData] = entry
+        finally:
+            self._lock.release()
+        try:
+            jobHandle = startjob(self._proc, clientData)
+        except Exception:
+            self._lock.acquire()
+            try:
+                del self._jobs[clientData]
+            finally:
+                self._lock.release()
+            raise
+        self._lock.acquire()
+        try:
+            # the event may have come before the handle
+            completed = entry[3]
+            if completed:
+                del self._jobs[clientData]
+            else:
+                entry[2] = jobHandle
+        finally:
+            self._lock.release()
+        if completed:
+            self.vix.Vix_ReleaseHandle(jobHandle)
+        return future
+
+    def pending(self):
+        return len(self._jobs)
+
+    def _onevent(self, jobHandle, eventType, moreEventInfo, clientData):
+        if eventType != Vix.VIX_EVENTTYPE_JOB_COMPLETED:
+            return
+        try:
+            self._lock.acquire()
+            try:
+                entry = self._jobs.get(clientData)
+                if entry is None:
+                    return
+                future, resultprop = entry[0], entry[1]
+            finally:
+                self._lock.release()
+            result = None
+            try:
+                err = self.vix.VixJob_GetError(jobHandle)
+                if err == Vix.VIX_OK and resultprop != Vix.VIX_PROPERTY_NONE:
+                    value = c_int()
+                    err = self.vix.Vix_GetProperties(jobHandle, resultprop, byref(value), Vix.VIX_PROPERTY_NONE)
+                    result = value.value
+                if err != Vix.VIX_OK:
+                    result = VixException("%s Failed"%future.opname, err)
+            except Exception, e:
+                result = e
+            self._lock.acquire()
+            try:
+                entry[3] = True
+                ownHandle = entry[2]
+                if ownHandle is not None:
+                    del self._jobs[clientData]
+            finally:
+                self._lock.release()
+            self._results.put((future, resultprop, result, ownHandle))
+        except Exception, e:
+            logging.error("VIX event of job %s: %s"%(clientData, e))
+
+    def _deliver(self):
+        while True:
+            future, resultprop, result, jobHandle = self._results.get()
+            if jobHandle is not None:
+                self.vix.Vix_ReleaseHandle(jobHandle)
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            elif not future.set_result(result):
+                _abandoned(self.vix, result, resultprop)
+
+
+def _abandoned(vixlib, result, resultprop):
+    '''
+    Release the handle a job abandoned at its deadline came back with
+    '''
+    if resultprop == Vix.VIX_PROPERTY_JOB_RESULT_HANDLE and result:
+        vixlib.Vix_ReleaseHandle(result)
+
+
+_poller = None
+_pollerLock = threading.Lock()
+_callbacks = None
+
+def getpoller():
+    '''
+    Return the process-wide poller, created on first use
+    '''
+    global _poller
+    _pollerLock.acquire()
+    try:
+        if _poller is None:
+            _poller = JobPoller()
+        return _poller
+    finally:
+        _pollerLock.release()
+
+
+def getcallbacks():
+    '''
+    Return the process-wide JobCallbacks, created on first use
+    '''
+    global _callbacks
+    _pollerLock.acquire()
+    try:
+        if _callbacks is None:
+            _callbacks = JobCallbacks()
+        return _callbacks
+    finally:
+        _pollerLock.release()
+
+
+class AsyncVix(object):
+    '''
+    Asynchronous counterpart of the job based Vix methods.
+
+    Every method submits its job and returns a JobFuture at once.  Methods
+    acting on a VM use the handle opened by the wrapped Vix unless an
+    explicit vmHandle is given, so many VMs can be driven concurrently.
+    The futures are resolved by the process-wide JobPoller, or with
+    callbacks set by the JOB_COMPLETED events through JobCallbacks;
+    poller may be either kind.
+    '''
+    def __init__(self, vix, poller = None, callbacks = False):
+        self.vix = vix
+        if poller is None:
+            poller = callbacks and getcallbacks() or getpoller()
+        self.poller = poller
+
+    def _submit(self, opname, startjob, resultprop = Vix.VIX_PROPERTY_NONE, vmpath = None, vmHandle = None):
+        '''
+        startjob(callbackProc, clientData) starts the job, returning its
+        handle; with Vix.jobScheduler set it is started once the scheduler
+        lets a job of vmHandle through, with Vix.jobPolicy set only when
+        the breaker of the host lets it too
+        '''
+        scheduler = self.vix.jobScheduler
+        future = JobFuture(opname)
+        if scheduler is None:
+            self._start(startjob, future, resultprop)
+        else:
+            try:
+                scheduler.submit(self.vix.tenant, self.vix.url, vmHandle,
+                    lambda: self._start(startjob, future, resultprop), future.set_exception)
+            except VixException, e:
+                # closed already
+                future.set_exception(e)
+        if self.vix.metrics is not None:
+            # timed to the future being resolved, with the poller up to one
+            # poll interval after the end
+            started = time.time()
+            future.add_done_callback(lambda future: self._record(future, opname, started, vmpath))
+        return future
+
+    def _start(self, startjob, future, resultprop):
+        try:
+            policy = self.vix.jobPolicy
+            if policy is not None:
+                if not policy.admit(self.vix.url):
+                    raise VixException("%s Failed"%future.opname, JobPolicy.BREAKER_OPEN)
+                self._police(policy, future)
+            self.poller.start(startjob, future, resultprop)
+        except Exception, e:
+            future.set_exception(e)
+
+    def _police(self, policy, future):
+        '''
+        Fail the future with DEADLINE_EXCEEDED at the deadline of its job,
+        which is left to run, and count its outcome into the breaker
+        '''
+        url = self.vix.url
+        started = time.time()
+        until = policy.until(future.opname, started)
+        expiry = None
+        if until is not None:
+            expiry = policy.expire(until, lambda: future.set_exception(VixException(
+                "%s abandoned after %.1fs"%(future.opname, until - started), JobPolicy.DEADLINE_EXCEEDED)))
+        def record(future):
+            if expiry is not None:
+                policy.disarm(expiry)
+            err = Vix.VIX_OK
+            if future.exception() is not None:
+                err = getattr(future.exception(), "errorCode", Vix.VIX_E_FAIL)
+            policy.record(url, err)
+        future.add_done_callback(record)
+
+    def _record(self, future, opname, started, vmpath):
+        err = Vix.VIX_OK
+        if future.exception() is not None:
+            err = getattr(future.exception(), "errorCode", Vix.VIX_E_FAIL)
+        self.vix.recordjob(opname, started, err, vmpath)
+
+    def _vm(self, vmHandle):
+        if vmHandle is None:
+            return self.vix.vmHandle
+        return vmHandle
+
+    def _changes(self, future, fulpathinvm, vmHandle):
+        '''
+        Drop cached guest listings the job made stale once it is done
+        '''
+        if self.vix.dirCache is not None:
+            vmHandle = self._vm(vmHandle)
+            future.add_done_callback(lambda future: self.vix.guestchanged(fulpathinvm, vmHandle))
+        return future
+
+    def _snapshotchanges(self, future, vmHandle):
+        '''
+        Drop the cached snapshot tree of the VM once the job is done
+        '''
+        if self.vix.snapshotCache is not None:
+            vmHandle = self._vm(vmHandle)
+            future.add_done_callback(lambda future: self.vix.snapshotchanged(vmHandle))
+        return future
+
+    def _sessionchanges(self, future, vmHandle):
+        '''
+        Forget the guest login kept on the VM once the job is done
+        '''
+        if self.vix.guestSessions is not None:
+            vmHandle = self._vm(vmHandle)
+            future.add_done_callback(lambda future: self.vix.guestSessions.invalidate(vmHandle))
+        return future
+
+    def Open(self, vmxFile):
+        '''
+        Result is the handle of the opened VM
+        '''
+        return self._submit("VixVM_Open", lambda proc, data: self.vix.vix.VixVM_Open(
+            self.vix.hostHandle, vmxFile, proc, data), Vix.VIX_PROPERTY_JOB_RESULT_HANDLE, vmxFile)
+
+    def PowerOn(self, vmHandle = None):
+        return self._submit("VixVM_PowerOn", lambda proc, data: self.vix.vix.VixVM_PowerOn(
+            self._vm(vmHandle), Vix.VIX_VMPOWEROP_NORMAL, Vix.VIX_INVALID_HANDLE, proc, data),
+            vmHandle = self._vm(vmHandle))
+
+    def PowerOff(self, vmHandle = None):
+        return self._sessionchanges(self._submit("VixVM_PowerOff", lambda proc, data: self.vix.vix.VixVM_PowerOff(
+            self._vm(vmHandle), Vix.VIX_VMPOWEROP_NORMAL, proc, data), vmHandle = self._vm(vmHandle)), vmHandle)
+
+    def Clone(self, snapshotHandle, destvmx, linked = True, vmHandle = None):
+        '''
+        Result is the handle of the clone
+        '''
+        cloneType = Vix.VIX_CLONETYPE_FULL
+        if linked:
+            cloneType = Vix.VIX_CLONETYPE_LINKED
+        return self._submit("VixVM_Clone", lambda proc, data: self.vix.vix.VixVM_Clone(
+            self._vm(vmHandle), snapshotHandle, cloneType, destvmx, 0, Vix.VIX_INVALID_HANDLE,
+            proc, data), Vix.VIX_PROPERTY_JOB_RESULT_HANDLE, destvmx, self._vm(vmHandle))
+
+    def RegisterVM(self, vmxpath):
+        return self._submit("VixHost_RegisterVM", lambda proc, data: self.vix.vix.VixHost_RegisterVM(
+            self.vix.hostHandle, vmxpath, proc, data), vmpath = vmxpath)
+
+    def CreateSnapshot(self, name, description = None, vmHandle = None):
+        '''
+        Result is the handle of the new snapshot
+        '''
+        return self._snapshotchanges(self._submit("VixVM_CreateSnapshot",
+            lambda proc, data: self.vix.vix.VixVM_CreateSnapshot(self._vm(vmHandle), name,
+                description, 0, Vix.VIX_INVALID_HANDLE, proc, data),
+            Vix.VIX_PROPERTY_JOB_RESULT_HANDLE, vmHandle = self._vm(vmHandle)), vmHandle)
+
+    def RevertToSnapshot(self, snapshotHandle, vmHandle = None):
+        return self._sessionchanges(self._snapshotchanges(self._submit("VixVM_RevertToSnapshot",
+            lambda proc, data: self.vix.vix.VixVM_RevertToSnapshot(self._vm(vmHandle),
+                snapshotHandle, 0, Vix.VIX_INVALID_HANDLE, proc, data), vmHandle = self._vm(vmHandle)), vmHandle),
+            vmHandle)
+
+    def waitfortools(self, timeout = Vix.TOOLS_TIMEOUT, vmHandle = None):
+        return self._submit("VixVM_WaitForToolsInGuest", lambda proc, data: self.vix.vix.VixVM_WaitForToolsInGuest(
+            self._vm(vmHandle), timeout, proc, data), vmHandle = self._vm(vmHandle))
+
+    def loginvm(self, vmuser, vmpassword, vmHandle = None):
+        '''
+        With guestSessions set the login is kept there once done, unused
+        until a loginvm of the same user takes it; it fails at once while
+        callers use a login under other credentials
+        '''
+        sessions = self.vix.guestSessions
+        if sessions is not None and sessions.taken(self._vm(vmHandle), vmuser, vmpassword):
+            future = JobFuture("VixVM_LoginInGuest")
+            future.set_exception(VixException("Guest login in use by another user", Vix.VIX_E_OBJECT_IS_BUSY))
+            return future
+        future = self._submit("VixVM_LoginInGuest", lambda proc, data: self.vix.vix.VixVM_LoginInGuest(
+            self._vm(vmHandle), vmuser, vmpassword,
+            Vix.VIX_LOGIN_IN_GUEST_REQUIRE_INTERACTIVE_ENVIRONMENT, proc, data), vmHandle = self._vm(vmHandle))
+        if sessions is not None:
+            vmHandle = self._vm(vmHandle)
+            def keep(future):
+                if future.exception() is None:
+                    sessions.put(vmHandle, vmuser, vmpassword, inuse = False)
+            future.add_done_callback(keep)
+        return future
+
+    def runprograminvm(self, progfullpathinvm, argsline, vmHandle = None):
+        return self._changes(self._submit("VixVM_RunProgramInGuest",
+            lambda proc, data: self.vix.vix.VixVM_RunProgramInGuest(self._vm(vmHandle),
+                progfullpathinvm, argsline, 0, Vix.VIX_INVALID_HANDLE, proc, data),
+            vmHandle = self._vm(vmHandle)), None, vmHandle)
+
+    def runscriptinvm(self, interpreter, scriptext, vmHandle = None):
+        return self._changes(self._submit("VixVM_RunScriptInGuest",
+            lambda proc, data: self.vix.vix.VixVM_RunScriptInGuest(self._vm(vmHandle),
+                interpreter, scriptext, 0, Vix.VIX_INVALID_HANDLE, proc, data),
+            vmHandle = self._vm(vmHandle)), None, vmHandle)
+
+    def cphost2vm(self, localfulpath, fulpathinvm, vmHandle = None):
+        return self._changes(self._submit("VixVM_CopyFileFromHostToGuest",
+            lambda proc, data: self.vix.vix.VixVM_CopyFileFromHostToGuest(self._vm(vmHandle),
+                localfulpath, fulpathinvm, 0, Vix.VIX_INVALID_HANDLE, proc, data),
+            vmHandle = self._vm(vmHandle)), fulpathinvm, vmHandle)
+
+    def cpvm2host(self, fulpathinvm, localfulpath, vmHandle = None):
+        return self._submit("VixVM_CopyFileFromGuestToHost",
+            lambda proc, data: self.vix.vix.VixVM_CopyFileFromGuestToHost(self._vm(vmHandle),
+                fulpathinvm, localfulpath, 0, Vix.VIX_INVALID_HANDLE, proc, data), vmHandle = self._vm(vmHandle))
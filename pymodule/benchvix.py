@@ -0,0 +1,197 @@
+# -*- coding:utf-8 -*-
+'''
+Benchmarks of the pyvix hot paths.
+
+Each path runs a fixed number of operations spread over N threads, every
+thread with its own Vix and VM, for each concurrency level asked for, and
+reports ops/sec with the p50/p99 latency of one operation.  By default the
+runs go against fakevix with a fixed job latency, which makes them
+repeatable and lets a change to pyvix be measured without an ESXi host:
+
+    python benchvix.py --latency 0.002 --concurrency 1,4,16
+    python benchvix.py --paths open,script --cache --json
+
+--host runs the same paths against a real host instead.
+'''
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+from optparse import OptionParser
+
+import pyvix
+from pyvix import Vix
+
+PATHS = ["connect", "open", "power", "copy", "snapshot", "script"]
+
+
+def percentile(samples, fraction):
+    '''
+    Nearest-rank percentile of sorted samples
+    '''
+    if not samples:
+        return 0.0
+    index = int(round(fraction * (len(samples) - 1)))
+    return samples[index]
+
+
+class Worker(object):
+    '''
+    One benchmark thread: a connected Vix with its own powered on VM
+    '''
+    def __init__(self, options, index):
+        self.options = options
+        self.vmxpath = options.vmx.replace("%d", str(index))
+        self.vix = Vix()
+        self.vix.vmuser = options.guestuser
+        self.vix.vmpassword = options.guestpassword
+        self.vix.Connect(options.host, 0, options.username, options.password)
+        self.vix.Open(self.vmxpath)
+        self.serial = 0
+        fd, self.localfile = tempfile.mkstemp(".bin", "pyvix-bench-")
+        os.write(fd, "x" * options.filesize)
+        os.close(fd)
+
+    def setup(self, path):
+        if path in ("copy", "script", "snapshot"):
+            self.vix.PowerOn()
+        if path in ("copy", "script") and not self.vix.loginvm():
+            raise pyvix.VixException("Login into %s failed"%self.vmxpath)
+
+    def run(self, path):
+        self.serial += 1
+        if path == "connect":
+            vix = Vix()
+            vix.Connect(self.options.host, 0, self.options.username, self.options.password)
+            vix.Disconnect()
+        elif path == "open":
+            self.vix.Open(self.vmxpath)
+        elif path == "power":
+            self.vix.PowerOn()
+            self.vix.PowerOff()
+        elif path == "copy":
+            if not self.vix.cphost2vm(self.localfile, "/tmp/pyvix-bench-%d"%self.serial):
+                raise pyvix.VixException("Copy into %s failed"%self.vmxpath)
+        elif path == "snapshot":
+            name = "pyvix-bench-%d"%self.serial
+            self.vix.CreateSnapshot(name)
+            self.vix.vix.Vix_ReleaseHandle(self.vix.snapshotHandle)
+            self.vix.RemoveNamedSnapshot(name)
+        elif path == "script":
+            if not self.vix.runscriptinvm("/bin/sh", "true\n"):
+                raise pyvix.VixException("Script in %s failed"%self.vmxpath)
+
+    def close(self):
+        os.remove(self.localfile)
+        self.vix.disconnecthost()
+
+
+def bench(options, path, concurrency):
+    '''
+    {"path", "concurrency", "ops", "errors", "seconds", "ops_per_sec", "p50", "p99"}
+    of options.ops runs of path over concurrency threads
+    '''
+    workers = [Worker(options, i) for i in range(concurrency)]
+    for worker in workers:
+        worker.setup(path)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    share = [options.ops // concurrency + (i < options.ops % concurrency) for i in range(concurrency)]
+
+    def loop(worker, count):
+        mine = []
+        failed = 0
+        for i in range(count):
+            start = time.time()
+            try:
+                worker.run(path)
+            except Exception:
+                failed += 1
+            mine.append(time.time() - start)
+        lock.acquire()
+        try:
+            latencies.extend(mine)
+            errors[0] += failed
+        finally:
+            lock.release()
+
+    threads = [threading.Thread(target = loop, args = (worker, count))
+        for worker, count in zip(workers, share)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+    for worker in workers:
+        worker.close()
+    latencies.sort()
+    return {"path": path, "concurrency": concurrency, "ops": len(latencies),
+        "errors": errors[0], "seconds": seconds,
+        "ops_per_sec": len(latencies) / seconds if seconds else 0.0,
+        "p50": percentile(latencies, 0.50), "p99": percentile(latencies, 0.99)}
+
+
+def main(argv = None):
+    parser = OptionParser(usage = "%prog [options]")
+    parser.add_option("--paths", default = ",".join(PATHS),
+        help = "comma separated paths out of %s"%",".join(PATHS))
+    parser.add_option("--concurrency", default = "1,4,16",
+        help = "comma separated thread counts, run in turn")
+    parser.add_option("--ops", type = "int", default = 200, help = "operations per run")
+    parser.add_option("--latency", type = "float", default = 0.001,
+        help = "job latency of the fake library in seconds")
+    parser.add_option("--hostslots", type = "int", default = None,
+        help = "jobs the fake host runs at once, unbounded by default")
+    parser.add_option("--failrate", type = "float", default = None,
+        help = "share of fake guest jobs failing with VIX_E_FAIL")
+    parser.add_option("--filesize", type = "int", default = 4096, help = "bytes per copy")
+    parser.add_option("--cache", action = "store_true", default = False,
+        help = "enable the host pool and VM handle, directory and snapshot caches")
+    parser.add_option("--json", action = "store_true", default = False,
+        help = "print one JSON object per run instead of a table")
+    parser.add_option("--host", default = None, help = "benchmark a real host instead of the fake")
+    parser.add_option("--username", default = "root")
+    parser.add_option("--password", default = "")
+    parser.add_option("--vmx", default = "[bench] vm%d/vm%d.vmx",
+        help = "VM path per thread, %d is replaced by the thread number")
+    parser.add_option("--guestuser", default = "root")
+    parser.add_option("--guestpassword", default = "")
+    options, args = parser.parse_args(argv)
+
+    fake = None
+    if options.host is None:
+        import fakevix
+        fake = fakevix.install(latency = options.latency, hostslots = options.hostslots)
+        if options.failrate:
+            for name in ("VixVM_RunScriptInGuest", "VixVM_CopyFileFromHostToGuest"):
+                fake.fail(name, Vix.VIX_E_FAIL, rate = options.failrate)
+        options.host = "fakehost"
+    if options.cache:
+        Vix.hostPool = pyvix.HostPool()
+        Vix.vmCache = pyvix.VMHandleCache()
+        Vix.dirCache = pyvix.GuestDirCache()
+        Vix.snapshotCache = pyvix.SnapshotTreeCache()
+
+    if not options.json:
+        print "%-10s %6s %7s %7s %12s %10s %10s"%("path", "conc", "ops", "errors", "ops/sec", "p50 ms", "p99 ms")
+    for path in options.paths.split(","):
+        for concurrency in [int(n) for n in options.concurrency.split(",")]:
+            result = bench(options, path, concurrency)
+            if options.json:
+                print json.dumps(result, sort_keys = True)
+            else:
+                print "%-10s %6d %7d %7d %12.1f %10.3f %10.3f"%(path, concurrency, result["ops"],
+                    result["errors"], result["ops_per_sec"], result["p50"] * 1000, result["p99"] * 1000)
+            sys.stdout.flush()
+    if fake is not None and not options.json:
+        stats = fake.stats()
+        print "fake library: %d handles and %d buffers left"%(stats["handles"], stats["buffers"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# -*- coding:utf-8 -*-
+'''
+Parallel provisioning of VMs cloned from one snapshot of a golden VM.
+
+clone_many resolves the snapshot once, then submits the clone jobs through
+AsyncVix, keeping at most limit of them in flight per datastore of the
+destinations, since a clone is bound by the disk it is written to rather
+than by the host.  All batches of the process together keep within the
+limit of the datastore, DATASTORE_INFLIGHT unless set with
+setdatastorelimit().  Each clone optionally goes on to be
+registered, powered on, waited for its tools and logged into, and one
+CloneResult per clone is yielded as soon as its chain is through, so work
+can start on the first VMs while the others are still being made.
+
+    for result in clone_many(vix, "[ds1] gold/gold.vmx", "base",
+            ["[ds1] t%d/t%d.vmx"%(i, i) for i in range(100)],
+            poweron = True, waittools = True):
+        if result.ok:
+            runtests(result.vmxpath)
+'''
+
+import re
+import threading
+import time
+import Queue
+
+from pyvix import Vix, VixException
+from asyncvix import AsyncVix
+from fleet import FleetResult, Slots, _Chain
+
+# Clones written to one datastore at the same time, by one batch unless
+# told otherwise and by all batches together unless set with
+# setdatastorelimit()
+DATASTORE_INFLIGHT = 4
+
+_DATASTORE = re.compile(r"\s*\[([^\]]*)\]")
+
+_datastorelimits = {}
+_datastoreslots = {}
+_datastoreslotsLock = threading.Lock()
+
+def datastore(vmxpath):
+    '''
+    Datastore name of a "[datastore] dir/vm.vmx" path, "" for local paths
+    '''
+    match = _DATASTORE.match(vmxpath)
+    if match is None:
+        return ""
+    return match.group(1)
+
+def setdatastorelimit(hostname, name, limit):
+    '''
+    Bound the clones in flight to one datastore of a host by all batches
+    of the process together, DATASTORE_INFLIGHT unless set
+    '''
+    _datastoreslotsLock.acquire()
+    try:
+        _datastorelimits[(hostname, name)] = limit
+        slots = _datastoreslots.get((hostname, name))
+        if slots is not None:
+            slots.resize(limit)
+    finally:
+        _datastoreslotsLock.release()
+
+def datastoreslots(hostname, name):
+    '''
+    Slots bounding the clones in flight to one datastore of a host, shared
+    by all batches
+    '''
+    _datastoreslotsLock.acquire()
+    try:
+        slots = _datastoreslots.get((hostname, name))
+        if slots is None:
+            slots = _datastoreslots[(hostname, name)] = Slots(
+                _datastorelimits.get((hostname, name), DATASTORE_INFLIGHT))
+        return slots
+    finally:
+        _datastoreslotsLock.release()
+
+
+class CloneResult(FleetResult):
+    '''
+    Outcome of one clone of a batch.  vmHandle is the handle of the clone
+    once it exists, also when a later step failed; the caller owns that
+    reference and releases it with Vix_ReleaseHandle.
+    '''
+    def __init__(self, vmxpath, elapsed, error = None, vmHandle = None):
+        FleetResult.__init__(self, vmxpath, elapsed, error)
+        self.vmHandle = vmHandle
+
+
+def clone_many(vix, source_vmx, snapshot_name, dest_paths, linked = True, register = False,
+        poweron = False, waittools = False, login = None, limit = DATASTORE_INFLIGHT):
+    '''
+    Clone the snapshot of source_vmx, its current one when snapshot_name is
+    None, to every destination path, yielding a CloneResult per clone as it
+    is ready.  login is an optional (user, password) for the guest.
+    '''
+    av = AsyncVix(vix)
+    sourceHandle = _open(av, source_vmx)
+    try:
+        tree = vix.GetSnapshotTree(sourceHandle)
+        try:
+            node = tree.current
+            if snapshot_name is not None:
+                node = tree.find(snapshot_name)
+            if node is None:
+                raise VixException("%s has no current snapshot"%source_vmx, Vix.VIX_E_SNAPSHOT_NOTFOUND)
+            # ours for the whole batch, the cached tree may be dropped meanwhile
+            snapshotHandle = node.handle
+            vix.vix.Vix_AddRefHandle(snapshotHandle)
+        finally:
+            tree.release()
+        steps = []
+        if register:
+            steps.append(lambda av, vmHandle, vmxpath: av.RegisterVM(vmxpath))
+        if poweron:
+            steps.append(lambda av, vmHandle, vmxpath: av.PowerOn(vmHandle))
+        if waittools:
+            steps.append(lambda av, vmHandle, vmxpath: av.waitfortools(Vix.TOOLS_TIMEOUT, vmHandle))
+        if login is not None:
+            steps.append(lambda av, vmHandle, vmxpath: av.loginvm(login[0], login[1], vmHandle))
+        try:
+            for result in _runclones(av, sourceHandle, snapshotHandle, linked, dest_paths, steps, limit):
+                yield result
+        finally:
+            vix.vix.Vix_ReleaseHandle(snapshotHandle)
+    finally:
+        vix.vix.Vix_ReleaseHandle(sourceHandle)
+
+
+def _open(av, vmxpath):
+    '''
+    Handle of the VM, with a reference of the caller's own
+    '''
+    vix = av.vix
+    if vix.vmCache is not None:
+        vmHandle = vix.vmCache.get(vix.hostHandle, vmxpath)
+        if vmHandle is not None:
+            return vmHandle
+    vmHandle = av.Open(vmxpath).result()
+    if vix.vmCache is not None:
+        vix.vmCache.put(vix.hostHandle, vmxpath, vmHandle)
+    return vmHandle
+
+
+def _runclones(av, sourceHandle, snapshotHandle, linked, dest_paths, steps, limit):
+    finished = Queue.Queue()
+    pending = list(dest_paths)
+    inflight = 0
+    # datastore: clones of this batch in flight to it
+    stores = {}
+    try:
+        while pending or inflight:
+            # start what the datastores have room for
+            for vmxpath in list(pending):
+                store = datastore(vmxpath)
+                if stores.get(store, 0) < limit and datastoreslots(av.vix.url, store).acquire(False):
+                    pending.remove(vmxpath)
+                    _CloneChain(av, sourceHandle, snapshotHandle, linked, vmxpath, steps, finished).start()
+                    stores[store] = stores.get(store, 0) + 1
+                    inflight += 1
+            if not inflight:
+                # every slot is taken by other batches, wait for the next one
+                vmxpath = pending.pop(0)
+                store = datastore(vmxpath)
+                datastoreslots(av.vix.url, store).acquire()
+                _CloneChain(av, sourceHandle, snapshotHandle, linked, vmxpath, steps, finished).start()
+                stores[store] = stores.get(store, 0) + 1
+                inflight += 1
+                continue
+            result = finished.get()
+            datastoreslots(av.vix.url, datastore(result.vmxpath)).release()
+            stores[datastore(result.vmxpath)] -= 1
+            inflight -= 1
+            yield result
+    finally:
+        # the caller stopped early, the datastore slots are ours until the
+        # jobs end, and so are the clones never handed to it
+        while inflight:
+            result = finished.get()
+            datastoreslots(av.vix.url, datastore(result.vmxpath)).release()
+            inflight -= 1
+            if result.vmHandle is not None and result.vmHandle != Vix.VIX_INVALID_HANDLE:
+                av.vix.vix.Vix_ReleaseHandle(result.vmHandle)
+
+
+class _CloneChain(_Chain):
+    '''
+    Clone one VM, then run the steps one after another on the clone; its
+    reference to the clone is handed on with the CloneResult
+    '''
+    def __init__(self, av, sourceHandle, snapshotHandle, linked, vmxpath, steps, finished):
+        _Chain.__init__(self, av, vmxpath,
+            [lambda av, vmHandle, step = step: step(av, vmHandle, vmxpath) for step in steps], finished)
+        self.sourceHandle = sourceHandle
+        self.snapshotHandle = snapshotHandle
+        self.linked = linked
+        self.vmHandle = None
+
+    def start(self):
+        try:
+            future = self.av.Clone(self.snapshotHandle, self.vmxpath, self.linked, self.sourceHandle)
+        except Exception, e:
+            self._done(e)
+            return
+        self._wait(future, self._opened)
+
+    def _done(self, error):
+        self.finished.put(CloneResult(self.vmxpath, time.time() - self.started, error, self.vmHandle))
@@ -0,0 +1,886 @@
+# -*- coding:utf-8 -*-
+'''
+In-process stand-in for libvix.
+
+FakeVixLib implements the libvix entry points pyvix binds with the same
+calling conventions: job handles, byref out parameters, variadic property
+lists ended by VIX_PROPERTY_NONE and strings freed with Vix_FreeBuffer.
+Behind them is a simulated host holding VMs, snapshot trees and guest
+files.  Every job takes a configurable latency and errors can be injected
+per entry point, so pyvix code can be exercised and measured without an
+ESXi host:
+
+    import fakevix
+    fake = fakevix.install(latency = 0.005)
+    fake.fail("VixVM_PowerOn", Vix.VIX_E_VM_NOT_RUNNING, count = 1)
+
+Setting PYVIX_LIB=fake in the environment makes getvixlib() load the fake
+for code that does not import this module itself.
+
+The entry points are C function pointers of the prototypes VixLib
+declares, so pyvix's arguments go through the same ctypes conversions as
+with libvix; only the variadic ones stay Python callables.  The tests
+under tests/ run against it.
+'''
+
+import os
+import time
+import heapq
+import random
+import logging
+import posixpath
+import threading
+from ctypes import *
+
+from pyvix import Vix, VixLib, VixEventProc, setvixlib, GUEST_TMP
+
+# Seconds a job takes unless set per entry point
+LATENCY = 0.001
+# Entry points taking property lists, ctypes cannot make callbacks of them
+VARIADIC = frozenset(["Vix_GetProperties", "VixJob_Wait", "VixJob_GetNthProperties"])
+
+
+def _store(ref, value, ctype = c_int):
+    '''
+    Write value through a byref() or pointer() out parameter, or through
+    the address of a ctype a C function pointer was handed
+    '''
+    if isinstance(ref, (int, long)):
+        cast(ref, POINTER(ctype))[0] = value
+        return
+    obj = getattr(ref, "_obj", None)
+    if obj is None:
+        obj = ref.contents
+    obj.value = value
+
+
+def _pairs(args):
+    '''
+    (propid, ref) pairs of a variadic property list, up to VIX_PROPERTY_NONE
+    '''
+    args = list(args)
+    pairs = []
+    while len(args) >= 2 and args[0] != Vix.VIX_PROPERTY_NONE:
+        pairs.append((args[0], args[1]))
+        args = args[2:]
+    return pairs
+
+
+class FakeEntry(object):
+    '''
+    Callable standing in for one ctypes function of the library, it takes
+    the restype/argtypes/errcheck VixLib assigns and honours errcheck
+    '''
+    def __init__(self, lib, name, func):
+        self.lib = lib
+        self.__name__ = name
+        self.func = func
+        self.restype = None
+        self.argtypes = None
+        self.errcheck = None
+
+    def __call__(self, *args):
+        self.lib._count(self.__name__)
+        result = self.func(*args)
+        if self.errcheck is not None:
+            result = self.errcheck(result, self, args)
+        return result
+
+
+def _cfunction(lib, name, func):
+    '''
+    C function pointer of the VixLib prototype of name, calling func
+    '''
+    restype, argtypes = VixLib.PROTOTYPES[name]
+    def entry(*args):
+        lib._count(name)
+        try:
+            return func(*args)
+        except Exception:
+            # ctypes would swallow it and return 0, which is VIX_OK
+            logging.exception("%s failed in the fake"%name)
+            if restype is VixLib.VIXERROR:
+                return Vix.VIX_E_FAIL
+            if restype is not None:
+                return Vix.VIX_INVALID_HANDLE
+    return CFUNCTYPE(restype, *argtypes)(entry)
+
+
+class FakeHost(object):
+    def __init__(self, hostname, username):
+        self.hostname = hostname
+        self.username = username
+
+
+class FakeVM(object):
+    '''
+    One simulated VM: power state, snapshot tree and guest file system
+    '''
+    def __init__(self, vmxpath):
+        self.vmxpath = vmxpath
+        self.name = os.path.splitext(posixpath.basename(vmxpath))[0]
+        self.guestos = "otherlinux-64"
+        self.registered = True
+        self.powerstate = Vix.VIX_POWERSTATE_POWERED_OFF
+        self.roots = []
+        self.current = None
+        self.files = {}
+        self.dirs = set(["/", GUEST_TMP])
+        self.loggedin = False
+
+
+class FakeSnapshot(object):
+    def __init__(self, vm, name, description, parent, powerstate):
+        self.vm = vm
+        self.name = name
+        self.description = description
+        self.parent = parent
+        self.powerstate = powerstate
+        self.children = []
+
+
+class FakeJob(object):
+    def __init__(self, opname, done, err, props, rows):
+        self.opname = opname
+        self.done = done
+        self.err = err
+        self.props = props
+        self.rows = rows
+
+
+class FakeItem(object):
+    '''
+    Property holder handed to callbacks, like the found item of FindItems
+    '''
+    def __init__(self, props):
+        self.props = props
+
+
+class FakeVixLib(object):
+    '''
+    Simulated libvix.  VMs are created on first open unless autocreate is
+    off, hostslots bounds the jobs one host runs at once, and latencies
+    maps entry point names to their own job latency.
+    '''
+    def __init__(self, latency = LATENCY, latencies = None, hostslots = None,
+            autocreate = True, users = None, seed = 0):
+        self.latency = latency
+        self.latencies = dict(latencies or {})
+        self.hostslots = hostslots
+        self.autocreate = autocreate
+        # {username: password} accepted by VixHost_Connect, None accepts anybody
+        self.users = users
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.vms = {}
+        self.calls = {}
+        self.scripts = []
+        # scripthook(vm, interpreter, text) returns the exit code of a guest script
+        self.scripthook = None
+        self._failures = {}
+        self._handles = {}
+        self._refs = {}
+        self._buffers = {}
+        # host handle each VM handle was opened through
+        self._owners = {}
+        self._nexthandle = 1000
+        self._nextpid = 1000
+        self._slots = {}
+        self._events = []
+        self._eventsCond = threading.Condition(self.lock)
+        self._eventsThread = None
+        for name in dir(self):
+            if not name.startswith("Vix"):
+                continue
+            if name in VixLib.PROTOTYPES and name not in VARIADIC:
+                setattr(self, name, _cfunction(self, name, getattr(self, name)))
+            else:
+                setattr(self, name, FakeEntry(self, name, getattr(self, name)))
+
+    ##### configuration and inspection
+
+    def addvm(self, vmxpath, powerstate = Vix.VIX_POWERSTATE_POWERED_OFF):
+        self.lock.acquire()
+        try:
+            vm = self.vms.get(vmxpath)
+            if vm is None:
+                vm = self.vms[vmxpath] = FakeVM(vmxpath)
+            vm.powerstate = powerstate
+            return vm
+        finally:
+            self.lock.release()
+
+    def fail(self, opname, errcode, count = None, rate = None):
+        '''
+        Make opname fail with errcode, for the next count calls or for a
+        rate share of the calls; both None fails every call until cleared
+        '''
+        self.lock.acquire()
+        try:
+            self._failures[opname] = [errcode, count, rate]
+        finally:
+            self.lock.release()
+
+    def clearfailures(self):
+        self.lock.acquire()
+        try:
+            self._failures.clear()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        '''
+        Call counts per entry point and the handles and buffers still alive,
+        which should both drop back to zero once pyvix released everything
+        '''
+        self.lock.acquire()
+        try:
+            return {"calls": dict(self.calls),
+                "handles": len(self._handles),
+                "buffers": len(self._buffers)}
+        finally:
+            self.lock.release()
+
+    ##### internals
+
+    def _count(self, name):
+        self.lock.acquire()
+        try:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        finally:
+            self.lock.release()
+
+    def _failure(self, opname):
+        self.lock.acquire()
+        try:
+            failure = self._failures.get(opname)
+            if failure is None:
+                return Vix.VIX_OK
+            errcode, count, rate = failure
+            if rate is not None and self.random.random() >= rate:
+                return Vix.VIX_OK
+            if count is not None:
+                failure[1] -= 1
+                if failure[1] <= 0:
+                    del self._failures[opname]
+            return errcode
+        finally:
+            self.lock.release()
+
+    def _new(self, obj):
+        self.lock.acquire()
+        try:
+            self._nexthandle += 1
+            self._handles[self._nexthandle] = obj
+            self._refs[self._nexthandle] = 1
+            return self._nexthandle
+        finally:
+            self.lock.release()
+
+    def _get(self, handle, kind):
+        obj = self._handles.get(handle)
+        if not isinstance(obj, kind):
+            return None
+        return obj
+
+    def _string(self, text):
+        if text is None:
+            return None
+        buf = create_string_buffer(text)
+        self.lock.acquire()
+        try:
+            self._buffers[addressof(buf)] = buf
+        finally:
+            self.lock.release()
+        return addressof(buf)
+
+    def _job(self, opname, err = Vix.VIX_OK, props = None, rows = None, host = None,
+            callbackProc = None, clientData = None, events = None):
+        '''
+        New job handle finishing after the latency of opname, queued behind
+        the other jobs of its host when hostslots is set
+        '''
+        self.lock.acquire()
+        try:
+            start = time.time()
+            latency = self.latencies.get(opname, self.latency)
+            if self.hostslots is not None:
+                slots = self._slots.setdefault(host, [0.0] * self.hostslots)
+                start = max(start, heapq.heappop(slots))
+                heapq.heappush(slots, start + latency)
+            job = FakeJob(opname, start + latency, err, props or {}, rows or [])
+            jobHandle = self._new(job)
+            if isinstance(callbackProc, (int, long)):
+                callbackProc = VixEventProc(callbackProc)
+            if callbackProc:
+                # the library holds the job until its callback ran
+                self._refs[jobHandle] += 1
+                heapq.heappush(self._events, (job.done, jobHandle, callbackProc, clientData, events or []))
+                if self._eventsThread is None:
+                    self._eventsThread = threading.Thread(target = self._signal, name = "fakevix-events")
+                    self._eventsThread.setDaemon(True)
+                    self._eventsThread.start()
+                self._eventsCond.notify()
+            return jobHandle
+        finally:
+            self.lock.release()
+
+    def _signal(self):
+        '''
+        Call the callbacks of finished jobs from a library thread, as libvix does
+        '''
+        while True:
+            self.lock.acquire()
+            try:
+                while not self._events or self._events[0][0] > time.time():
+                    timeout = None
+                    if self._events:
+                        timeout = self._events[0][0] - time.time()
+                    self._eventsCond.wait(timeout)
+                done, jobHandle, callbackProc, clientData, events = heapq.heappop(self._events)
+            finally:
+                self.lock.release()
+            for eventType, props in events:
+                itemHandle = self._new(FakeItem(props))
+                callbackProc(jobHandle, eventType, itemHandle, clientData)
+                self.Vix_ReleaseHandle(itemHandle)
+            callbackProc(jobHandle, Vix.VIX_EVENTTYPE_JOB_COMPLETED, Vix.VIX_INVALID_HANDLE, clientData)
+            self.Vix_ReleaseHandle(jobHandle)
+
+    def _guest(self, vmHandle, opname):
+        '''
+        (vm, error) of a guest operation, which needs a running VM
+        '''
+        vm = self._get(vmHandle, FakeVM)
+        if vm is None:
+            return None, Vix.VIX_E_INVALID_HANDLE
+        err = self._failure(opname)
+        if err == Vix.VIX_OK and not vm.powerstate & Vix.VIX_POWERSTATE_POWERED_ON:
+            err = Vix.VIX_E_VM_NOT_RUNNING
+        return vm, err
+
+    def _snapshot(self, vm, name):
+        nodes = vm.roots
+        found = None
+        for part in name.split("/"):
+            matches = [node for node in nodes if node.name == part]
+            if not matches:
+                return None
+            found = matches[0]
+            nodes = found.children
+        return found
+
+    def _delay(self, job):
+        remaining = job.done - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    ##### handles and properties
+
+    def Vix_ReleaseHandle(self, handle):
+        self.lock.acquire()
+        try:
+            if handle in self._refs:
+                self._refs[handle] -= 1
+                if self._refs[handle] <= 0:
+                    del self._refs[handle]
+                    del self._handles[handle]
+                    self._owners.pop(handle, None)
+        finally:
+            self.lock.release()
+
+    def Vix_AddRefHandle(self, handle):
+        self.lock.acquire()
+        try:
+            if handle in self._refs:
+                self._refs[handle] += 1
+        finally:
+            self.lock.release()
+
+    def Vix_GetHandleType(self, handle):
+        obj = self._handles.get(handle)
+        for kind, handletype in ((FakeHost, Vix.VIX_HANDLETYPE_HOST), (FakeVM, Vix.VIX_HANDLETYPE_VM),
+                (FakeJob, Vix.VIX_HANDLETYPE_JOB), (FakeSnapshot, Vix.VIX_HANDLETYPE_SNAPSHOT)):
+            if isinstance(obj, kind):
+                return handletype
+        return Vix.VIX_HANDLETYPE_NONE
+
+    def Vix_GetProperties(self, handle, *args):
+        obj = self._handles.get(handle)
+        if obj is None:
+            return Vix.VIX_E_INVALID_HANDLE
+        for propid, ref in _pairs(args):
+            if isinstance(obj, FakeHost) and propid == Vix.VIX_PROPERTY_HOST_HOSTTYPE:
+                value = Vix.VIX_SERVICEPROVIDER_VMWARE_VI_SERVER
+            elif isinstance(obj, FakeVM) and propid == Vix.VIX_PROPERTY_VM_POWER_STATE:
+                value = obj.powerstate
+            elif isinstance(obj, FakeVM) and propid == Vix.VIX_PROPERTY_VM_VMX_PATHNAME:
+                value = self._string(obj.vmxpath)
+            elif isinstance(obj, FakeVM) and propid == Vix.VIX_PROPERTY_VM_NAME:
+                value = self._string(obj.name)
+            elif isinstance(obj, FakeVM) and propid == Vix.VIX_PROPERTY_VM_GUESTOS:
+                value = self._string(obj.guestos)
+            elif isinstance(obj, FakeSnapshot) and propid == Vix.VIX_PROPERTY_SNAPSHOT_DISPLAYNAME:
+                value = self._string(obj.name)
+            elif isinstance(obj, FakeSnapshot) and propid == Vix.VIX_PROPERTY_SNAPSHOT_DESCRIPTION:
+                value = self._string(obj.description)
+            elif isinstance(obj, (FakeJob, FakeItem)) and propid in obj.props:
+                value = obj.props[propid]
+                if isinstance(value, str):
+                    value = self._string(value)
+            else:
+                return Vix.VIX_E_UNRECOGNIZED_PROPERTY
+            _store(ref, value)
+        return Vix.VIX_OK
+
+    def Vix_FreeBuffer(self, p):
+        self.lock.acquire()
+        try:
+            self._buffers.pop(getattr(p, "value", p), None)
+        finally:
+            self.lock.release()
+
+    ##### jobs
+
+    def VixJob_Wait(self, jobHandle, *args):
+        job = self._get(jobHandle, FakeJob)
+        if job is None:
+            return Vix.VIX_E_INVALID_HANDLE
+        self._delay(job)
+        if job.err != Vix.VIX_OK:
+            return job.err
+        return self.Vix_GetProperties.func(jobHandle, *args)
+
+    def VixJob_CheckCompletion(self, jobHandle, complete):
+        job = self._get(jobHandle, FakeJob)
+        if job is None:
+            return Vix.VIX_E_INVALID_HANDLE
+        # a Bool, one byte
+        _store(complete, int(time.time() >= job.done), c_byte)
+        return Vix.VIX_OK
+
+    def VixJob_GetError(self, jobHandle):
+        job = self._get(jobHandle, FakeJob)
+        if job is None:
+            return Vix.VIX_E_INVALID_HANDLE
+        return job.err
+
+    def VixJob_GetNumProperties(self, jobHandle, propid):
+        job = self._get(jobHandle, FakeJob)
+        if job is None:
+            return 0
+        return len([row for row in job.rows if propid in row])
+
+    def VixJob_GetNthProperties(self, jobHandle, index, *args):
+        job = self._get(jobHandle, FakeJob)
+        if job is None or index >= len(job.rows):
+            return Vix.VIX_E_INVALID_ARG
+        row = job.rows[index]
+        for propid, ref in _pairs(args):
+            if propid not in row:
+                return Vix.VIX_E_UNRECOGNIZED_PROPERTY
+            value = row[propid]
+            if isinstance(value, str):
+                value = self._string(value)
+            _store(ref, value)
+        return Vix.VIX_OK
+
+    ##### host
+
+    def VixHost_Connect(self, apiVersion, hostType, hostName, hostPort, userName, password,
+            options, propertyListHandle, callbackProc, clientData):
+        err = self._failure("VixHost_Connect")
+        if err == Vix.VIX_OK and self.users is not None and self.users.get(userName) != password:
+            err = Vix.VIX_E_HOST_USER_PERMISSIONS
+        props = {}
+        if err == Vix.VIX_OK:
+            props[Vix.VIX_PROPERTY_JOB_RESULT_HANDLE] = self._new(FakeHost(hostName, userName))
+        return self._job("VixHost_Connect", err, props, host = hostName,
+            callbackProc = callbackProc, clientData = clientData)
+
+    def VixHost_Disconnect(self, hostHandle):
+        '''
+        Like libvix, disconnecting also closes the VMs opened on the host
+        '''
+        self.lock.acquire()
+        try:
+            for vmHandle, owner in self._owners.items():
+                if owner == hostHandle:
+                    del self._owners[vmHandle]
+                    self._refs.pop(vmHandle, None)
+                    self._handles.pop(vmHandle, None)
+            self.Vix_ReleaseHandle(hostHandle)
+        finally:
+            self.lock.release()
+
+    def VixHost_RegisterVM(self, hostHandle, vmxFilePath, callbackProc, clientData):
+        err = self._failure("VixHost_RegisterVM")
+        if err == Vix.VIX_OK:
+            self.addvm(vmxFilePath, self.vms.get(vmxFilePath, FakeVM(vmxFilePath)).powerstate).registered = True
+        return self._job("VixHost_RegisterVM", err, callbackProc = callbackProc, clientData = clientData)
+
+    def VixHost_UnregisterVM(self, hostHandle, vmxFilePath, callbackProc, clientData):
+        err = self._failure("VixHost_UnregisterVM")
+        vm = self.vms.get(vmxFilePath)
+        if err == Vix.VIX_OK and vm is None:
+            err = Vix.VIX_E_FILE_NOT_FOUND
+        if err == Vix.VIX_OK:
+            vm.registered = False
+        return self._job("VixHost_UnregisterVM", err, callbackProc = callbackProc, clientData = clientData)
+
+    def VixHost_FindItems(self, hostHandle, searchType, searchCriteria, timeout,
+            callbackProc, clientData):
+        '''
+        Registered or running VMs are reported through FIND_ITEM events to
+        callbackProc, as libvix does
+        '''
+        err = self._failure("VixHost_FindItems")
+        events = []
+        for vmxpath, vm in sorted(self.vms.items()):
+            if not vm.registered:
+                continue
+            if searchType == Vix.VIX_FIND_RUNNING_VMS and not vm.powerstate & Vix.VIX_POWERSTATE_POWERED_ON:
+                continue
+            events.append((Vix.VIX_EVENTTYPE_FIND_ITEM, {Vix.VIX_PROPERTY_FOUND_ITEM_LOCATION: vmxpath}))
+        if err != Vix.VIX_OK:
+            events = []
+        host = self._get(hostHandle, FakeHost)
+        return self._job("VixHost_FindItems", err, host = host and host.hostname,
+            callbackProc = callbackProc, clientData = clientData, events = events)
+
+    ##### VM
+
+    def VixVM_Open(self, hostHandle, vmxFilePath, callbackProc, clientData):
+        err = self._failure("VixVM_Open")
+        host = self._get(hostHandle, FakeHost)
+        if err == Vix.VIX_OK and host is None:
+            err = Vix.VIX_E_INVALID_HANDLE
+        vm = self.vms.get(vmxFilePath)
+        if err == Vix.VIX_OK and vm is None:
+            if self.autocreate:
+                vm = self.addvm(vmxFilePath)
+            else:
+                err = Vix.VIX_E_FILE_NOT_FOUND
+        props = {}
+        if err == Vix.VIX_OK:
+            vmHandle = props[Vix.VIX_PROPERTY_JOB_RESULT_HANDLE] = self._new(vm)
+            self._owners[vmHandle] = hostHandle
+        return self._job("VixVM_Open", err, props, host = host and host.hostname,
+            callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_PowerOn(self, vmHandle, powerOnOptions, propertyListHandle, callbackProc, clientData):
+        vm = self._get(vmHandle, FakeVM)
+        err = vm is None and Vix.VIX_E_INVALID_HANDLE or self._failure("VixVM_PowerOn")
+        if err == Vix.VIX_OK:
+            vm.powerstate = Vix.VIX_POWERSTATE_POWERED_ON | Vix.VIX_POWERSTATE_TOOLS_RUNNING
+        return self._job("VixVM_PowerOn", err, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_PowerOff(self, vmHandle, powerOffOptions, callbackProc, clientData):
+        vm = self._get(vmHandle, FakeVM)
+        err = vm is None and Vix.VIX_E_INVALID_HANDLE or self._failure("VixVM_PowerOff")
+        if err == Vix.VIX_OK:
+            vm.powerstate = Vix.VIX_POWERSTATE_POWERED_OFF
+            vm.loggedin = False
+        return self._job("VixVM_PowerOff", err, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_Delete(self, vmHandle, deleteOptions, callbackProc, clientData):
+        vm = self._get(vmHandle, FakeVM)
+        err = vm is None and Vix.VIX_E_INVALID_HANDLE or self._failure("VixVM_Delete")
+        if err == Vix.VIX_OK:
+            self.lock.acquire()
+            try:
+                self.vms.pop(vm.vmxpath, None)
+            finally:
+                self.lock.release()
+        return self._job("VixVM_Delete", err, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_Clone(self, vmHandle, snapshotHandle, cloneType, destConfigPathName, options,
+            propertyListHandle, callbackProc, clientData):
+        vm = self._get(vmHandle, FakeVM)
+        err = vm is None and Vix.VIX_E_INVALID_HANDLE or self._failure("VixVM_Clone")
+        if err == Vix.VIX_OK and destConfigPathName in self.vms:
+            err = Vix.VIX_E_FILE_ALREADY_EXISTS
+        props = {}
+        if err == Vix.VIX_OK:
+            clone = self.addvm(destConfigPathName)
+            clone.files = dict(vm.files)
+            clone.dirs = set(vm.dirs)
+            props[Vix.VIX_PROPERTY_JOB_RESULT_HANDLE] = self._new(clone)
+        return self._job("VixVM_Clone", err, props, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_WaitForToolsInGuest(self, vmHandle, timeoutInSeconds, callbackProc, clientData):
+        vm, err = self._guest(vmHandle, "VixVM_WaitForToolsInGuest")
+        return self._job("VixVM_WaitForToolsInGuest", err, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_LoginInGuest(self, vmHandle, userName, password, options, callbackProc, clientData):
+        vm, err = self._guest(vmHandle, "VixVM_LoginInGuest")
+        if err == Vix.VIX_OK:
+            vm.loggedin = True
+        return self._job("VixVM_LoginInGuest", err, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_LogoutFromGuest(self, vmHandle, callbackProc, clientData):
+        vm, err = self._guest(vmHandle, "VixVM_LogoutFromGuest")
+        if err == Vix.VIX_OK:
+            vm.loggedin = False
+        return self._job("VixVM_LogoutFromGuest", err, callbackProc = callbackProc, clientData = clientData)
+
+    ##### guest programs
+
+    def _run(self, opname, vmHandle, interpreter, text, callbackProc, clientData):
+        vm, err = self._guest(vmHandle, opname)
+        props = {}
+        if err == Vix.VIX_OK:
+            self.lock.acquire()
+            try:
+                self._nextpid += 1
+                pid = self._nextpid
+                self.scripts.append((vm.vmxpath, interpreter, text))
+            finally:
+                self.lock.release()
+            exitcode = 0
+            if self.scripthook is not None:
+                exitcode = self.scripthook(vm, interpreter, text)
+            props = {Vix.VIX_PROPERTY_JOB_RESULT_PROCESS_ID: pid,
+                Vix.VIX_PROPERTY_JOB_RESULT_GUEST_PROGRAM_EXIT_CODE: exitcode,
+                Vix.VIX_PROPERTY_JOB_RESULT_GUEST_PROGRAM_ELAPSED_TIME: int(self.latencies.get(opname, self.latency))}
+        return self._job(opname, err, props, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_RunProgramInGuest(self, vmHandle, guestProgramName, commandLineArgs, options,
+            propertyListHandle, callbackProc, clientData):
+        return self._run("VixVM_RunProgramInGuest", vmHandle, guestProgramName, commandLineArgs,
+            callbackProc, clientData)
+
+    def VixVM_RunScriptInGuest(self, vmHandle, interpreter, scriptText, options,
+            propertyListHandle, callbackProc, clientData):
+        return self._run("VixVM_RunScriptInGuest", vmHandle, interpreter, scriptText,
+            callbackProc, clientData)
+
+    ##### guest files
+
+    def _path(self, path):
+        return posixpath.normpath(path.replace("\\", "/"))
+
+    def VixVM_CopyFileFromHostToGuest(self, vmHandle, hostPathName, guestPathName, options,
+            propertyListHandle, callbackProc, clientData):
+        vm, err = self._guest(vmHandle, "VixVM_CopyFileFromHostToGuest")
+        path = self._path(guestPathName)
+        if err == Vix.VIX_OK and posixpath.dirname(path) not in vm.dirs:
+            err = Vix.VIX_E_FILE_NOT_FOUND
+        if err == Vix.VIX_OK:
+            try:
+                f = open(hostPathName, "rb")
+                try:
+                    vm.files[path] = f.read()
+                finally:
+                    f.close()
+            except IOError:
+                err = Vix.VIX_E_FILE_NOT_FOUND
+        return self._job("VixVM_CopyFileFromHostToGuest", err, callbackProc = callbackProc,
+            clientData = clientData)
+
+    def VixVM_CopyFileFromGuestToHost(self, vmHandle, guestPathName, hostPathName, options,
+            propertyListHandle, callbackProc, clientData):
+        vm, err = self._guest(vmHandle, "VixVM_CopyFileFromGuestToHost")
+        path = self._path(guestPathName)
+        if err == Vix.VIX_OK and path not in vm.files:
+            err = Vix.VIX_E_FILE_NOT_FOUND
+        if err == Vix.VIX_OK:
+            f = open(hostPathName, "wb")
+            try:
+                f.write(vm.files[path])
+            finally:
+                f.close()
+        return self._job("VixVM_CopyFileFromGuestToHost", err, callbackProc = callbackProc,
+            clientData = clientData)
+
+    def VixVM_DeleteFileInGuest(self, vmHandle, guestPathName, callbackProc, clientData):
+        vm, err = self._guest(vmHandle, "VixVM_DeleteFileInGuest")
+        if err == Vix.VIX_OK and vm.files.pop(self._path(guestPathName), None) is None:
+            err = Vix.VIX_E_FILE_NOT_FOUND
+        return self._job("VixVM_DeleteFileInGuest", err, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_FileExistsInGuest(self, vmHandle, guestPathName, callbackProc, clientData):
+        vm, err = self._guest(vmHandle, "VixVM_FileExistsInGuest")
+        props = {}
+        if err == Vix.VIX_OK:
+            props[Vix.VIX_PROPERTY_JOB_RESULT_GUEST_OBJECT_EXISTS] = int(self._path(guestPathName) in vm.files)
+        return self._job("VixVM_FileExistsInGuest", err, props, callbackProc = callbackProc,
+            clientData = clientData)
+
+    def VixVM_RenameFileInGuest(self, vmHandle, oldName, newName, options, propertyListHandle,
+            callbackProc, clientData):
+        vm, err = self._guest(vmHandle, "VixVM_RenameFileInGuest")
+        old = self._path(oldName)
+        if err == Vix.VIX_OK and old not in vm.files:
+            err = Vix.VIX_E_FILE_NOT_FOUND
+        if err == Vix.VIX_OK:
+            vm.files[self._path(newName)] = vm.files.pop(old)
+        return self._job("VixVM_RenameFileInGuest", err, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_ListDirectoryInGuest(self, vmHandle, pathName, options, callbackProc, clientData):
+        vm, err = self._guest(vmHandle, "VixVM_ListDirectoryInGuest")
+        path = self._path(pathName)
+        if err == Vix.VIX_OK and path not in vm.dirs:
+            err = Vix.VIX_E_FILE_NOT_FOUND
+        rows = []
+        if err == Vix.VIX_OK:
+            for name in sorted(vm.dirs):
+                if name != path and posixpath.dirname(name) == path:
+                    rows.append({Vix.VIX_PROPERTY_JOB_RESULT_ITEM_NAME: posixpath.basename(name),
+                        Vix.VIX_PROPERTY_JOB_RESULT_FILE_SIZE: 0,
+                        Vix.VIX_PROPERTY_JOB_RESULT_FILE_FLAGS: Vix.VIX_FILE_ATTRIBUTES_DIRECTORY,
+                        Vix.VIX_PROPERTY_JOB_RESULT_FILE_MOD_TIME: 0})
+            for name, data in sorted(vm.files.items()):
+                if posixpath.dirname(name) == path:
+                    rows.append({Vix.VIX_PROPERTY_JOB_RESULT_ITEM_NAME: posixpath.basename(name),
+                        Vix.VIX_PROPERTY_JOB_RESULT_FILE_SIZE: len(data),
+                        Vix.VIX_PROPERTY_JOB_RESULT_FILE_FLAGS: 0,
+                        Vix.VIX_PROPERTY_JOB_RESULT_FILE_MOD_TIME: 0})
+        return self._job("VixVM_ListDirectoryInGuest", err, rows = rows, callbackProc = callbackProc,
+            clientData = clientData)
+
+    def VixVM_CreateDirectoryInGuest(self, vmHandle, pathName, propertyListHandle, callbackProc, clientData):
+        vm, err = self._guest(vmHandle, "VixVM_CreateDirectoryInGuest")
+        path = self._path(pathName)
+        if err == Vix.VIX_OK and path in vm.dirs:
+            err = Vix.VIX_E_FILE_ALREADY_EXISTS
+        if err == Vix.VIX_OK and posixpath.dirname(path) not in vm.dirs:
+            err = Vix.VIX_E_FILE_NOT_FOUND
+        if err == Vix.VIX_OK:
+            vm.dirs.add(path)
+        return self._job("VixVM_CreateDirectoryInGuest", err, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_DeleteDirectoryInGuest(self, vmHandle, pathName, options, callbackProc, clientData):
+        vm, err = self._guest(vmHandle, "VixVM_DeleteDirectoryInGuest")
+        path = self._path(pathName)
+        if err == Vix.VIX_OK and path not in vm.dirs:
+            err = Vix.VIX_E_FILE_NOT_FOUND
+        if err == Vix.VIX_OK:
+            prefix = path.rstrip("/") + "/"
+            vm.dirs = set(name for name in vm.dirs if name != path and not name.startswith(prefix))
+            vm.files = dict(item for item in vm.files.items() if not item[0].startswith(prefix))
+        return self._job("VixVM_DeleteDirectoryInGuest", err, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_DirectoryExistsInGuest(self, vmHandle, pathName, callbackProc, clientData):
+        vm, err = self._guest(vmHandle, "VixVM_DirectoryExistsInGuest")
+        props = {}
+        if err == Vix.VIX_OK:
+            props[Vix.VIX_PROPERTY_JOB_RESULT_GUEST_OBJECT_EXISTS] = int(self._path(pathName) in vm.dirs)
+        return self._job("VixVM_DirectoryExistsInGuest", err, props, callbackProc = callbackProc,
+            clientData = clientData)
+
+    ##### snapshots
+
+    def VixVM_CreateSnapshot(self, vmHandle, name, description, options, propertyListHandle,
+            callbackProc, clientData):
+        vm = self._get(vmHandle, FakeVM)
+        err = vm is None and Vix.VIX_E_INVALID_HANDLE or self._failure("VixVM_CreateSnapshot")
+        props = {}
+        if err == Vix.VIX_OK:
+            snapshot = FakeSnapshot(vm, name, description, vm.current, vm.powerstate)
+            if vm.current is None:
+                vm.roots.append(snapshot)
+            else:
+                vm.current.children.append(snapshot)
+            vm.current = snapshot
+            props[Vix.VIX_PROPERTY_JOB_RESULT_HANDLE] = self._new(snapshot)
+        return self._job("VixVM_CreateSnapshot", err, props, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_RevertToSnapshot(self, vmHandle, snapshotHandle, options, propertyListHandle,
+            callbackProc, clientData):
+        vm = self._get(vmHandle, FakeVM)
+        snapshot = self._get(snapshotHandle, FakeSnapshot)
+        err = (vm is None or snapshot is None) and Vix.VIX_E_INVALID_HANDLE or self._failure("VixVM_RevertToSnapshot")
+        if err == Vix.VIX_OK:
+            vm.current = snapshot
+            vm.powerstate = snapshot.powerstate
+        return self._job("VixVM_RevertToSnapshot", err, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_RemoveSnapshot(self, vmHandle, snapshotHandle, options, callbackProc, clientData):
+        vm = self._get(vmHandle, FakeVM)
+        snapshot = self._get(snapshotHandle, FakeSnapshot)
+        err = (vm is None or snapshot is None) and Vix.VIX_E_INVALID_HANDLE or self._failure("VixVM_RemoveSnapshot")
+        if err == Vix.VIX_OK:
+            siblings = snapshot.parent and snapshot.parent.children or vm.roots
+            siblings.remove(snapshot)
+            if not options & Vix.VIX_SNAPSHOT_REMOVE_CHILDREN:
+                for child in snapshot.children:
+                    child.parent = snapshot.parent
+                    siblings.append(child)
+            current = vm.current
+            while current is not None and current is not snapshot:
+                current = current.parent
+            if current is snapshot:
+                vm.current = snapshot.parent
+        return self._job("VixVM_RemoveSnapshot", err, callbackProc = callbackProc, clientData = clientData)
+
+    def VixVM_GetNumRootSnapshots(self, vmHandle, result):
+        vm = self._get(vmHandle, FakeVM)
+        if vm is None:
+            return Vix.VIX_E_INVALID_HANDLE
+        _store(result, len(vm.roots))
+        return Vix.VIX_OK
+
+    def VixVM_GetRootSnapshot(self, vmHandle, index, snapshotHandle):
+        vm = self._get(vmHandle, FakeVM)
+        if vm is None:
+            return Vix.VIX_E_INVALID_HANDLE
+        if index >= len(vm.roots):
+            return Vix.VIX_E_INVALID_ARG
+        _store(snapshotHandle, self._new(vm.roots[index]))
+        return Vix.VIX_OK
+
+    def VixVM_GetCurrentSnapshot(self, vmHandle, snapshotHandle):
+        vm = self._get(vmHandle, FakeVM)
+        if vm is None:
+            return Vix.VIX_E_INVALID_HANDLE
+        if vm.current is None:
+            return Vix.VIX_E_SNAPSHOT_NOTFOUND
+        _store(snapshotHandle, self._new(vm.current))
+        return Vix.VIX_OK
+
+    def VixVM_GetNamedSnapshot(self, vmHandle, name, snapshotHandle):
+        vm = self._get(vmHandle, FakeVM)
+        if vm is None:
+            return Vix.VIX_E_INVALID_HANDLE
+        snapshot = self._snapshot(vm, name)
+        if snapshot is None:
+            return Vix.VIX_E_SNAPSHOT_NOTFOUND
+        _store(snapshotHandle, self._new(snapshot))
+        return Vix.VIX_OK
+
+    def VixSnapshot_GetNumChildren(self, parentSnapshotHandle, numChildSnapshots):
+        snapshot = self._get(parentSnapshotHandle, FakeSnapshot)
+        if snapshot is None:
+            return Vix.VIX_E_INVALID_HANDLE
+        _store(numChildSnapshots, len(snapshot.children))
+        return Vix.VIX_OK
+
+    def VixSnapshot_GetChild(self, parentSnapshotHandle, index, childSnapshotHandle):
+        snapshot = self._get(parentSnapshotHandle, FakeSnapshot)
+        if snapshot is None:
+            return Vix.VIX_E_INVALID_HANDLE
+        if index >= len(snapshot.children):
+            return Vix.VIX_E_INVALID_ARG
+        _store(childSnapshotHandle, self._new(snapshot.children[index]))
+        return Vix.VIX_OK
+
+    def VixSnapshot_GetParent(self, snapshotHandle, parentSnapshotHandle):
+        snapshot = self._get(snapshotHandle, FakeSnapshot)
+        if snapshot is None:
+            return Vix.VIX_E_INVALID_HANDLE
+        if snapshot.parent is None:
+            _store(parentSnapshotHandle, Vix.VIX_INVALID_HANDLE)
+        else:
+            _store(parentSnapshotHandle, self._new(snapshot.parent))
+        return Vix.VIX_OK
+
+
+def install(**kwargs):
+    '''
+    Create a FakeVixLib and make pyvix use it, returning the fake
+    '''
+    fake = FakeVixLib(**kwargs)
+    setvixlib(fake)
+    return fake
+
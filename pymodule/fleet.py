@@ -0,0 +1,241 @@
+# -*- coding:utf-8 -*-
+'''
+Batch power operations over many VMs of one host.
+
+power_on_many/power_off_many/revert_many submit the open and power jobs
+of every VM through AsyncVix, keeping at most limit of them in flight per
+batch, and yield one FleetResult per VM as soon as it is finished.  All
+batches of the process together keep within the limit of the host,
+HOST_INFLIGHT unless set with sethostlimit().
+'''
+
+import threading
+import time
+import Queue
+from ctypes import *
+
+from pyvix import Vix, VixException
+from asyncvix import AsyncVix
+
+# VMs of one host worked on at the same time, by one batch unless told
+# otherwise and by all batches together unless set with sethostlimit()
+HOST_INFLIGHT = 8
+
+
+class Slots(object):
+    '''
+    Semaphore whose limit may be changed while slots are taken; a lower
+    limit holds back acquire() until enough slots are given back
+    '''
+    def __init__(self, limit):
+        self.cond = threading.Condition()
+        self.limit = limit
+        self.taken = 0
+
+    def acquire(self, blocking = True):
+        self.cond.acquire()
+        try:
+            while self.taken >= self.limit:
+                if not blocking:
+                    return False
+                self.cond.wait()
+            self.taken += 1
+            return True
+        finally:
+            self.cond.release()
+
+    def release(self):
+        self.cond.acquire()
+        try:
+            self.taken -= 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def resize(self, limit):
+        self.cond.acquire()
+        try:
+            self.limit = limit
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+
+_hostlimits = {}
+_hostslots = {}
+_hostslotsLock = threading.Lock()
+
+def sethostlimit(hostname, limit):
+    '''
+    Bound the jobs in flight on a host by all batches of the process
+    together, HOST_INFLIGHT unless set
+    '''
+    _hostslotsLock.acquire()
+    try:
+        _hostlimits[hostname] = limit
+        slots = _hostslots.get(hostname)
+        if slots is not None:
+            slots.resize(limit)
+    finally:
+        _hostslotsLock.release()
+
+def hostslots(hostname):
+    '''
+    Slots bounding the jobs in flight on one host, shared by all batches
+    '''
+    _hostslotsLock.acquire()
+    try:
+        slots = _hostslots.get(hostname)
+        if slots is None:
+            slots = _hostslots[hostname] = Slots(_hostlimits.get(hostname, HOST_INFLIGHT))
+        return slots
+    finally:
+        _hostslotsLock.release()
+
+
+class FleetResult(object):
+    '''
+    Outcome of one VM of a batch
+    '''
+    def __init__(self, vmxpath, elapsed, error = None):
+        self.vmxpath = vmxpath
+        self.elapsed = elapsed
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return "<FleetResult %s ok %.2fs>"%(self.vmxpath, self.elapsed)
+        return "<FleetResult %s failed %.2fs: %s>"%(self.vmxpath, self.elapsed, self.error)
+
+
+def power_on_many(vix, vmxpaths, limit = HOST_INFLIGHT):
+    '''
+    Power on every VM, yielding a FleetResult per VM as it completes
+    '''
+    return _runmany(vix, vmxpaths, limit, [lambda av, vmHandle: av.PowerOn(vmHandle)])
+
+def power_off_many(vix, vmxpaths, limit = HOST_INFLIGHT):
+    return _runmany(vix, vmxpaths, limit, [lambda av, vmHandle: av.PowerOff(vmHandle)])
+
+def revert_many(vix, vmxpaths, snapshotname = None, poweron = False, limit = HOST_INFLIGHT):
+    '''
+    Revert every VM to the named snapshot, or to its current one when no
+    name is given, and optionally power it on afterwards
+    '''
+    def revert(av, vmHandle):
+        if snapshotname is not None and vix.snapshotCache is not None:
+            tree = vix.GetSnapshotTree(vmHandle)
+            try:
+                snapshotHandle = tree.find(snapshotname).handle
+                # ours until the revert is done, the tree goes away with it
+                vix.vix.Vix_AddRefHandle(snapshotHandle)
+            finally:
+                tree.release()
+        else:
+            handle = c_int()
+            if snapshotname is None:
+                opname = "VixVM_GetCurrentSnapshot"
+                err = vix.vix.VixVM_GetCurrentSnapshot(vmHandle, byref(handle))
+            else:
+                opname = "VixVM_GetNamedSnapshot"
+                err = vix.vix.VixVM_GetNamedSnapshot(vmHandle, snapshotname, byref(handle))
+            if err != Vix.VIX_OK:
+                raise VixException("%s Failed"%opname, err)
+            snapshotHandle = handle.value
+        try:
+            future = av.RevertToSnapshot(snapshotHandle, vmHandle)
+        except:
+            vix.vix.Vix_ReleaseHandle(snapshotHandle)
+            raise
+        future.add_done_callback(lambda future: vix.vix.Vix_ReleaseHandle(snapshotHandle))
+        return future
+    steps = [revert]
+    if poweron:
+        steps.append(lambda av, vmHandle: av.PowerOn(vmHandle))
+    return _runmany(vix, vmxpaths, limit, steps)
+
+
+def _runmany(vix, vmxpaths, limit, steps):
+    av = AsyncVix(vix)
+    slots = hostslots(vix.url)
+    finished = Queue.Queue()
+    pending = list(vmxpaths)
+    inflight = 0
+    try:
+        while pending or inflight:
+            # only block for a slot when nothing of ours is left to wait for
+            while pending and inflight < limit and slots.acquire(inflight == 0):
+                _Chain(av, pending.pop(0), steps, finished).start()
+                inflight += 1
+            result = finished.get()
+            slots.release()
+            inflight -= 1
+            yield result
+    finally:
+        # the caller stopped early, the host slots are ours until the jobs end
+        while inflight:
+            finished.get()
+            slots.release()
+            inflight -= 1
+
+
+class _Chain(object):
+    '''
+    Open one VM, then run the steps one after another on its handle.  The
+    chain owns a reference to the handle, from the open or from
+    Vix.vmCache, and releases it when it is done.
+    '''
+    def __init__(self, av, vmxpath, steps, finished):
+        self.av = av
+        self.vmxpath = vmxpath
+        self.steps = list(steps)
+        self.finished = finished
+        self.vmHandle = Vix.VIX_INVALID_HANDLE
+        self.started = time.time()
+
+    def start(self):
+        vix = self.av.vix
+        vmHandle = None
+        if vix.vmCache is not None:
+            vmHandle = vix.vmCache.get(vix.hostHandle, self.vmxpath)
+        if vmHandle is not None:
+            self._next(vmHandle)
+        else:
+            self._wait(self.av.Open(self.vmxpath), self._opened)
+
+    def _opened(self, vmHandle):
+        vix = self.av.vix
+        if vix.vmCache is not None:
+            vix.vmCache.put(vix.hostHandle, self.vmxpath, vmHandle)
+        self._next(vmHandle)
+
+    def _next(self, vmHandle):
+        self.vmHandle = vmHandle
+        if not self.steps:
+            self._done(None)
+            return
+        step = self.steps.pop(0)
+        try:
+            future = step(self.av, vmHandle)
+        except Exception, e:
+            self._done(e)
+            return
+        self._wait(future, lambda result: self._next(vmHandle))
+
+    def _wait(self, future, then):
+        def resolved(future):
+            error = future.exception()
+            if error is not None:
+                self._done(error)
+            else:
+                then(future.result())
+        future.add_done_callback(resolved)
+
+    def _done(self, error):
+        if self.vmHandle not in (None, Vix.VIX_INVALID_HANDLE):
+            self.av.vix.vix.Vix_ReleaseHandle(self.vmHandle)
+        self.finished.put(FleetResult(self.vmxpath, time.time() - self.started, error))
@@ -0,0 +1,1032 @@
+# -*- coding:utf-8 -*-
+'''
+Event driven replacement of the vmmengine daemon.
+
+vmmengine forks a child per client, and every child logs in to ESXi on its
+own.  The gateway speaks the same protocol and command set (CMDNAME_LIST in
+vixSession.h, answered as handle_esxi_session and do_esxi_session do) from
+one process: a single asyncore loop owns all client sockets, and the
+blocking VIX work of the commands runs on a small pool of worker threads.
+Clients of one ESXi host and user share one host handle through
+Vix.hostPool, and clients opening the same VM share its handle through
+Vix.vmCache, so telnet scripts and vmmclient keep working while the host
+sees one connection instead of hundreds.
+
+    python gateway.py 127.0.0.1 4564
+
+Commands of one client run strictly in order, one at a time; commands of
+different clients run concurrently.  A command ends at a newline or a NUL,
+which covers both telnet lines and the NUL padded records of vmmclient;
+like the daemon's read(), MAXPACKLEN bytes without either are taken as one
+command.
+
+"proto;2" switches a client to the framed protocol of vixproto, where
+arguments may hold anything and be of any length.  Replies there carry the
+id of their request, so the commands in CONCURRENT, which only read the
+session state or keep snapshot handles under its lock, run side by side, up to CLIENT_INFLIGHT at a time, and are
+answered as they finish; any other command waits for those before it and
+runs alone, so "open" followed by "fetch" still fetches from the opened VM.
+
+Clients sharing a VM handle share its guest login as well: a login with the
+credentials already in use on the handle costs nothing, a login under other
+credentials is refused while clients are logged in on it, and once the last
+client logged in on it logs out or leaves the login is handed to
+Vix.guestSessions, so the next session logging in as the same user skips
+the tools wait and the login; it is logged out when it stays idle.
+
+Commands the daemon accepts but does nothing for (perl, delfile, clone,
+mkdir, rmdir) answer "[0]" here as well.
+
+"F:" replies (listguests, dir, sslist) carry their data at its exact
+length between "[0]" and the trailer, as vmmengine sends it.  On top of the
+daemon's commands, "fetch;<guest path>" streams a guest file the same way:
+it is copied once to a host temp file, which goes out to the socket through
+sendfile in the loop thread and is removed afterwards.
+'''
+
+import os
+import re
+import sys
+import copy
+import mmap
+import errno
+import socket
+import asyncore
+import logging
+import tempfile
+import threading
+import functools
+import Queue
+from collections import deque
+
+import pyvix
+import vixproto
+from pyvix import Vix, VixException, _getstrings
+from transfer import md5file
+from vmmclient import MAXPACKLEN, EOF, RECV_SIZE, _Waker
+
+# Worker threads running the VIX side of commands
+WORKERS = 16
+# Tries of hput before giving up, as CID_HPUT does
+HPUT_TRIES = 3
+# Bytes of a streamed file given to one send call
+SEND_CHUNK = 256 * 1024
+# Commands of one framed protocol client running at once
+CLIENT_INFLIGHT = 4
+
+# Session states, see vixSession.h
+CONNECTED_ESXI = 1
+OPENED_VM = 2
+LOGINED_VM = 4
+
+# Reply codes, see vixSession.h
+VE_000 = 0      # OK
+VE_001 = 1      # failed to init host ticket
+VE_002 = 2      # failed to connect esxi
+VE_003 = 3      # failed to disconnect esxi
+VE_004 = 4      # not connected to esxi yet
+VE_005 = 5      # failed to get registered vms
+VE_006 = 6      # failed to open vm with vmxpath
+VE_007 = 7      # failed to register vmxpath
+VE_008 = 8      # failed to un-register vmxpath
+VE_009 = 9      # failed to close vm with cached vmxpath
+VE_010 = 10     # failed to operate power state
+VE_011 = 11     # failed to login vm
+VE_012 = 12     # failed to logout vm
+VE_013 = 13     # failed to transfer file to vm
+VE_014 = 14     # failed to run in vm
+VE_015 = 15     # failed to operate snapshot
+
+# CMDNAME_LIST and CMDARGNUM_LIST of vixSession.h with the code answered
+# when the VIX side of a command fails
+COMMANDS = [
+    ("test", 0, VE_000),
+    ("connect", 3, VE_002),
+    ("disconn", 0, VE_003),
+    ("listguests", 0, VE_005),
+    ("open", 1, VE_006),
+    ("poweron", 0, VE_010),
+    ("poweroff", 0, VE_010),
+    ("login", 2, VE_011),
+    ("logout", 0, VE_012),
+    ("put", 2, VE_013),
+    ("hput", 2, VE_013),
+    ("get", 2, VE_013),
+    ("bat", 2, VE_014),
+    ("bash", 2, VE_014),
+    ("perl", 2, VE_014),
+    ("delfile", 1, VE_014),
+    ("clone", 1, VE_014),
+    ("dir", 0, VE_014),
+    ("cd", 1, VE_000),
+    ("mkdir", 1, VE_014),
+    ("rmdir", 1, VE_014),
+    ("createss", 2, VE_015),
+    ("ssrnum", 0, VE_015),
+    ("gotoss", 1, VE_015),
+    ("ssnum", 0, VE_015),
+    ("rmss", 1, VE_015),
+    ("sslist", 0, VE_015),
+    ("powerstate", 0, VE_010),
+    ("registvm", 1, VE_007),
+    ("unregistvm", 1, VE_008),
+    ("close", 0, VE_009),
+    ("deletevm", 0, VE_004),
+    ("getnamess", 1, VE_015),
+    ("delssid", 1, VE_015),
+    # gateway only
+    ("fetch", 1, VE_013),
+    ("proto", 1, VE_000),
+]
+
+# Commands that leave the session state alone, but for the snapshot handles
+# getnamess keeps under snapshotsLock, run side by side for framed protocol
+# clients
+CONCURRENT = frozenset(["test", "listguests", "powerstate", "put", "hput",
+    "get", "bat", "bash", "perl", "delfile", "dir", "ssrnum", "ssnum",
+    "sslist", "getnamess", "fetch"])
+
+# VMPOWER of vixVarStruct.h, answered by powerstate
+PWUNKNOWN, POWERING_OFF, POWERD_OFF, POWERING_ON, POWERED_ON = range(5)
+
+# Stands in for missing strings, as the daemon's null
+NULL = "null"
+
+_SEPARATOR = re.compile("[\0\n]")
+
+
+def command_index(name):
+    '''
+    Index into COMMANDS of a command name, prefixes match the first command
+    starting with them as in cmd_name_to_index; -1 if there is none
+    '''
+    for index, command in enumerate(COMMANDS):
+        if command[0].startswith(name):
+            return index
+    return -1
+
+
+def parse_request(request):
+    '''
+    (COMMANDS index, arguments) of a request line, arguments missing from
+    the line are empty strings
+    '''
+    return parse_fields([token for token in request.split(";") if token])
+
+
+def parse_fields(fields):
+    '''
+    (COMMANDS index, arguments) of a command name and its arguments
+    '''
+    if not fields or not fields[0]:
+        return -1, []
+    index = command_index(fields[0])
+    if index < 0:
+        return index, []
+    args = fields[1:]
+    return index, args + [""] * (COMMANDS[index][1] - len(args))
+
+
+def vmpower(powerstate):
+    '''
+    VMPOWER value of a VIX_POWERSTATE_* bitmask, as GetVMPowerState maps it
+    '''
+    if powerstate & Vix.VIX_POWERSTATE_POWERING_OFF:
+        return POWERING_OFF
+    if powerstate & Vix.VIX_POWERSTATE_POWERED_OFF:
+        return POWERD_OFF
+    if powerstate & Vix.VIX_POWERSTATE_POWERING_ON:
+        return POWERING_ON
+    if powerstate & Vix.VIX_POWERSTATE_POWERED_ON:
+        return POWERED_ON
+    return PWUNKNOWN
+
+
+def filereply(data):
+    '''
+    Parts of a streamed "F:" reply: "[0]", the data, then the trailer
+    '''
+    return ["[0]", data, EOF]
+
+
+def textreply(code, text, data = None):
+    '''
+    Parts of the reply to a request line
+    '''
+    if code == VE_000 and data is not None:
+        return filereply(data)
+    return ["[%d]%s%s"%(code, text, EOF)]
+
+
+def framedreply(reqid, code, text, data = None):
+    '''
+    Parts of the reply to a request frame
+    '''
+    if isinstance(data, FilePart):
+        return [FramedFile(reqid, data)]
+    if code != VE_000:
+        data = None
+    return [vixproto.replyframes(reqid, code, text, data)]
+
+
+class FilePart(object):
+    '''
+    Host file sent as part of a reply, piece by piece as the socket takes
+    it, and removed once sent or dropped
+    '''
+    # never handed over to another reply half sent
+    boundary = False
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.offset = 0
+        # sendto() stops here, FramedFile moves it frame by frame
+        self.limit = self.size
+        self.mapped = None
+
+    @property
+    def done(self):
+        return self.offset >= self.size
+
+    def sendto(self, channel):
+        '''
+        Send what the non-blocking socket takes, returning the byte count
+        '''
+        count = min(self.limit - self.offset, SEND_CHUNK)
+        if count <= 0:
+            return 0
+        try:
+            if pyvix.sendfile is not None:
+                sent = pyvix.sendfile(channel.socket.fileno(), self.file.fileno(), self.offset, count)
+            else:
+                if self.mapped is None:
+                    self.mapped = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+                sent = channel.socket.send(self.mapped[self.offset:self.offset + count])
+        except (OSError, socket.error), e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+        self.offset += sent
+        return sent
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+        self.file.close()
+        os.remove(self.path)
+
+
+class FramedFile(object):
+    '''
+    FilePart sent as the FLAG_MORE frames of a framed reply, each frame
+    header followed by its piece of the file through FilePart.sendto()
+    '''
+    def __init__(self, reqid, part):
+        self.reqid = reqid
+        self.part = part
+        # nothing goes out before the first frame header
+        part.limit = part.offset
+        self.pending = ""
+        self.ended = False
+
+    @property
+    def done(self):
+        return self.ended and not self.pending
+
+    @property
+    def boundary(self):
+        '''
+        Between two frames, where other replies may go out
+        '''
+        return not self.pending and self.part.offset >= self.part.limit
+
+    def sendto(self, channel):
+        if self.boundary and not self.ended:
+            part = self.part
+            count = min(part.size - part.offset, vixproto.DATA_CHUNK)
+            if count:
+                self.pending = vixproto.replyheader(self.reqid, VE_000, vixproto.FLAG_MORE, count)
+                part.limit = part.offset + count
+            else:
+                self.pending = vixproto.replyframe(self.reqid, VE_000, vixproto.FLAG_FILE)
+                self.ended = True
+        if self.pending:
+            sent = channel.send(self.pending)
+            self.pending = self.pending[sent:]
+            return sent
+        return self.part.sendto(channel)
+
+    def close(self):
+        self.part.close()
+
+
+class SessionError(Exception):
+    '''
+    A command refused before reaching VIX, answered with its code
+    '''
+    def __init__(self, code, message = ""):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class GatewaySession(object):
+    '''
+    State of one client, the g_sessoninfo, g_conTicket and g_vmTicket of a
+    daemon child.  handle() runs in a worker thread, never two at once for
+    the same session.
+    '''
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.vix = Vix()
+        self.state = 0
+        self.vmxpath = ""
+        self.guestpath = ""
+        # snapshot handles given out by getnamess, for delssid
+        self.snapshots = set()
+        # shared with the views getnamess runs on
+        self.snapshotsLock = threading.Lock()
+
+    def handle(self, request):
+        '''
+        Run one request line and return the parts of its reply, strings
+        and FileParts
+        '''
+        index, args = parse_request(request)
+        if index < 0:
+            logging.debug("Unknown request: %s"%request)
+            return textreply(VE_000, "")
+        return textreply(*self.run(index, args))
+
+    def run(self, index, args):
+        '''
+        Run one command, returning (code, text, data) with data the string
+        or FilePart of an "F:" reply, None for other replies
+        '''
+        name, argnum, failcode = COMMANDS[index]
+        method = getattr(self, "do_" + name, None)
+        code, text, data = VE_000, "", None
+        try:
+            if method is not None:
+                result = method(*args[:argnum])
+                if isinstance(result, tuple):
+                    text, data = result
+                elif result is not None:
+                    text = result
+        except SessionError, e:
+            code = e.code
+        except Exception, e:
+            logging.error("%s failed: %s"%(name, e))
+            code = failcode
+        return code, text, data
+
+    def view(self):
+        '''
+        Copy of the session for a CONCURRENT command: it shares the handles
+        and the state, with a Vix of its own for the job and snapshot
+        handles of the command
+        '''
+        view = copy.copy(self)
+        view.vix = copy.copy(self.vix)
+        return view
+
+    def close(self):
+        '''
+        Give back what the session holds once its client is gone
+        '''
+        try:
+            self.do_disconn()
+        except Exception, e:
+            logging.error("Closing session failed: %s"%e)
+
+    def require(self, state):
+        if self.state & state != state:
+            raise SessionError(VE_004, "Not ready")
+
+    ##### commands, named after CMDNAME_LIST
+
+    def do_test(self):
+        pass
+
+    def do_connect(self, hostname, username, password):
+        # like the daemon, connect again even when already connected
+        self.do_disconn()
+        self.vix.Connect("http://%s/sdk"%hostname, 0, username, password)
+        self.state = CONNECTED_ESXI
+
+    def do_disconn(self):
+        if not self.state & CONNECTED_ESXI:
+            return
+        self._closevm()
+        for snapshotHandle in self.snapshots:
+            self.vix.vix.Vix_ReleaseHandle(snapshotHandle)
+        self.snapshots.clear()
+        self.state = 0
+        self.vix.Disconnect()
+
+    def do_listguests(self):
+        self.require(CONNECTED_ESXI)
+        return "", "".join(["%s;"%url for url in self.vix.find_vms()])
+
+    def do_open(self, vmxpath):
+        self.require(CONNECTED_ESXI)
+        if not (self.state & OPENED_VM and self.vmxpath == vmxpath):
+            self._closevm()
+            # the session holds a reference of its own until _closevm,
+            # the handle outlives its vmCache entry
+            self.vix.Open(vmxpath)
+            self.vmxpath = vmxpath
+            self.state |= OPENED_VM
+        try:
+            vmname, guestos = _getstrings(self.vix.vix, self.vix.vmHandle,
+                Vix.VIX_PROPERTY_VM_NAME, Vix.VIX_PROPERTY_VM_GUESTOS)
+        except VixException, e:
+            logging.error(e)
+            vmname, guestos = None, None
+        return "%s;%s"%(vmname or NULL, guestos or NULL)
+
+    def do_registvm(self, vmxpath):
+        self.require(CONNECTED_ESXI)
+        if not self.vix.registevm(vmxpath):
+            raise SessionError(VE_007)
+
+    def do_unregistvm(self, vmxpath):
+        self.require(CONNECTED_ESXI)
+        if not self.vix.unregistevm(vmxpath):
+            raise SessionError(VE_008)
+        if self.state & OPENED_VM and self.vmxpath == vmxpath:
+            self._closevm(logout = False)
+
+    def do_close(self):
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        self._closevm()
+
+    def do_deletevm(self):
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        self.vix.deletevm()
+        self._closevm(logout = False)
+
+    def do_poweron(self):
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        if vmpower(self.vix.power_state()) == POWERD_OFF:
+            self.vix.PowerOn()
+
+    def do_poweroff(self):
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        if vmpower(self.vix.power_state()) != POWERED_ON:
+            raise SessionError(VE_010)
+        self.vix.PowerOff()
+
+    def do_powerstate(self):
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        try:
+            powerstate = vmpower(self.vix.power_state())
+        except VixException, e:
+            raise SessionError(VE_010, "%d-%s"%(PWUNKNOWN, e))
+        if powerstate == PWUNKNOWN:
+            raise SessionError(VE_010, "%d-Unknown powerstate"%powerstate)
+        return "%d"%powerstate
+
+    def do_login(self, username, password):
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        if self.state & LOGINED_VM:
+            self.gateway.logout(self.vix, logout = False)
+            self.state &= ~LOGINED_VM
+        if not self.gateway.login(self.vix, username, password):
+            raise SessionError(VE_011)
+        self.state |= LOGINED_VM
+
+    def do_logout(self):
+        if self.state & LOGINED_VM != LOGINED_VM or self.state & OPENED_VM != OPENED_VM:
+            return
+        self.state &= ~LOGINED_VM
+        if not self.gateway.logout(self.vix):
+            raise SessionError(VE_012)
+
+    def do_put(self, localpath, guestpath):
+        self.require(CONNECTED_ESXI | OPENED_VM | LOGINED_VM)
+        if not self.vix.cphost2vm(localpath, guestpath):
+            raise SessionError(VE_013)
+
+    def do_get(self, guestpath, localpath):
+        self.require(CONNECTED_ESXI | OPENED_VM | LOGINED_VM)
+        if not self.vix.cpvm2host(guestpath, localpath):
+            raise SessionError(VE_013)
+
+    def do_hput(self, localpath, guestpath):
+        '''
+        put, checked by fetching the copy back and comparing MD5 digests
+        '''
+        self.require(CONNECTED_ESXI | OPENED_VM | LOGINED_VM)
+        fd, checkpath = tempfile.mkstemp(".hput", "gateway-")
+        os.close(fd)
+        try:
+            for i in range(HPUT_TRIES):
+                if not self.vix.cphost2vm(localpath, guestpath):
+                    continue
+                if not self.vix.cpvm2host(guestpath, checkpath):
+                    continue
+                if md5file(localpath) == md5file(checkpath):
+                    return
+                logging.error("hput %s: MD5 of the copy does not match"%guestpath)
+        finally:
+            if os.path.exists(checkpath):
+                os.remove(checkpath)
+        raise SessionError(VE_013)
+
+    def do_bat(self, script, block):
+        self._runscript(None, script, block)
+
+    def do_bash(self, script, block):
+        self._runscript("/bin/sh", script, block)
+
+    def do_cd(self, guestpath):
+        self.guestpath = guestpath
+
+    def do_dir(self):
+        self.require(CONNECTED_ESXI | OPENED_VM | LOGINED_VM)
+        return "", "".join(["%d;%d;%d;%s\n"%(entry.flags, entry.size, entry.modtime, entry.name)
+            for entry in self.vix.ListDirectoryInGuest(self.guestpath)])
+
+    def do_createss(self, name, description):
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        self.vix.CreateSnapshot(name, description)
+        self.vix.vix.Vix_ReleaseHandle(self.vix.snapshotHandle)
+        self.vix.snapshotHandle = Vix.VIX_INVALID_HANDLE
+
+    def do_ssrnum(self):
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        return "%d"%self.vix.GetNumRootSnapshots().value
+
+    def do_ssnum(self):
+        '''
+        Children of the first root snapshot, as GetVMSnapChildNumber counts
+        '''
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        tree = self.vix.GetSnapshotTree()
+        try:
+            if not tree.roots:
+                raise SessionError(VE_015, "No root snapshot")
+            return "%d"%len(tree.roots[0].children)
+        finally:
+            tree.release()
+
+    def do_gotoss(self, name):
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        self.vix.RevertToNamedSnapshot(name)
+
+    def do_rmss(self, name):
+        '''
+        Remove a snapshot, keeping its children; no such snapshot is no error
+        '''
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        try:
+            self.vix.RemoveNamedSnapshot(name)
+        except VixException, e:
+            if e.errorCode != Vix.VIX_E_SNAPSHOT_NOTFOUND:
+                raise
+
+    def do_sslist(self):
+        '''
+        "name<TAB>description<TAB>parent;" per snapshot, depth first
+        '''
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        tree = self.vix.GetSnapshotTree()
+        try:
+            return "", "".join(["%s\t%s\t%s;"%(node.name, node.description or NULL,
+                node.parent is not None and node.parent.name or "None") for node in tree])
+        finally:
+            tree.release()
+
+    def do_getnamess(self, name):
+        '''
+        "handle;name;description" of a snapshot, the handle is kept for delssid
+        '''
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        tree = self.vix.GetSnapshotTree()
+        try:
+            node = tree.find(name)
+            # the handle outlives the tree, one reference however often asked
+            self.snapshotsLock.acquire()
+            try:
+                if node.handle not in self.snapshots:
+                    self.vix.vix.Vix_AddRefHandle(node.handle)
+                    self.snapshots.add(node.handle)
+            finally:
+                self.snapshotsLock.release()
+            return "%d;%s;%s"%(node.handle, node.name, node.description or NULL)
+        finally:
+            tree.release()
+
+    def do_delssid(self, snapshotid):
+        self.require(CONNECTED_ESXI | OPENED_VM)
+        snapshotHandle = int(snapshotid)
+        # any other number could be a handle of another session
+        if snapshotHandle not in self.snapshots:
+            raise SessionError(VE_015, "Unknown snapshot id %s"%snapshotid)
+        self.vix.snapshotHandle = snapshotHandle
+        try:
+            self.vix.RemoveSnapshot()
+        finally:
+            self.vix.snapshotHandle = Vix.VIX_INVALID_HANDLE
+        self.snapshots.discard(snapshotHandle)
+        self.vix.vix.Vix_ReleaseHandle(snapshotHandle)
+
+    def do_fetch(self, guestpath):
+        self.require(CONNECTED_ESXI | OPENED_VM | LOGINED_VM)
+        return "", FilePart(self.vix.cpvm2temp(guestpath))
+
+    def do_proto(self, version):
+        '''
+        Protocol version the client gets, the channel switches its framing
+        '''
+        if version == str(vixproto.VERSION):
+            return version
+        return "1"
+
+    ##### helpers
+
+    def _runscript(self, interpreter, script, block):
+        '''
+        The script argument is the script text, usually the path of a
+        script in the guest which the interpreter runs
+        '''
+        self.require(CONNECTED_ESXI | OPENED_VM | LOGINED_VM)
+        if not self.vix.runscriptinvm(interpreter, script, block.strip() == "1"):
+            raise SessionError(VE_014)
+
+    def _closevm(self, logout = True):
+        '''
+        Drop the opened VM, logging out of the guest unless the VM is gone
+        '''
+        if not self.state & OPENED_VM:
+            return
+        if self.state & LOGINED_VM:
+            self.gateway.logout(self.vix, logout)
+        self.state &= ~(OPENED_VM | LOGINED_VM)
+        self.vix.CloseVM()
+        self.vmxpath = ""
+
+
+class GatewayChannel(asyncore.dispatcher):
+    '''
+    Socket of one client.  Requests are cut out of the input in the loop
+    thread and queued as (request id, COMMANDS index, arguments), the id
+    None for request lines; workers run them and hand the reply parts back
+    through outq.
+    '''
+    def __init__(self, gateway, sock):
+        asyncore.dispatcher.__init__(self, sock, gateway.map)
+        self.gateway = gateway
+        self.session = GatewaySession(gateway)
+        # taken again by close() when a send inside handle_write fails
+        self.lock = threading.RLock()
+        self.inbuf = ""
+        # vixproto.FrameReader once the client switched to frames
+        self.reader = None
+        # NULs left of the padded record that asked for frames
+        self.padding = 0
+        self.outq = deque()
+        self.requests = deque()
+        self.running = 0
+        self.exclusive = False
+        self.quitting = False
+        self.closing = False
+        self.finished = False
+        self.closed = False
+
+    def readable(self):
+        return not self.quitting
+
+    def writable(self):
+        return bool(self.outq) or self.finished
+
+    def handle_read(self):
+        data = self.recv(RECV_SIZE)
+        if not data:
+            return
+        if self.reader is not None:
+            self._readframes(data)
+            return
+        self.inbuf += data
+        while not self.quitting:
+            match = _SEPARATOR.search(self.inbuf, 0, MAXPACKLEN)
+            if match is not None:
+                request, self.inbuf = self.inbuf[:match.start()], self.inbuf[match.end():]
+            elif len(self.inbuf) >= MAXPACKLEN:
+                request, self.inbuf = self.inbuf[:MAXPACKLEN], self.inbuf[MAXPACKLEN:]
+            else:
+                break
+            request = request.strip("\r\0")
+            if not request:
+                continue
+            if request.startswith("quit"):
+                self.quitting = True
+                self._queue(None)
+                break
+            logging.debug("Incoming %s"%request)
+            index, args = parse_request(request)
+            self._queue((None, index, args))
+            if index >= 0 and COMMANDS[index][0] == "proto" and args[0] == str(vixproto.VERSION):
+                # the client waits for the answer before its first frame
+                self.reader = vixproto.FrameReader(vixproto.REQUEST)
+                if match is not None and match.group() == "\0":
+                    # vmmclient padded the request to a record, the rest
+                    # of it may still be on the way
+                    self.padding = MAXPACKLEN - match.end()
+                data, self.inbuf = self.inbuf, ""
+                self._readframes(data)
+                break
+
+    def _readframes(self, data):
+        if self.padding:
+            head = data[:self.padding]
+            skip = len(head) - len(head.lstrip("\0"))
+            self.padding = skip == len(head) and self.padding - skip or 0
+            data = data[skip:]
+        try:
+            for (reqid,), body in self.reader.feed(data):
+                if self.quitting:
+                    break
+                fields = vixproto.decodefields(body)
+                if fields[:1] == ["quit"]:
+                    self.quitting = True
+                    self._queue(None)
+                    break
+                index, args = parse_fields(fields)
+                self._queue((reqid, index, args))
+        except vixproto.ProtocolError, e:
+            logging.error("Gateway client %s: %s"%(self.addr, e))
+            self.handle_close()
+
+    def handle_write(self):
+        self.lock.acquire()
+        try:
+            while self.outq:
+                part = self.outq[0]
+                if isinstance(part, str):
+                    sent = self.send(part)
+                    if sent == len(part):
+                        self.outq.popleft()
+                    else:
+                        self.outq[0] = part[sent:]
+                else:
+                    sent = part.sendto(self)
+                    if part.done:
+                        part.close()
+                        self.outq.popleft()
+                    elif part.boundary and len(self.outq) > 1:
+                        # between two frames, let the other replies through
+                        self.outq.rotate(-1)
+                if not sent and self.outq:
+                    break
+            if not self.outq and self.finished:
+                self.close()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.lock.acquire()
+        try:
+            self.closed = True
+            for part in self.outq:
+                if not isinstance(part, str):
+                    part.close()
+            self.outq.clear()
+        finally:
+            self.lock.release()
+
+    def handle_close(self):
+        self.close()
+        # commands already read still run, then the session is closed
+        self._queue(None)
+
+    def handle_error(self):
+        logging.error("Gateway client %s: %s"%(self.addr, sys.exc_info()[1]))
+        self.handle_close()
+
+    def _queue(self, request):
+        '''
+        Queue a request, None closes the session after the queued ones
+        '''
+        self.lock.acquire()
+        try:
+            if self.closing:
+                return
+            self.closing = request is None
+            self.requests.append(request)
+            started = self._dispatch()
+        finally:
+            self.lock.release()
+        for request in started:
+            self.gateway.workers.put(functools.partial(self._work, request))
+
+    def _concurrent(self, request):
+        if request is None or request[0] is None:
+            return False
+        return request[1] < 0 or COMMANDS[request[1]][0] in CONCURRENT
+
+    def _dispatch(self):
+        '''
+        Take the requests that may start now off the queue, with the lock
+        held: CONCURRENT commands of framed requests start beside each
+        other, any other request waits for the running ones and runs alone
+        '''
+        started = []
+        while self.requests and not self.exclusive and self.running < CLIENT_INFLIGHT:
+            request = self.requests[0]
+            if not self._concurrent(request):
+                if self.running:
+                    break
+                self.exclusive = True
+            self.requests.popleft()
+            self.running += 1
+            started.append(request)
+        return started
+
+    def _work(self, request):
+        '''
+        Run a request, in a worker thread
+        '''
+        if request is None:
+            self.session.close()
+            reply = []
+        else:
+            reply = self._run(*request)
+        self.lock.acquire()
+        try:
+            for part in reply:
+                if self.closed and not isinstance(part, str):
+                    part.close()
+                elif part and not self.closed:
+                    self.outq.append(part)
+            self.running -= 1
+            self.exclusive = False
+            if request is None:
+                self.finished = True
+            # back into the queue behind the other clients' commands
+            started = self._dispatch()
+        finally:
+            self.lock.release()
+        for request in started:
+            self.gateway.workers.put(functools.partial(self._work, request))
+        self.gateway.wake()
+
+    def _run(self, reqid, index, args):
+        if index < 0:
+            code, text, data = VE_000, "", None
+        elif self._concurrent((reqid, index, args)):
+            code, text, data = self.session.view().run(index, args)
+        else:
+            code, text, data = self.session.run(index, args)
+        if reqid is None:
+            return textreply(code, text, data)
+        return framedreply(reqid, code, text, data)
+
+
+class Gateway(asyncore.dispatcher):
+    '''
+    Listening socket of the gateway with the loop, the workers and the
+    guest logins shared by its sessions
+    '''
+    def __init__(self, address, workers = WORKERS):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map = self.map)
+        self.waker = _Waker(self.map)
+        # sessions share host and VM handles
+        if Vix.hostPool is None:
+            Vix.hostPool = pyvix.HostPool()
+        if Vix.vmCache is None:
+            Vix.vmCache = pyvix.VMHandleCache()
+        # and guest logins outlive the sessions that made them
+        if Vix.guestSessions is None:
+            Vix.guestSessions = pyvix.GuestSessionCache()
+        self.workers = Queue.Queue()
+        for i in range(workers):
+            thread = threading.Thread(target = self._worker, name = "gateway-worker-%d"%i)
+            thread.setDaemon(True)
+            thread.start()
+        self.loginLock = threading.Lock()
+        # VM handle: [(username, password), sessions logged in, sessions logging in]
+        self.logins = {}
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(socket.SOMAXCONN)
+        self.address = self.socket.getsockname()
+
+    def serve_forever(self):
+        logging.info("Gateway listening at %s:%d"%self.address)
+        while self.map:
+            asyncore.loop(30, True, self.map, 1)
+
+    def shutdown(self):
+        self.close()
+        self.wake()
+
+    def wake(self):
+        self.waker.wake()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, addr = pair
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        GatewayChannel(self, sock)
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        for channel in self.map.values():
+            if isinstance(channel, GatewayChannel):
+                channel.handle_close()
+        self.waker.close()
+
+    ##### guest logins shared on a VM handle, called from the workers
+
+    def login(self, vix, username, password):
+        '''
+        Share the guest login of the handle with the session.  A handle
+        holds one login, so while sessions of one user are logged in, or
+        logging in, a login under other credentials is refused.
+        '''
+        credentials = (username, password)
+        self.loginLock.acquire()
+        try:
+            entry = self.logins.get(vix.vmHandle)
+            if entry is not None and entry[0] != credentials:
+                logging.error("Guest of %s is in use by %s"%(vix.vmfolder, entry[0][0]))
+                return False
+            if entry is not None and entry[1]:
+                entry[1] += 1
+                return True
+            if entry is None:
+                entry = self.logins[vix.vmHandle] = [credentials, 0, 0]
+            entry[2] += 1
+        finally:
+            self.loginLock.release()
+        vix.vmuser = username
+        vix.vmpassword = password
+        ok = vix.loginvm()
+        self.loginLock.acquire()
+        try:
+            entry[2] -= 1
+            if ok:
+                entry[1] += 1
+            elif not entry[1] and not entry[2]:
+                del self.logins[vix.vmHandle]
+        finally:
+            self.loginLock.release()
+        return ok
+
+    def logout(self, vix, logout = True):
+        '''
+        Drop one login on the handle, the last one logs out of the guest
+        '''
+        self.loginLock.acquire()
+        try:
+            entry = self.logins.get(vix.vmHandle)
+            if entry is None:
+                return True
+            entry[1] -= 1
+            if entry[1] > 0:
+                return True
+            if entry[2]:
+                # a session of the same user is logging in again
+                return True
+            del self.logins[vix.vmHandle]
+        finally:
+            self.loginLock.release()
+        if not logout:
+            return True
+        return vix.logoutvm()
+
+    def _worker(self):
+        while True:
+            task = self.workers.get()
+            try:
+                task()
+            except Exception, e:
+                logging.error("Gateway worker: %s"%e)
+
+
+def main(argv = None):
+    argv = argv or sys.argv
+    if len(argv) < 3:
+        print >>sys.stderr, "Usage: gateway.py <127.0.0.1> <4564> [workers]"
+        return 1
+    logging.basicConfig(level = logging.INFO)
+    workers = WORKERS
+    if len(argv) > 3:
+        workers = int(argv[3])
+    Gateway((argv[1], int(argv[2])), workers).serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,7 +12,20 @@
 
 import sys
 import os
+import mmap
+import errno
 import string
+import threading
+import time
+import random
+import heapq
+import tempfile
+import Queue
+import itertools
+import json
+import ntpath
+import posixpath
+from collections import OrderedDict
 from ctypes import *
 
 import logging
@@ -24,6 +37,19 @@ if osname == "nt":
     DYLIBPATH = "C:\\Program Files (x86)\\VMware\\VMware VIX\\Workstation-8.0.0-and-vSphere-5.0.0\\32bit"
     DYLIBFILENAME = "vix.dll"
 
+# Scratch directory of POSIX guests, used for spooled command output
+GUEST_TMP = "/tmp"
+# Bytes handed out at once when a guest file is streamed
+STREAM_CHUNK = 1024 * 1024
+
+_spoolids = itertools.count(1)
+
+# VixEventProc(handle, eventType, moreEventInfo, clientData) of vix.h
+VixEventProc = CFUNCTYPE(None, c_int, c_int, c_int, c_void_p)
+# Event callbacks handed to libvix by id, kept alive until their job
+# completed
+_eventprocs = {}
+
 
 class Vix(object):
     '''
@@ -31,6 +57,8 @@ class Vix(object):
     '''
     # After power on vm, wait for vm tools for 5 minutes
     TOOLS_TIMEOUT = 300
+    # Seconds between two fetches of the output of a tailed guest command
+    TAIL_INTERVAL = 1
     # Following const variables are referring to the source code from vix.h in VIX API
     
     VIX_INVALID_HANDLE   = 0
@@ -275,6 +303,8 @@ class Vix(object):
     VIX_PROPERTY_VM_VMTEAM_PATHNAME                    = 105 
     VIX_PROPERTY_VM_MEMORY_SIZE                        = 106
     VIX_PROPERTY_VM_READ_ONLY                          = 107
+    VIX_PROPERTY_VM_NAME                               = 108
+    VIX_PROPERTY_VM_GUESTOS                            = 109
     VIX_PROPERTY_VM_IN_VMTEAM                          = 128
     VIX_PROPERTY_VM_POWER_STATE                        = 129
     VIX_PROPERTY_VM_TOOLS_STATE                        = 152
@@ -461,6 +491,35 @@ class Vix(object):
     VIX_CLONETYPE_FULL       = 0
     VIX_CLONETYPE_LINKED     = 1
     
+    # Process-wide HostPool that Connect borrows host handles from,
+    # None means every Connect does its own VixHost_Connect
+    hostPool = None
+    # Process-wide VMHandleCache that Open looks VM handles up in,
+    # None means every Open does its own VixVM_Open
+    vmCache = None
+    # Process-wide GuestDirCache that guest listings and existence checks
+    # are answered from, None means every check is its own guest job
+    dirCache = None
+    # Process-wide SnapshotTreeCache keeping the snapshot tree of each VM
+    # handle, None means the tree is read again for every lookup
+    snapshotCache = None
+    # Process-wide JobMetrics timing every job run through _runjob,
+    # None means nothing is recorded
+    metrics = None
+    # Process-wide InventoryCache keeping the VMs of each host between
+    # refreshes, None means inventory() lists the host every time
+    inventoryCache = None
+    # Process-wide JobPolicy giving jobs deadlines, retries and per-host
+    # circuit breakers, None means every job is waited for once, unbounded
+    jobPolicy = None
+    # Process-wide scheduler.JobScheduler that jobs wait for their turn in,
+    # None means they start at once; tenant is whose jobs these are
+    jobScheduler = None
+    tenant = None
+    # Process-wide GuestSessionCache keeping guest logins of VM handles
+    # between calls, None means logoutvm logs out and loginvm logs in
+    guestSessions = None
+
     #####################################################
 
     def __init__(self):
@@ -474,27 +533,43 @@ class Vix(object):
         self.vmuser = "null"
         self.vmpassword = "null"
         self.isConnected = False
-        dylibfilepath = os.path.join(DYLIBPATH, DYLIBFILENAME)
-        print dylibfilepath
-        self.vix = vix = cdll.LoadLibrary(dylibfilepath)
-        self.VixHost_Connect = self.vix.VixHost_Connect
-        self.VixHost_Connect.argtypes = [c_int, c_int, c_char_p, c_int, c_char_p, c_char_p, c_int, c_int, c_void_p, c_void_p ]
-        self.VixJob_Wait = self.vix.VixJob_Wait
-        self.VixJob_Wait.argtypes = [c_int, c_int, c_void_p, c_int]
-        self.VixJob_Wait2 = self.vix.VixJob_Wait
-        self.VixJob_Wait2.argtypes = [c_int, c_int]
-        self.Vix_GetVMPowerState = self.vix.Vix_GetProperties
-        self.Vix_GetVMPowerState.argtypes = [c_int, c_int, c_void_p, c_int]
-        #self.VixVM_GetNamedSnapshot = self.vix.VixVM_GetNamedSnapshot
-        #self.VixVM_GetNamedSnapshot = [c_int, c_char_p, c_void_p]
-        self.VixVM_GetRootSnapshot = self.vix.VixVM_GetRootSnapshot
-        self.VixVM_GetRootSnapshot.argtypes = [c_int, c_int, c_void_p]
+        self.jobHandle = Vix.VIX_INVALID_HANDLE
+        self.vmHandle = Vix.VIX_INVALID_HANDLE
+        # the handle Open gave this Vix a reference on, released by CloseVM
+        self.openedHandle = Vix.VIX_INVALID_HANDLE
+        self.hostHandle = Vix.VIX_INVALID_HANDLE
+        # shared binding table, libvix is loaded once per process
+        self.vix = getvixlib()
+
+    def __copy__(self):
+        '''
+        Copies use the handles of the original, which stays their owner
+        '''
+        vix = self.__class__.__new__(self.__class__)
+        vix.__dict__.update(self.__dict__)
+        vix.openedHandle = Vix.VIX_INVALID_HANDLE
+        return vix
 
     def Connect(self, hostname = None, hostport = 0, username = None, password = None):
         self.jobHandle = Vix.VIX_INVALID_HANDLE
         self.vmHandle = Vix.VIX_INVALID_HANDLE
         self.hostHandle = Vix.VIX_INVALID_HANDLE
-        self.jobHandle = self.VixHost_Connect(Vix.VIX_API_VERSION,
+        self.url = hostname
+        self.hostport = hostport
+        self.username = username
+        self.password = password
+        if self.hostPool is not None:
+            self.hostHandle = self.hostPool.acquire(self, hostname, hostport, username, password)
+        else:
+            self.hostHandle = self.HostConnect(hostname, hostport, username, password)
+        self.isConnected = True
+
+    def HostConnect(self, hostname, hostport, username, password):
+        '''
+        Do the VixHost_Connect round trip and return the new host handle
+        '''
+        hostHandle = c_int()        
+        err = self._startjob("VixHost_Connect", lambda: self.vix.VixHost_Connect(Vix.VIX_API_VERSION,
             Vix.VIX_SERVICEPROVIDER_VMWARE_VI_SERVER,
             hostname,
             hostport,
@@ -503,14 +578,24 @@ class Vix(object):
             0,
             Vix.VIX_INVALID_HANDLE,
             None,
-            None);
-        hostHandle = c_int()        
-        err = self.VixJob_Wait(self.jobHandle, Vix.VIX_PROPERTY_JOB_RESULT_HANDLE,
-            byref(hostHandle), Vix.VIX_PROPERTY_NONE)
-        self.hostHandle = hostHandle.value
-        self.vix.Vix_ReleaseHandle(self.jobHandle)
+            None), Vix.VIX_PROPERTY_JOB_RESULT_HANDLE, byref(hostHandle),
+            vmHandle = Vix.VIX_INVALID_HANDLE, retry = False, vmpath = "")
         if err != Vix.VIX_OK:
-            raise Exception("VixHost_Connect Failed")
+            raise VixException("VixHost_Connect Failed", err)
+        return hostHandle.value
+
+    def Reconnect(self):
+        '''
+        Replace a host handle whose connection was lost
+        '''
+        if self.hostPool is not None:
+            self.hostPool.release(self, self.hostHandle, broken = True)
+            self.hostHandle = self.hostPool.acquire(self, self.url, self.hostport, self.username, self.password)
+        else:
+            if self.vmCache is not None:
+                self.vmCache.invalidatehost(self.hostHandle)
+            self.vix.VixHost_Disconnect(self.hostHandle)
+            self.hostHandle = self.HostConnect(self.url, self.hostport, self.username, self.password)
     
     def connecthost(self, url, username, userpassword):
         try:
@@ -527,17 +612,53 @@ class Vix(object):
             logging.error(e)
     
     def Open(self, vmxFile):
-        self.jobHandle = self.vix.VixVM_Open(self.hostHandle, vmxFile, None, None)
-        
+        '''
+        Open the VM as vmHandle, which this Vix holds a reference on until
+        CloseVM or the next Open
+        '''
+        self.CloseVM()
+        self.vmfolder = vmxFile
+        if self.vmCache is not None:
+            vmHandle = self.vmCache.get(self.hostHandle, vmxFile)
+            if vmHandle is not None:
+                self.vmHandle = self.openedHandle = vmHandle
+                return
         vmHandle = c_int()
-        err = self.VixJob_Wait(self.jobHandle, Vix.VIX_PROPERTY_JOB_RESULT_HANDLE,
-            byref(vmHandle), Vix.VIX_PROPERTY_NONE)
-        self.vix.Vix_ReleaseHandle(self.jobHandle);
+        err = self._startjob("VixVM_Open", lambda: self.vix.VixVM_Open(self.hostHandle, vmxFile, None, None),
+            Vix.VIX_PROPERTY_JOB_RESULT_HANDLE, byref(vmHandle), vmHandle = Vix.VIX_INVALID_HANDLE)
+        if err in HostPool.CONNECTION_ERRORS:
+            # the host dropped us, open once more on a fresh connection
+            self.Reconnect()
+            err = self._startjob("VixVM_Open", lambda: self.vix.VixVM_Open(self.hostHandle, vmxFile, None, None),
+                Vix.VIX_PROPERTY_JOB_RESULT_HANDLE, byref(vmHandle), vmHandle = Vix.VIX_INVALID_HANDLE,
+                retry = False)
         
         self.vmHandle = vmHandle.value
         
         if err != Vix.VIX_OK:
-            raise Exception("VixVM_Open Failed")
+            raise VixException("VixVM_Open Failed", err)
+        self.openedHandle = self.vmHandle
+        Vix.forgetvmhandle(self.vmHandle)
+        if self.vmCache is not None:
+            self.vmCache.put(self.hostHandle, vmxFile, self.vmHandle)
+    
+    def CloseVM(self):
+        '''
+        Release the reference Open took on the VM handle
+        '''
+        if self.openedHandle != Vix.VIX_INVALID_HANDLE:
+            self.vix.Vix_ReleaseHandle(self.openedHandle)
+            if self.vmHandle == self.openedHandle:
+                self.vmHandle = Vix.VIX_INVALID_HANDLE
+            self.openedHandle = Vix.VIX_INVALID_HANDLE
+
+    def closevm(self):
+        try:
+            self.CloseVM()
+            return True
+        except Exception, e:
+            logging.error(e)
+        return False
     
     def locatevm(self, vmfolder, vmuser = None, vmpassword = None):
         try:
@@ -552,26 +673,107 @@ class Vix(object):
     
     def registevm(self, vmxpath):
         try:
-            self.jobHandle = self.vix.VixHost_RegisterVM(self.hostHandle, vmxpath, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle)
+            err = self._startjob("VixHost_RegisterVM", lambda: self.vix.VixHost_RegisterVM(self.hostHandle,
+                vmxpath, None, None), vmHandle = Vix.VIX_INVALID_HANDLE, retry = False, vmpath = vmxpath)
             
             if err != Vix.VIX_OK:
-                logging.error("Vix_VM_Register Failed")
+                logging.error("Vix_VM_Register Failed (VixError %d)"%err)
                 return False
             return True            
         except Exception, e:
             logging.error(e)
         return False
     
+    def find_vms(self, running_only = False, timeout = -1):
+        '''
+        Generator of the vmx paths of the registered VMs, or only of the
+        running ones, yielded as VixHost_FindItems reports them through its
+        callback instead of once the whole search is over.  The search is
+        admitted like any other job and abandoned with DEADLINE_EXCEEDED
+        after timeout seconds, -1 for none, or at the deadline jobPolicy
+        gives it, whichever comes first.
+        '''
+        searchtype = Vix.VIX_FIND_REGISTERED_VMS
+        if running_only:
+            searchtype = Vix.VIX_FIND_RUNNING_VMS
+        found = Queue.Queue()
+        vix = self.vix
+
+        def onevent(jobHandle, eventType, moreEventInfo, clientData):
+            if eventType == Vix.VIX_EVENTTYPE_FIND_ITEM:
+                try:
+                    found.put(_getstrings(vix, moreEventInfo, Vix.VIX_PROPERTY_FOUND_ITEM_LOCATION)[0])
+                except VixException, e:
+                    logging.error(e)
+            elif eventType == Vix.VIX_EVENTTYPE_JOB_COMPLETED:
+                _eventprocs.pop(id(callback), None)
+                found.put(None)
+
+        # the library calls back until the job completed, even if the
+        # generator is dropped before
+        callback = VixEventProc(onevent)
+        if not self._admit(Vix.VIX_INVALID_HANDLE):
+            raise VixException("VixHost_FindItems Failed", JobPolicy.BREAKER_OPEN)
+        started = time.time()
+        until = None
+        if timeout >= 0:
+            until = started + timeout
+        policy = self.jobPolicy
+        if policy is not None:
+            deadline = policy.until("VixHost_FindItems", started)
+            if until is None or (deadline is not None and deadline < until):
+                until = deadline
+        _eventprocs[id(callback)] = callback
+        err = Vix.VIX_E_FAIL
+        jobHandle = vix.VixHost_FindItems(self.hostHandle, searchtype,
+            Vix.VIX_INVALID_HANDLE, timeout, callback, None)
+        try:
+            while True:
+                if until is None:
+                    vmxpath = found.get()
+                else:
+                    try:
+                        vmxpath = found.get(True, max(0.0, until - time.time()))
+                    except Queue.Empty:
+                        # the callback stays registered until the job completes
+                        err = JobPolicy.DEADLINE_EXCEEDED
+                        break
+                if vmxpath is None:
+                    err = vix.VixJob_GetError(jobHandle)
+                    break
+                yield vmxpath
+        finally:
+            self.recordjob("VixHost_FindItems", started, err, "")
+            if policy is not None:
+                policy.record(self.url, err)
+            vix.Vix_ReleaseHandle(jobHandle)
+        if err == JobPolicy.DEADLINE_EXCEEDED:
+            raise VixException("VixHost_FindItems abandoned after %.1fs"%(until - started), err)
+        if err != Vix.VIX_OK:
+            raise VixException("VixHost_FindItems Failed", err)
+
+    def inventory(self):
+        '''
+        Map the vmx path of every registered VM of the host to whether it
+        runs, from inventoryCache while its inventory is fresh
+        '''
+        if self.inventoryCache is not None:
+            return self.inventoryCache.vms(self)
+        running = set(self.find_vms(True))
+        vms = dict((vmxpath, vmxpath in running) for vmxpath in self.find_vms())
+        for vmxpath in running:
+            vms[vmxpath] = True
+        return vms
+
     def unregistevm(self, vmxpath):
         try:
-            self.jobHandle = self.vix.VixHost_UnregisterVM(self.hostHandle, vmxpath, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle)
+            err = self._startjob("VixHost_UnregisterVM", lambda: self.vix.VixHost_UnregisterVM(self.hostHandle,
+                vmxpath, None, None), vmHandle = Vix.VIX_INVALID_HANDLE, retry = False, vmpath = vmxpath)
+            if self.vmCache is not None:
+                self.vmCache.invalidate(self.hostHandle, vmxpath)
             
             if err != Vix.VIX_OK:
-                logging.error("Vix_VM_Register Failed")
+                logging.error("Vix_VM_Unregister Failed (VixError %d)"%err)
                 return False
             return True            
         except Exception, e:
@@ -595,158 +797,349 @@ class Vix(object):
         return False
 
     def PowerOn(self):
-        self.jobHandle = self.vix.VixVM_PowerOn(self.vmHandle, Vix.VIX_VMPOWEROP_NORMAL,
-            Vix.VIX_INVALID_HANDLE, None, None);
-        err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-        self.vix.Vix_ReleaseHandle(self.jobHandle);
+        err = self._startjob("VixVM_PowerOn", lambda: self.vix.VixVM_PowerOn(self.vmHandle,
+            Vix.VIX_VMPOWEROP_NORMAL, Vix.VIX_INVALID_HANDLE, None, None))
         
         if err != Vix.VIX_OK:
-            raise Exception("VixVM_PowerOn Failed")
+            raise VixException("VixVM_PowerOn Failed", err)
         
     def PowerOff(self):
-        self.jobHandle = self.vix.VixVM_PowerOff(self.vmHandle, Vix.VIX_VMPOWEROP_NORMAL,
-            None, None);
-        err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-        self.vix.Vix_ReleaseHandle(self.jobHandle);
+        err = self._startjob("VixVM_PowerOff", lambda: self.vix.VixVM_PowerOff(self.vmHandle,
+            Vix.VIX_VMPOWEROP_NORMAL, None, None))
+        if self.guestSessions is not None:
+            self.guestSessions.invalidate(self.vmHandle)
         
         if err != Vix.VIX_OK:
-            raise Exception("VixVM_PowerOff Failed")
+            raise VixException("VixVM_PowerOff Failed", err)
     
     def getvmpowerstate(self, vmxFile):
+        '''
+        Open the vm and return its VIX_POWERSTATE_* bitmask, None on failure
+        '''
         try:
-            self.jobHandle = self.vix.VixVM_Open(self.hostHandle, vmxFile, None, None)
-            vmHandle = c_int()
-            err = self.VixJob_Wait(self.jobHandle, Vix.VIX_PROPERTY_JOB_RESULT_HANDLE, byref(vmHandle), Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
-        
-            self.vmHandle = vmHandle.value
-        
-            if err != Vix.VIX_OK:
-                raise Exception("VixVM_Open Failed")
-            vmpowerstate = c_void_p(10)
-            vmpowerstate_pointer = c_char_p("None")
-            err = self.jobHandle = self.Vix_GetVMPowerState(self.vmHandle, Vix.VIX_PROPERTY_VM_POWER_STATE, vmpowerstate_pointer, Vix.VIX_PROPERTY_NONE)
-            
-            print "length %d"%len(vmpowerstate_pointer.value)
-            print "|"
-            #print int(vmpowerstate_pointer.value)
-            for i in range(len(vmpowerstate_pointer.value)):
-                print ord(vmpowerstate_pointer.value[i])
-            print "|"
-            '''
-            for i in range(len(vmpowerstate_pointer.value)):
-                print "%d, %x"%(i, hex(vmpowerstate_pointer.value[i]))
-            '''
-            print "3"
-            #print "#### %d"%vmpowerstate
-            if err == Vix.VIX_OK:
-                return vmpowerstate
+            self.Open(vmxFile)
+            return self.power_state()
         except Exception, e:
-            print e
+            logging.error(e)
         return None
-            
+
+    def power_state(self, vmHandle = None):
+        '''
+        Read the VIX_POWERSTATE_* bitmask of an opened vm, no job involved
+        '''
+        if vmHandle is None:
+            vmHandle = self.vmHandle
+        powerstate = c_int()
+        err = self.vix.Vix_GetProperties(vmHandle, Vix.VIX_PROPERTY_VM_POWER_STATE,
+            byref(powerstate), Vix.VIX_PROPERTY_NONE)
+        if err != Vix.VIX_OK:
+            raise VixException("Vix_GetProperties Failed", err)
+        return powerstate.value
+
+    def power_states(self, vmxFiles):
+        '''
+        Map every vmx path to its power state bitmask, None where it failed.
+        Cached handles are read directly, the others are opened concurrently,
+        each open admitted by jobPolicy and jobScheduler like any other job;
+        the references taken on either are released at the end.
+        '''
+        handles = {}
+        jobs = []
+        for vmxFile in vmxFiles:
+            if vmxFile in handles:
+                continue
+            handles[vmxFile] = None
+            if self.vmCache is not None:
+                handles[vmxFile] = self.vmCache.get(self.hostHandle, vmxFile)
+            if handles[vmxFile] is None:
+                if not self._admit(Vix.VIX_INVALID_HANDLE):
+                    logging.error("VixVM_Open %s Failed (VixError %d)"%(vmxFile, JobPolicy.BREAKER_OPEN))
+                    continue
+                jobs.append((vmxFile, self.vix.VixVM_Open(self.hostHandle, vmxFile, None, None)))
+        # every open is in flight already, waiting on them in turn costs one round trip
+        for vmxFile, jobHandle in jobs:
+            vmHandle = c_int()
+            err = self._runjob("VixVM_Open", jobHandle, Vix.VIX_PROPERTY_JOB_RESULT_HANDLE,
+                byref(vmHandle), vmpath = vmxFile)
+            if err != Vix.VIX_OK:
+                logging.error("VixVM_Open %s Failed (VixError %d)"%(vmxFile, err))
+                continue
+            handles[vmxFile] = vmHandle.value
+            Vix.forgetvmhandle(vmHandle.value)
+            if self.vmCache is not None:
+                self.vmCache.put(self.hostHandle, vmxFile, vmHandle.value)
+        states = {}
+        for vmxFile in vmxFiles:
+            states[vmxFile] = None
+            if handles.get(vmxFile) is not None:
+                try:
+                    states[vmxFile] = self.power_state(handles[vmxFile])
+                except VixException, e:
+                    logging.error(e)
+        for vmHandle in handles.values():
+            if vmHandle is not None:
+                self.vix.Vix_ReleaseHandle(vmHandle)
+        return states
+
     
     def GetVMHandle(self):
         return self.vmHandle
 
     def CreateSnapshot(self, name, description = None):
-        self.jobHandle = self.vix.VixVM_CreateSnapshot(self.vmHandle, name,
-            description, 0, Vix.VIX_INVALID_HANDLE, None, None)
-        print "test 1 ", self.vmHandle
-        vmHandle = c_int()
-        #err = self.VixJob_Wait(self.snapshotHandle, Vix.VIX_PROPERTY_JOB_RESULT_HANDLE, byref(vmHandle), Vix.VIX_PROPERTY_NONE)
-        err = self.VixJob_Wait(self.jobHandle, Vix.VIX_PROPERTY_JOB_RESULT_HANDLE, byref(vmHandle), Vix.VIX_PROPERTY_NONE)
-        self.vix.Vix_ReleaseHandle(self.jobHandle);
-        self.vmHandle = vmHandle.value
-        print "test 2 ", vmHandle.value
+        snapshotHandle = c_int()
+        err = self._startjob("VixVM_CreateSnapshot", lambda: self.vix.VixVM_CreateSnapshot(self.vmHandle, name,
+            description, 0, Vix.VIX_INVALID_HANDLE, None, None), Vix.VIX_PROPERTY_JOB_RESULT_HANDLE,
+            byref(snapshotHandle), retry = False)
+        self.snapshotchanged()
         
         if err != Vix.VIX_OK:
-            raise Exception("VixVM_CreateSnapshot Failed")
+            raise VixException("VixVM_CreateSnapshot Failed", err)
+        self.snapshotHandle = snapshotHandle.value
     
     def RevertToNamedSnapshot(self, name):
-        self.GetNamedSnapshot(name)
-        self.RevertToSnapshot()
+        '''
+        name is a snapshot name or a "parent/child" path, looked up in the
+        snapshot tree instead of one VixVM_GetNamedSnapshot walk per call
+        '''
+        tree = self.GetSnapshotTree()
+        try:
+            self.snapshotHandle = tree.find(name).handle
+            self.RevertToSnapshot()
+        finally:
+            # the handle belongs to the tree, which is gone after the revert
+            self.snapshotHandle = Vix.VIX_INVALID_HANDLE
+            tree.release()
     
     def RevertToSnapshot(self):
         # get snapshot handle
         
-        self.jobHandle = self.vix.VixVM_RevertToSnapshot(self.vmHandle,
-            self.snapshotHandle, 0, Vix.VIX_INVALID_HANDLE, None, None)
-        err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-        self.vix.Vix_ReleaseHandle(self.jobHandle);
+        err = self._startjob("VixVM_RevertToSnapshot", lambda: self.vix.VixVM_RevertToSnapshot(self.vmHandle,
+            self.snapshotHandle, 0, Vix.VIX_INVALID_HANDLE, None, None))
+        # the current snapshot moved, the guest went back with it
+        self.snapshotchanged()
+        if self.guestSessions is not None:
+            self.guestSessions.invalidate(self.vmHandle)
         
         if err != Vix.VIX_OK:
-            raise Exception("VixVM_RevertToSnapshot Failed")
+            raise VixException("VixVM_RevertToSnapshot Failed", err)
+
+    def RemoveSnapshot(self, removechildren = False):
+        options = 0
+        if removechildren:
+            options = Vix.VIX_SNAPSHOT_REMOVE_CHILDREN
+        err = self._startjob("VixVM_RemoveSnapshot", lambda: self.vix.VixVM_RemoveSnapshot(self.vmHandle,
+            self.snapshotHandle, options, None, None), retry = False)
+        self.snapshotchanged()
+
+        if err != Vix.VIX_OK:
+            raise VixException("VixVM_RemoveSnapshot Failed", err)
+
+    def RemoveNamedSnapshot(self, name, removechildren = False):
+        tree = self.GetSnapshotTree()
+        try:
+            options = 0
+            if removechildren:
+                options = Vix.VIX_SNAPSHOT_REMOVE_CHILDREN
+            snapshotHandle = tree.find(name).handle
+            err = self._startjob("VixVM_RemoveSnapshot", lambda: self.vix.VixVM_RemoveSnapshot(self.vmHandle,
+                snapshotHandle, options, None, None), retry = False)
+        finally:
+            tree.release()
+        self.snapshotchanged()
+        if err != Vix.VIX_OK:
+            raise VixException("VixVM_RemoveSnapshot Failed", err)
+
+    def GetSnapshotTree(self, vmHandle = None):
+        '''
+        SnapshotTree of the VM, which the caller releases; the tree may be
+        shared through snapshotCache
+        '''
+        if vmHandle is None:
+            vmHandle = self.vmHandle
+        if self.snapshotCache is None:
+            return SnapshotTree(vmHandle)
+        tree = self.snapshotCache.get(vmHandle)
+        if tree is None:
+            tree = SnapshotTree(vmHandle)
+            self.snapshotCache.put(vmHandle, tree)
+        return tree
+
+    def snapshotchanged(self, vmHandle = None):
+        if self.snapshotCache is not None:
+            if vmHandle is None:
+                vmHandle = self.vmHandle
+            self.snapshotCache.invalidate(vmHandle)
+
+    @classmethod
+    def forgetvmhandle(cls, vmHandle):
+        '''
+        Drop whatever the guest and snapshot caches hold for a VM handle
+        that was released or has just been handed out
+        '''
+        if cls.dirCache is not None:
+            cls.dirCache.invalidatehandle(vmHandle)
+        if cls.snapshotCache is not None:
+            cls.snapshotCache.invalidate(vmHandle)
+        if cls.guestSessions is not None:
+            cls.guestSessions.invalidate(vmHandle)
     
     def GetRootSnapshot(self, index = 0):
         snapshotHandle = c_int()
-        err = self.VixVM_GetRootSnapshot(self.vmHandle, index, byref(snapshotHandle))
+        err = self.vix.VixVM_GetRootSnapshot(self.vmHandle, index, byref(snapshotHandle))
         self.snapshotHandle = snapshotHandle.value
         if err != Vix.VIX_OK:
             raise Exception("VixVM_GetRootSnapshot Failed")
         
     def GetNamedSnapshot(self, name):
         snapshotHandle = c_int()
-        err = self.VixVM_GetNamedSnapshot(self.vmHandle, name, byref(snapshotHandle))
-        if err != VIX_OK:
+        err = self.vix.VixVM_GetNamedSnapshot(self.vmHandle, name, byref(snapshotHandle))
+        if err != Vix.VIX_OK:
             raise Exception("VixVM_GetNamedSnapshot Failed")
         self.snapshotHandle = snapshotHandle.value
     
     def GetCurrentSnapshot(self):
         snapshotHandle = c_int()
-        err = self.VixVM_GetCurrentSnapshot(self.vmHandle, byref(snapshotHandle))
-        if err != VIX_OK:
+        err = self.vix.VixVM_GetCurrentSnapshot(self.vmHandle, byref(snapshotHandle))
+        if err != Vix.VIX_OK:
             raise Exception("VixVM_GetCurrentSnapshot Failed")
         self.snapshotHandle = snapshotHandle.value
 
     def GetNumRootSnapshots(self):
         ss_num = c_int()
-        err = self.VixVM_GetNumRootSnapshots(self.vmHandle, byref(ss_num))
-        if err != VIX_OK:
+        err = self.vix.VixVM_GetNumRootSnapshots(self.vmHandle, byref(ss_num))
+        if err != Vix.VIX_OK:
             raise Exception("VixVM_GetNumRootSnapshots Failed")
         return ss_num
 
     def Disconnect(self):
-        self.vix.VixHost_Disconnect(self.hostHandle)
+        self.CloseVM()
+        if self.hostPool is not None:
+            self.hostPool.release(self, self.hostHandle)
+        else:
+            if self.vmCache is not None:
+                self.vmCache.invalidatehost(self.hostHandle)
+            self.vix.VixHost_Disconnect(self.hostHandle)
+        self.hostHandle = Vix.VIX_INVALID_HANDLE
+        self.isConnected = False
     
+    def Clone(self, destvmx, snapshotHandle = None, linked = True):
+        '''
+        Clone the opened VM into destvmx from a snapshot, self.snapshotHandle
+        by default, and return the handle of the clone, which the caller
+        releases.  Linked clones share the disks of the snapshot.
+        '''
+        if snapshotHandle is None:
+            snapshotHandle = getattr(self, "snapshotHandle", Vix.VIX_INVALID_HANDLE)
+        cloneType = Vix.VIX_CLONETYPE_FULL
+        if linked:
+            cloneType = Vix.VIX_CLONETYPE_LINKED
+        vmHandle = c_int()
+        err = self._startjob("VixVM_Clone", lambda: self.vix.VixVM_Clone(self.vmHandle, snapshotHandle, cloneType,
+            destvmx, 0, Vix.VIX_INVALID_HANDLE, None, None), Vix.VIX_PROPERTY_JOB_RESULT_HANDLE,
+            byref(vmHandle), retry = False, vmpath = destvmx)
+        if err != Vix.VIX_OK:
+            raise VixException("VixVM_Clone %s Failed"%destvmx, err)
+        return vmHandle.value
+
+    def clonevm(self, destvmx, snapshotname = None, linked = True):
+        '''
+        Clone the opened VM from the named snapshot, the current one by default
+        '''
+        try:
+            tree = self.GetSnapshotTree()
+            try:
+                node = tree.current
+                if snapshotname is not None:
+                    node = tree.find(snapshotname)
+                if node is None:
+                    raise VixException("No current snapshot to clone from", Vix.VIX_E_SNAPSHOT_NOTFOUND)
+                self.vix.Vix_ReleaseHandle(self.Clone(destvmx, node.handle, linked))
+            finally:
+                tree.release()
+            return True
+        except Exception, e:
+            logging.error(e)
+        return False
+
     def deletevm(self):
         try:
-            self.jobHandle = self.vix.VixVM_Delete(self.vmHandle, Vix.VIX_VMDELETE_DISK_FILES, None, None);
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
+            err = self._startjob("VixVM_Delete", lambda: self.vix.VixVM_Delete(self.vmHandle,
+                Vix.VIX_VMDELETE_DISK_FILES, None, None), retry = False)
+            if self.vmCache is not None:
+                self.vmCache.invalidatehandle(self.vmHandle)
+            Vix.forgetvmhandle(self.vmHandle)
+            self.CloseVM()
             if err != Vix.VIX_OK:
-                logging.error("VixVM_delete Failed")
+                logging.error("VixVM_delete Failed (VixError %d)"%err)
             return True
         except Exception, e:
             logging.error(e)
         return False
     
     def loginvm(self):
+        '''
+        With guestSessions set, a login of the same user kept on the handle
+        is used as it is, and the tools are not waited for again while
+        they were seen running less than TOOLS_TTL seconds ago
+        '''
+        sessions = self.guestSessions
         try:
-            self.jobHandle = self.vix.VixVM_WaitForToolsInGuest(self.vmHandle, Vix.TOOLS_TIMEOUT, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
-            if err != Vix.VIX_OK:
-                logging.error("VixVM_WaitForToolsInGuest Failed")
+            if sessions is not None:
+                sessions.expire()
+                if sessions.get(self.vmHandle, self.vmuser, self.vmpassword):
+                    return True
+            if not self._login(sessions):
+                if sessions is not None:
+                    sessions.release(self.vmHandle)
                 return False
-            self.jobHandle = self.vix.VixVM_LoginInGuest(self.vmHandle, self.vmuser, self.vmpassword, Vix.VIX_LOGIN_IN_GUEST_REQUIRE_INTERACTIVE_ENVIRONMENT, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
+            return True
+        except Exception, e:
+            logging.error(e)
+        return False
+
+    def _login(self, sessions):
+        '''
+        Log in as loginvm does once the cache had no login to offer
+        '''
+        try:
+            toolsrunning = sessions is not None and sessions.toolsrunning(self.vmHandle)
+            if not toolsrunning:
+                err = self._startjob("VixVM_WaitForToolsInGuest",
+                    lambda: self.vix.VixVM_WaitForToolsInGuest(self.vmHandle, Vix.TOOLS_TIMEOUT, None, None))
+                if err != Vix.VIX_OK:
+                    logging.error("VixVM_WaitForToolsInGuest Failed (VixError %d)"%err)
+                    return False
+            err = self._startjob("VixVM_LoginInGuest", lambda: self.vix.VixVM_LoginInGuest(self.vmHandle,
+                self.vmuser, self.vmpassword, Vix.VIX_LOGIN_IN_GUEST_REQUIRE_INTERACTIVE_ENVIRONMENT, None, None))
+            if toolsrunning and err in GuestSessionCache.SESSION_ERRORS:
+                # the tools went away since, wait for them this time
+                sessions.toolsgone(self.vmHandle)
+                return self._login(sessions)
             if err != Vix.VIX_OK:
-                logging.error("VixVM_LoginInGuest Failed")
+                logging.error("VixVM_LoginInGuest Failed (VixError %d)"%err)
                 return False
+            if sessions is not None:
+                # get() counted this caller already
+                return sessions.put(self.vmHandle, self.vmuser, self.vmpassword, inuse = False)
             return True
         except Exception, e:
             logging.error(e)
         return False
     
     def logoutvm(self):
+        '''
+        With guestSessions set the login stays for the next loginvm, it is
+        logged out when the cache lets it go
+        '''
+        if self.guestSessions is not None and self.guestSessions.release(self.vmHandle):
+            return True
         try:
-            self.jobHandle = self.vix.VixVM_LogoutFromGuest(self.vmHandle, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
+            err = self._startjob("VixVM_LogoutFromGuest", lambda: self.vix.VixVM_LogoutFromGuest(self.vmHandle,
+                None, None), retry = False)
+            if self.guestSessions is not None:
+                self.guestSessions.invalidate(self.vmHandle)
             if err != Vix.VIX_OK:
-                logging.error("VixVM_LogoutFromGuest Failed")
+                logging.error("VixVM_LogoutFromGuest Failed (VixError %d)"%err)
                 return False
             return True
         except Exception, e:
@@ -755,11 +1148,11 @@ class Vix(object):
     
     def runprograminvm(self, progfullpathinvm, argsline):
         try:
-            self.jobHandle = self.vix.VixVM_RunProgramInGuest(self.vmHandle, progfullpathinvm, argsline, 0, Vix.VIX_INVALID_HANDLE, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
+            err = self._startjob("VixVM_RunProgramInGuest", lambda: self.vix.VixVM_RunProgramInGuest(self.vmHandle,
+                progfullpathinvm, argsline, 0, Vix.VIX_INVALID_HANDLE, None, None), retry = False)
+            self.guestchanged()
             if err != Vix.VIX_OK:
-                logging.error("VixVM_RunProgramInGuest Failed")
+                logging.error("VixVM_RunProgramInGuest Failed (VixError %d)"%err)
             return True
         except Exception, e:
             logging.error(e)
@@ -790,27 +1183,181 @@ class Vix(object):
         if interpreter == None, it means we use cmd in Windows
         '''
         try:
-            self.jobHandle = self.vix.VixVM_RunScriptInGuest(self.vmHandle, interpreter, scriptext, 0, Vix.VIX_INVALID_HANDLE, None, None)
             if not blocking:
+                if not self._admit():
+                    logging.error("VixVM_RunScriptInGuest Failed (VixError %d)"%JobPolicy.BREAKER_OPEN)
+                    return False
+                self.jobHandle = self.vix.VixVM_RunScriptInGuest(self.vmHandle, interpreter, scriptext, 0, Vix.VIX_INVALID_HANDLE, None, None)
                 self.vix.Vix_ReleaseHandle(self.jobHandle)
+                self.guestchanged()
                 return True
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
+            err = self._startjob("VixVM_RunScriptInGuest", lambda: self.vix.VixVM_RunScriptInGuest(self.vmHandle,
+                interpreter, scriptext, 0, Vix.VIX_INVALID_HANDLE, None, None), retry = False)
+            self.guestchanged()
             if err != Vix.VIX_OK:
-                logging.error("VixVM_RunScriptInGuest Failed")
+                logging.error("VixVM_RunScriptInGuest Failed (VixError %d)"%err)
                 return False
             return True
         except Exception, e:
             logging.error(e)
         return False
     
+    def exec_in_guest(self, command, interpreter = "/bin/sh", capture = True,
+            ontail = None, interval = TAIL_INTERVAL):
+        '''
+        Run a command line in the guest and return a GuestExecResult with
+        its exit code, pid and elapsed seconds, raising VixException if the
+        job fails.
+
+        With capture the command's stdout and stderr are spooled into one
+        guest file which is fetched by a single copy afterwards.  ontail,
+        if given, is called with each new piece of stdout every interval
+        seconds while the command runs.  Capturing needs a POSIX shell.
+        '''
+        if not capture:
+            return self._exec(interpreter, command + "\n", None, None, interval)
+        spool = posixpath.join(GUEST_TMP, "pyvix-exec-%d-%d"%(os.getpid(), next(_spoolids)))
+        # a subshell, so that an exit in the command still gets its output spooled
+        script = ("( %s\n) > %s.out 2> %s.err\nrc=$?\n"
+            "{ wc -c < %s.out; cat %s.out %s.err; } > %s\n"
+            "rm -f %s.out %s.err\nexit $rc\n")%((command,) + (spool,) * 8)
+        return self._exec(interpreter, script, spool, ontail, interval)
+
+    def _exec(self, interpreter, script, spool, ontail, interval):
+        pid = c_int64()
+        elapsed = c_int()
+        exitcode = c_int()
+        tailed = 0
+        started = time.time()
+        if not self._admit():
+            raise VixException("VixVM_RunScriptInGuest Failed", JobPolicy.BREAKER_OPEN)
+        policy = self.jobPolicy
+        until = None
+        if policy is not None:
+            until = policy.until("VixVM_RunScriptInGuest", started)
+        jobHandle = self.vix.VixVM_RunScriptInGuest(self.vmHandle, interpreter, script, 0, Vix.VIX_INVALID_HANDLE, None, None)
+        try:
+            if ontail is not None:
+                complete = c_byte(0)
+                while self.vix.VixJob_CheckCompletion(jobHandle, byref(complete)) == Vix.VIX_OK \
+                        and not complete.value and (until is None or time.time() < until):
+                    time.sleep(interval)
+                    tailed = self._tail(interpreter, spool, tailed, ontail)
+            properties = (Vix.VIX_PROPERTY_JOB_RESULT_PROCESS_ID, byref(pid),
+                Vix.VIX_PROPERTY_JOB_RESULT_GUEST_PROGRAM_ELAPSED_TIME, byref(elapsed),
+                Vix.VIX_PROPERTY_JOB_RESULT_GUEST_PROGRAM_EXIT_CODE, byref(exitcode))
+            if policy is not None:
+                err = policy.wait(self, "VixVM_RunScriptInGuest", jobHandle, properties, started)
+            else:
+                err = self.vix.VixJob_Wait(jobHandle, *(properties + (Vix.VIX_PROPERTY_NONE,)))
+        finally:
+            self.vix.Vix_ReleaseHandle(jobHandle)
+        # timed from the submission, the tail loop may have waited already
+        self.recordjob("VixVM_RunScriptInGuest", started, err)
+        self.guestchanged()
+        if err != Vix.VIX_OK:
+            raise VixException("VixVM_RunScriptInGuest Failed", err)
+        result = GuestExecResult(exitcode.value, pid.value, elapsed.value)
+        if spool is not None:
+            data = self._fetchguest(spool)
+            # the spool is of no further use, do not wait for its removal
+            self.vix.Vix_ReleaseHandle(self.vix.VixVM_DeleteFileInGuest(self.vmHandle, spool, None, None))
+            if ontail is not None:
+                self.vix.Vix_ReleaseHandle(self.vix.VixVM_DeleteFileInGuest(self.vmHandle, spool + ".tail", None, None))
+            size, data = data.split("\n", 1)
+            result.stdout = data[:int(size)]
+            result.stderr = data[int(size):]
+            if ontail is not None and len(result.stdout) > tailed:
+                ontail(result.stdout[tailed:])
+        return result
+
+    def _tail(self, interpreter, spool, offset, ontail):
+        '''
+        Hand the stdout spooled past offset to ontail; the guest cuts the
+        new bytes off into a file of their own, so only those are copied
+        '''
+        tail = spool + ".tail"
+        if not self.runscriptinvm(interpreter, "tail -c +%d %s.out > %s 2>/dev/null\n"%(offset + 1, spool, tail)):
+            return offset
+        try:
+            data = self._fetchguest(tail)
+        except VixException:
+            return offset
+        if data:
+            ontail(data)
+        return offset + len(data)
+
+    def _fetchguest(self, fulpathinvm):
+        '''
+        Content of a guest file, copied through a host temp file
+        '''
+        localfulpath = self.cpvm2temp(fulpathinvm)
+        try:
+            f = open(localfulpath, "rb")
+            try:
+                return f.read()
+            finally:
+                f.close()
+        finally:
+            os.remove(localfulpath)
+
+    def cpvm2temp(self, fulpathinvm):
+        '''
+        Copy a guest file into a new host temp file and return its path,
+        the caller removes it
+        '''
+        fd, localfulpath = tempfile.mkstemp(prefix = "pyvix-")
+        os.close(fd)
+        try:
+            err = self._startjob("VixVM_CopyFileFromGuestToHost", lambda: self.vix.VixVM_CopyFileFromGuestToHost(
+                self.vmHandle, fulpathinvm, localfulpath, 0, Vix.VIX_INVALID_HANDLE, None, None))
+            if err != Vix.VIX_OK:
+                raise VixException("VixVM_CopyFileFromGuestToHost %s Failed"%fulpathinvm, err)
+        except:
+            os.remove(localfulpath)
+            raise
+        return localfulpath
+
+    def iterguestfile(self, fulpathinvm, chunksize = STREAM_CHUNK):
+        '''
+        Generator of the content of a guest file in chunks of up to chunksize
+        bytes, sliced from a memory map of its one host copy.  The copy is
+        removed once the generator is exhausted or closed.
+        '''
+        localfulpath = self.cpvm2temp(fulpathinvm)
+        try:
+            f = open(localfulpath, "rb")
+            try:
+                for chunk in mapchunks(f, chunksize):
+                    yield chunk
+            finally:
+                f.close()
+        finally:
+            os.remove(localfulpath)
+
+    def sendguestfile(self, fulpathinvm, sock):
+        '''
+        Copy a guest file to a connected blocking socket, from its host copy
+        straight through sendfile where the platform has it, and return the
+        number of bytes sent
+        '''
+        localfulpath = self.cpvm2temp(fulpathinvm)
+        try:
+            f = open(localfulpath, "rb")
+            try:
+                return sendwholefile(sock, f)
+            finally:
+                f.close()
+        finally:
+            os.remove(localfulpath)
+
     def cphost2vm(self, localfulpath, fulpathinvm):
         try:
-            self.jobHandle = self.vix.VixVM_CopyFileFromHostToGuest(self.vmHandle, localfulpath, fulpathinvm, 0, Vix.VIX_INVALID_HANDLE, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
+            err = self._startjob("VixVM_CopyFileFromHostToGuest", lambda: self.vix.VixVM_CopyFileFromHostToGuest(
+                self.vmHandle, localfulpath, fulpathinvm, 0, Vix.VIX_INVALID_HANDLE, None, None))
+            self.guestchanged(fulpathinvm)
             if err != Vix.VIX_OK:
-                logging.error("VixVM_CopyFileFromHostToGuest Failed")
+                logging.error("VixVM_CopyFileFromHostToGuest Failed (VixError %d)"%err)
                 return False
             return True
         except Exception, e:
@@ -819,76 +1366,72 @@ class Vix(object):
 
     def cpvm2host(self, fulpathinvm, localfulpath):
         try:
-            print fulpathinvm, localfulpath
-            self.jobHandle = self.vix.VixVM_CopyFileFromGuestToHost(self.vmHandle, fulpathinvm, localfulpath, 0, Vix.VIX_INVALID_HANDLE, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
+            err = self._startjob("VixVM_CopyFileFromGuestToHost", lambda: self.vix.VixVM_CopyFileFromGuestToHost(
+                self.vmHandle, fulpathinvm, localfulpath, 0, Vix.VIX_INVALID_HANDLE, None, None))
             if err != Vix.VIX_OK:
-                print "VixVM_CopyFileFromGuestToHost Failed"
-                logging.error("VixVM_CopyFileFromGuestToHost Failed")
+                logging.error("VixVM_CopyFileFromGuestToHost %s Failed (VixError %d)"%(fulpathinvm, err))
                 return False
             return True
         except Exception, e:
-            print e
             logging.error(e)
         return False
 
     def rmfileinvm(self, fulpathinvm):
         try:
-            self.jobHandle = self.vix.VixVM_DeleteFileInGuest(self.vmHandle, fulpathinvm, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
+            err = self._startjob("VixVM_DeleteFileInGuest", lambda: self.vix.VixVM_DeleteFileInGuest(self.vmHandle,
+                fulpathinvm, None, None), retry = False)
+            self.guestchanged(fulpathinvm)
             if err != Vix.VIX_OK:
-                logging.error("VixVM_DeleteFileInGuest Failed")
+                logging.error("VixVM_DeleteFileInGuest Failed (VixError %d)"%err)
             return True
         except Exception, e:
             logging.error(e)
         return False
     
     def isfileinvm(self, fulpathinvm):
+        '''
+        With a dirCache the answer comes from the cached listing of the
+        parent directory, otherwise from one VixVM_FileExistsInGuest job
+        '''
         try:
-            self.jobHandle = self.vix.VixVM_FileExistsInGuest(self.vmHandle, fulpathinvm, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
-            if err != Vix.VIX_OK:
-                logging.error("VixVM_FileExistsInGuest Failed")
-            return True
+            if self.dirCache is not None:
+                entry = self.GuestEntry(fulpathinvm)
+                return entry is not None and not entry.isdir
+            return self._exists("VixVM_FileExistsInGuest", fulpathinvm)
         except Exception, e:
             logging.error(e)
         return False
     
     def renamefileinvm(self, oldfulpathinvm, newfulpathinvm):
         try:
-            self.jobHandle = self.vix.VixVM_RenameFileInGuest(self.vmHandle, oldfulpathinvm, newfulpathinvm, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
+            err = self._startjob("VixVM_RenameFileInGuest", lambda: self.vix.VixVM_RenameFileInGuest(self.vmHandle,
+                oldfulpathinvm, newfulpathinvm, 0, Vix.VIX_INVALID_HANDLE, None, None), retry = False)
+            self.guestchanged(oldfulpathinvm)
+            self.guestchanged(newfulpathinvm)
             if err != Vix.VIX_OK:
-                logging.error("VixVM_RenameFileInGuest Failed")
+                logging.error("VixVM_RenameFileInGuest Failed (VixError %d)"%err)
             return True
         except Exception, e:
             logging.error(e)
         return False
     
     def lsdirinvm(self, fulpathinvm):
+        '''
+        List of the GuestFileEntry items in the directory, None on failure
+        '''
         try:
-            self.jobHandle = self.vix.VixVM_ListDirectoryInGuest(self.vmHandle, fulpathinvm, None, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
-            print err
-            if err != Vix.VIX_OK:
-                logging.error("VixVM_ListDirectoryInGuest Failed")
-            return True
+            return list(self.ListDirectoryInGuest(fulpathinvm))
         except Exception, e:
             logging.error(e)
-        return False
+        return None
     
     def mkdirinvm(self, newfulpathinvm):
         try:
-            self.jobHandle = self.vix.VixVM_CreateDirectoryInGuest(self.vmHandle, newfulpathinvm, Vix.VIX_INVALID_HANDLE, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
+            err = self._startjob("VixVM_CreateDirectoryInGuest", lambda: self.vix.VixVM_CreateDirectoryInGuest(
+                self.vmHandle, newfulpathinvm, Vix.VIX_INVALID_HANDLE, None, None), retry = False)
+            self.guestchanged(newfulpathinvm)
             if err != Vix.VIX_OK:
-                logging.error("VixVM_CreateDirectoryInGuest Failed")
+                logging.error("VixVM_CreateDirectoryInGuest Failed (VixError %d)"%err)
             return True
         except Exception, e:
             logging.error(e)
@@ -896,11 +1439,11 @@ class Vix(object):
     
     def rmdirinvm(self, fulpathinvm):
         try:
-            self.jobHandle = self.vix.VixVM_DeleteDirectoryInGuest(self.vmHandle, fulpathinvm, Vix.VIX_INVALID_HANDLE, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
+            err = self._startjob("VixVM_DeleteDirectoryInGuest", lambda: self.vix.VixVM_DeleteDirectoryInGuest(
+                self.vmHandle, fulpathinvm, Vix.VIX_INVALID_HANDLE, None, None), retry = False)
+            self.guestchanged(fulpathinvm)
             if err != Vix.VIX_OK:
-                logging.error("VixVM_DeleteDirectoryInGuest Failed")
+                logging.error("VixVM_DeleteDirectoryInGuest Failed (VixError %d)"%err)
             return True
         except Exception, e:
             logging.error(e)
@@ -908,25 +1451,1813 @@ class Vix(object):
     
     def isdirinvm(self, fulpathinvm):
         try:
-            self.jobHandle = self.vix.VixVM_DirectoryExistsInGuest(self.vmHandle, fulpathinvm, None, None)
-            err = self.VixJob_Wait2(self.jobHandle, Vix.VIX_PROPERTY_NONE)
-            self.vix.Vix_ReleaseHandle(self.jobHandle);
-            if err != Vix.VIX_OK:
-                logging.error("VixVM_DirectoryExistsInGuest Failed")
-                return False
-            print "TEST %d"%self.jobHandle
-            if self.jobHandle == Vix.VIX_PROPERTY_JOB_RESULT_GUEST_OBJECT_EXISTS:
-                return True
+            # a root has no parent listing to be looked up in
+            if self.dirCache is not None and not _isguestroot(fulpathinvm):
+                entry = self.GuestEntry(fulpathinvm)
+                return entry is not None and entry.isdir
+            return self._exists("VixVM_DirectoryExistsInGuest", fulpathinvm)
         except Exception, e:
             logging.error(e)
         return False
 
-'''
+    def ListDirectoryInGuest(self, fulpathinvm, vmHandle = None):
+        '''
+        Generator of the GuestFileEntry items of a guest directory, read one
+        by one off the finished job.  A listing read to the end goes into
+        dirCache and later calls within its TTL are answered from there.
+        '''
+        if vmHandle is None:
+            vmHandle = self.vmHandle
+        if self.dirCache is not None:
+            entries = self.dirCache.get(vmHandle, fulpathinvm)
+            if entries is not None:
+                for entry in entries:
+                    yield entry
+                return
+        if not self._admit(vmHandle):
+            raise VixException("VixVM_ListDirectoryInGuest Failed", JobPolicy.BREAKER_OPEN)
+        jobHandle = self.vix.VixVM_ListDirectoryInGuest(vmHandle, fulpathinvm, 0, None, None)
+        entries = []
+        try:
+            err = self._waitjob("VixVM_ListDirectoryInGuest", jobHandle)
+            if err != Vix.VIX_OK:
+                raise VixException("VixVM_ListDirectoryInGuest Failed", err)
+            num = self.vix.VixJob_GetNumProperties(jobHandle, Vix.VIX_PROPERTY_JOB_RESULT_ITEM_NAME)
+            for i in range(num):
+                entry = self._direntry(jobHandle, i, fulpathinvm)
+                entries.append(entry)
+                yield entry
+        finally:
+            self.vix.Vix_ReleaseHandle(jobHandle)
+        if self.dirCache is not None:
+            self.dirCache.put(vmHandle, fulpathinvm, entries)
+
+    def GuestEntry(self, fulpathinvm, vmHandle = None):
+        '''
+        GuestFileEntry of a guest path out of the listing of its parent
+        directory, None if it does not exist
+        '''
+        pathmod = guestpathmodule(fulpathinvm)
+        dirpath, name = pathmod.split(fulpathinvm.rstrip("/\\") or fulpathinvm)
+        if pathmod is ntpath:
+            name = name.lower()
+        try:
+            # read the whole listing so that it ends up in dirCache
+            entries = list(self.ListDirectoryInGuest(dirpath, vmHandle))
+        except VixException, e:
+            if e.errorCode in (Vix.VIX_E_FILE_NOT_FOUND, Vix.VIX_E_NOT_A_DIRECTORY):
+                return None
+            raise
+        for entry in entries:
+            if entry.name == name or (pathmod is ntpath and entry.name.lower() == name):
+                return entry
+        return None
+
+    def guestchanged(self, fulpathinvm = None, vmHandle = None):
+        '''
+        Forget the cached listings made stale by a change of fulpathinvm, or
+        every listing of the VM when anything may have changed
+        '''
+        if self.dirCache is None:
+            return
+        if vmHandle is None:
+            vmHandle = self.vmHandle
+        if fulpathinvm is None:
+            self.dirCache.invalidatehandle(vmHandle)
+        else:
+            self.dirCache.invalidate(vmHandle, fulpathinvm)
+
+    def _direntry(self, jobHandle, index, dirpath):
+        name = c_void_p()
+        size = c_int64()
+        flags = c_int()
+        modtime = c_int64()
+        err = self.vix.VixJob_GetNthProperties(jobHandle, index,
+            Vix.VIX_PROPERTY_JOB_RESULT_ITEM_NAME, byref(name),
+            Vix.VIX_PROPERTY_JOB_RESULT_FILE_SIZE, byref(size),
+            Vix.VIX_PROPERTY_JOB_RESULT_FILE_FLAGS, byref(flags),
+            Vix.VIX_PROPERTY_JOB_RESULT_FILE_MOD_TIME, byref(modtime),
+            Vix.VIX_PROPERTY_NONE)
+        if err != Vix.VIX_OK:
+            raise VixException("VixJob_GetNthProperties Failed", err)
+        try:
+            filename = string_at(name.value)
+        finally:
+            self.vix.Vix_FreeBuffer(name)
+        return GuestFileEntry(dirpath, filename, size.value, flags.value, modtime.value)
+
+    def _exists(self, opname, fulpathinvm):
+        exists = c_int()
+        err = self._startjob(opname, lambda: getattr(self.vix, opname)(self.vmHandle, fulpathinvm, None, None),
+            Vix.VIX_PROPERTY_JOB_RESULT_GUEST_OBJECT_EXISTS, byref(exists))
+        if err != Vix.VIX_OK:
+            raise VixException("%s Failed"%opname, err)
+        return bool(exists.value)
+
+    def _startjob(self, opname, startjob, *properties, **kwargs):
+        '''
+        _runjob of the job startjob() starts, started again as jobPolicy
+        allows when it fails with a retryable error.  Only for jobs that
+        can safely be run twice, the others pass retry = False.
+        '''
+        retry = kwargs.pop("retry", True)
+        vmHandle = kwargs.pop("vmHandle", self.vmHandle)
+        policy = self.jobPolicy
+        attempt = 0
+        relogin = self.guestSessions is not None
+        while True:
+            if not self._admit(vmHandle):
+                return JobPolicy.BREAKER_OPEN
+            self.jobHandle = startjob()
+            err = self._runjob(opname, self.jobHandle, *properties, **kwargs)
+            if relogin and err in GuestSessionCache.SESSION_ERRORS \
+                    and opname not in ("VixVM_LoginInGuest", "VixVM_LogoutFromGuest"):
+                # the cached login went away, the job did not run; log in once more
+                relogin = False
+                if self.guestSessions.invalidate(vmHandle) and self.loginvm():
+                    continue
+            if policy is None or not retry or not policy.retryable(err) or attempt >= policy.retries:
+                return err
+            delay = policy.backoff(attempt)
+            logging.warning("%s Failed (VixError %d), try %d again in %.2fs"%(opname, err, attempt + 2, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def _admit(self, vmHandle = None):
+        '''
+        Wait for jobScheduler to let a job of the VM, the opened one by
+        default, start, then ask jobPolicy whether the breaker of the host
+        lets it; False when the job must not be started.  VIX_INVALID_HANDLE
+        for jobs of no VM.
+        '''
+        if self.jobScheduler is not None:
+            if vmHandle is None:
+                vmHandle = self.vmHandle
+            if vmHandle == Vix.VIX_INVALID_HANDLE:
+                vmHandle = None
+            self.jobScheduler.wait(self.tenant, self.url, vmHandle)
+        return self.jobPolicy is None or self.jobPolicy.admit(self.url)
+
+    def _runjob(self, opname, jobHandle, *properties, **kwargs):
+        '''
+        Wait for a job, release its handle and return its error code.
+        properties are the propid, byref(value) pairs read off the result.
+        '''
+        try:
+            return self._waitjob(opname, jobHandle, *properties, **kwargs)
+        finally:
+            self.vix.Vix_ReleaseHandle(jobHandle)
+
+    def _waitjob(self, opname, jobHandle, *properties, **kwargs):
+        '''
+        _runjob keeping the job handle, for results read off the job later.
+        The wait is recorded into metrics under opname, vmpath (the opened
+        VM by default) and the host.
+        '''
+        started = time.time()
+        err = Vix.VIX_E_FAIL
+        try:
+            if self.jobPolicy is not None:
+                err = self.jobPolicy.wait(self, opname, jobHandle, properties)
+            else:
+                err = self.vix.VixJob_Wait(jobHandle, *(properties + (Vix.VIX_PROPERTY_NONE,)))
+            return err
+        finally:
+            self.recordjob(opname, started, err, kwargs.get("vmpath"))
+
+    def recordjob(self, opname, started, err, vmpath = None):
+        '''
+        Record a job begun at started into metrics, if set
+        '''
+        if self.metrics is not None:
+            if vmpath is None:
+                vmpath = self.vmfolder
+            self.metrics.record(opname, self.url, vmpath, time.time() - started, err)
+
+def VixErrorCode(err, func = None, args = None):
+    '''
+    Strip the extra bits a VixError carries above its 16-bit error code
+    '''
+    return err & 0xFFFF
+
+
+class VixLib(object):
+    '''
+    Binding table of libvix shared by all Vix instances.
+
+    The library is loaded on first use, and each entry point gets its
+    restype/argtypes declared once, the first time it is looked up.  lib
+    may be given already loaded, e.g. the in-process fake of fakevix.
+    '''
+    # VixError is a uint64, only its low 16 bits are the error code
+    VIXERROR = c_uint64
+    # restype, argtypes of the libvix entry points; variadic functions
+    # only declare their fixed arguments
+    PROTOTYPES = {
+        "Vix_ReleaseHandle": (None, [c_int]),
+        "Vix_AddRefHandle": (None, [c_int]),
+        "Vix_GetHandleType": (c_int, [c_int]),
+        "Vix_GetProperties": (VIXERROR, [c_int, c_int]),
+        "Vix_FreeBuffer": (None, [c_void_p]),
+        "VixHost_Connect": (c_int, [c_int, c_int, c_char_p, c_int, c_char_p, c_char_p, c_int, c_int, c_void_p, c_void_p]),
+        "VixHost_Disconnect": (None, [c_int]),
+        "VixHost_RegisterVM": (c_int, [c_int, c_char_p, c_void_p, c_void_p]),
+        "VixHost_UnregisterVM": (c_int, [c_int, c_char_p, c_void_p, c_void_p]),
+        "VixHost_FindItems": (c_int, [c_int, c_int, c_int, c_int, c_void_p, c_void_p]),
+        "VixJob_Wait": (VIXERROR, [c_int, c_int]),
+        "VixJob_CheckCompletion": (VIXERROR, [c_int, c_void_p]),
+        "VixJob_GetError": (VIXERROR, [c_int]),
+        "VixJob_GetNumProperties": (c_int, [c_int, c_int]),
+        "VixJob_GetNthProperties": (VIXERROR, [c_int, c_int, c_int]),
+        "VixVM_Open": (c_int, [c_int, c_char_p, c_void_p, c_void_p]),
+        "VixVM_PowerOn": (c_int, [c_int, c_int, c_int, c_void_p, c_void_p]),
+        "VixVM_PowerOff": (c_int, [c_int, c_int, c_void_p, c_void_p]),
+        "VixVM_Delete": (c_int, [c_int, c_int, c_void_p, c_void_p]),
+        "VixVM_WaitForToolsInGuest": (c_int, [c_int, c_int, c_void_p, c_void_p]),
+        "VixVM_LoginInGuest": (c_int, [c_int, c_char_p, c_char_p, c_int, c_void_p, c_void_p]),
+        "VixVM_LogoutFromGuest": (c_int, [c_int, c_void_p, c_void_p]),
+        "VixVM_RunProgramInGuest": (c_int, [c_int, c_char_p, c_char_p, c_int, c_int, c_void_p, c_void_p]),
+        "VixVM_RunScriptInGuest": (c_int, [c_int, c_char_p, c_char_p, c_int, c_int, c_void_p, c_void_p]),
+        "VixVM_CopyFileFromHostToGuest": (c_int, [c_int, c_char_p, c_char_p, c_int, c_int, c_void_p, c_void_p]),
+        "VixVM_CopyFileFromGuestToHost": (c_int, [c_int, c_char_p, c_char_p, c_int, c_int, c_void_p, c_void_p]),
+        "VixVM_DeleteFileInGuest": (c_int, [c_int, c_char_p, c_void_p, c_void_p]),
+        "VixVM_FileExistsInGuest": (c_int, [c_int, c_char_p, c_void_p, c_void_p]),
+        "VixVM_RenameFileInGuest": (c_int, [c_int, c_char_p, c_char_p, c_int, c_int, c_void_p, c_void_p]),
+        "VixVM_ListDirectoryInGuest": (c_int, [c_int, c_char_p, c_int, c_void_p, c_void_p]),
+        "VixVM_CreateDirectoryInGuest": (c_int, [c_int, c_char_p, c_int, c_void_p, c_void_p]),
+        "VixVM_DeleteDirectoryInGuest": (c_int, [c_int, c_char_p, c_int, c_void_p, c_void_p]),
+        "VixVM_DirectoryExistsInGuest": (c_int, [c_int, c_char_p, c_void_p, c_void_p]),
+        "VixVM_CreateSnapshot": (c_int, [c_int, c_char_p, c_char_p, c_int, c_int, c_void_p, c_void_p]),
+        "VixVM_RevertToSnapshot": (c_int, [c_int, c_int, c_int, c_int, c_void_p, c_void_p]),
+        "VixVM_RemoveSnapshot": (c_int, [c_int, c_int, c_int, c_void_p, c_void_p]),
+        "VixVM_GetNumRootSnapshots": (VIXERROR, [c_int, c_void_p]),
+        "VixVM_GetRootSnapshot": (VIXERROR, [c_int, c_int, c_void_p]),
+        "VixVM_GetCurrentSnapshot": (VIXERROR, [c_int, c_void_p]),
+        "VixVM_GetNamedSnapshot": (VIXERROR, [c_int, c_char_p, c_void_p]),
+        "VixSnapshot_GetNumChildren": (VIXERROR, [c_int, c_void_p]),
+        "VixSnapshot_GetChild": (VIXERROR, [c_int, c_int, c_void_p]),
+        "VixSnapshot_GetParent": (VIXERROR, [c_int, c_void_p]),
+        "VixVM_Clone": (c_int, [c_int, c_int, c_int, c_char_p, c_int, c_int, c_void_p, c_void_p]),
+    }
+
+    def __init__(self, dylibfilepath, lib = None):
+        self.dylibfilepath = dylibfilepath
+        self.lib = lib
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # only reached for entry points that are not bound yet
+        if not name.startswith("Vix"):
+            raise AttributeError(name)
+        self.lock.acquire()
+        try:
+            if name in self.__dict__:
+                return self.__dict__[name]
+            if self.lib is None:
+                self.lib = cdll.LoadLibrary(self.dylibfilepath)
+            func = getattr(self.lib, name)
+            prototype = VixLib.PROTOTYPES.get(name)
+            if prototype is not None:
+                func.restype, func.argtypes = prototype
+                if func.restype is VixLib.VIXERROR:
+                    func.errcheck = VixErrorCode
+            setattr(self, name, func)
+            return func
+        finally:
+            self.lock.release()
+
+
+_vixlib = None
+_vixlibLock = threading.Lock()
+
+def getvixlib():
+    '''
+    Return the process-wide libvix binding table.  PYVIX_LIB in the
+    environment overrides DYLIBPATH: a library file path, or "fake" for
+    the in-process FakeVixLib of fakevix
+    '''
+    global _vixlib
+    if _vixlib is None:
+        _vixlibLock.acquire()
+        try:
+            if _vixlib is None:
+                override = os.environ.get("PYVIX_LIB")
+                if override == "fake":
+                    import fakevix
+                    _vixlib = VixLib("fake", fakevix.FakeVixLib())
+                elif override:
+                    _vixlib = VixLib(override)
+                else:
+                    _vixlib = VixLib(os.path.join(DYLIBPATH, DYLIBFILENAME))
+        finally:
+            _vixlibLock.release()
+    return _vixlib
+
+def setvixlib(lib, dylibfilepath = "preloaded"):
+    '''
+    Bind pyvix to an already loaded library, such as fakevix.FakeVixLib.
+    Only Vix instances created afterwards use it, so call it first.
+    '''
+    global _vixlib
+    _vixlibLock.acquire()
+    try:
+        _vixlib = VixLib(dylibfilepath, lib)
+    finally:
+        _vixlibLock.release()
+    return _vixlib
+
+
+
 class VixException(Exception):
-    def __init__(errorCode):
+    '''
+    Raised when a VIX job or call finishes with an error code
+    '''
+    def __init__(self, message, errorCode = Vix.VIX_E_FAIL):
+        Exception.__init__(self, "%s (VixError %d)"%(message, errorCode))
         self.errorCode = errorCode
-'''
-        
 
 
+class GuestExecResult(object):
+    '''
+    Outcome of a command run by Vix.exec_in_guest
+    '''
+    def __init__(self, exitcode, pid, elapsed, stdout = None, stderr = None):
+        self.exitcode = exitcode
+        self.pid = pid
+        self.elapsed = elapsed
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @property
+    def ok(self):
+        return self.exitcode == 0
+
+    def __repr__(self):
+        return "<GuestExecResult pid %d exit %d %ds>"%(self.pid, self.exitcode, self.elapsed)
+
+
+def mapchunks(f, chunksize = STREAM_CHUNK, offset = 0):
+    '''
+    Generator of the content of an open file from offset on, in chunks of
+    up to chunksize bytes sliced from a read-only memory map
+    '''
+    size = os.fstat(f.fileno()).st_size
+    if size <= offset:
+        return
+    mapped = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+        while offset < size:
+            yield mapped[offset:offset + chunksize]
+            offset += chunksize
+    finally:
+        mapped.close()
+
+
+def _libcsendfile():
+    '''
+    sendfile(2) of the C library as os.sendfile has it, for Pythons without
+    os.sendfile; None where there is no such call
+    '''
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = CDLL(None, use_errno = True)
+        call = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    call.restype = c_ssize_t
+    call.argtypes = [c_int, c_int, POINTER(c_longlong), c_size_t]
+
+    def sendfile(outfd, infd, offset, count):
+        position = c_longlong(offset)
+        sent = call(outfd, infd, byref(position), count)
+        if sent < 0:
+            code = get_errno()
+            raise OSError(code, os.strerror(code))
+        return sent
+    return sendfile
+
+# sendfile(outfd, infd, offset, count) returning the bytes sent, or None
+sendfile = getattr(os, "sendfile", None) or _libcsendfile()
+
+
+def sendwholefile(sock, f, offset = 0):
+    '''
+    Send an open file from offset to its end over a blocking socket, with
+    sendfile when possible and memory-mapped chunks otherwise; returns the
+    number of bytes sent
+    '''
+    size = os.fstat(f.fileno()).st_size
+    start = offset
+    if sendfile is not None:
+        try:
+            while offset < size:
+                sent = sendfile(sock.fileno(), f.fileno(), offset, min(size - offset, 0x7ffff000))
+                if sent == 0:
+                    break
+                offset += sent
+            return offset - start
+        except OSError, e:
+            # not a file sendfile takes, send what is left through user space
+            if e.errno not in (errno.EINVAL, errno.ENOSYS) or offset != start:
+                raise
+    for chunk in mapchunks(f, STREAM_CHUNK, offset):
+        sock.sendall(chunk)
+        offset += len(chunk)
+    return offset - start
+
+
+def guestpathmodule(fulpathinvm):
+    '''
+    ntpath for Windows guest paths, posixpath for the others
+    '''
+    if "\\" in fulpathinvm or fulpathinvm[1:2] == ":":
+        return ntpath
+    return posixpath
+
+
+def _isguestroot(fulpathinvm):
+    '''
+    Whether the guest path is "/" or a drive like "C:\\"
+    '''
+    pathmod = guestpathmodule(fulpathinvm)
+    return not pathmod.split(fulpathinvm.rstrip("/\\") or fulpathinvm)[1]
+
+
+class GuestFileEntry(object):
+    '''
+    One item of a guest directory listing
+    '''
+    def __init__(self, dirpath, name, size, flags, modtime):
+        self.path = guestpathmodule(dirpath).join(dirpath, name)
+        self.name = name
+        self.size = size
+        self.flags = flags
+        self.modtime = modtime
+
+    @property
+    def isdir(self):
+        return bool(self.flags & Vix.VIX_FILE_ATTRIBUTES_DIRECTORY)
+
+    @property
+    def issymlink(self):
+        return bool(self.flags & Vix.VIX_FILE_ATTRIBUTES_SYMLINK)
+
+    def __repr__(self):
+        return "<GuestFileEntry %s%s %d>"%(self.path, self.isdir and "/" or "", self.size)
+
+
+class PooledHost(object):
+    '''
+    One connected host handle shared by the Vix instances borrowing it
+    '''
+    def __init__(self, key, hostHandle, password):
+        self.key = key
+        self.hostHandle = hostHandle
+        self.password = password
+        self.refs = 0
+        self.lastused = time.time()
+        self.retired = False
+
+
+class HostPool(object):
+    '''
+    Process-wide pool of warm host handles keyed by (hostname, port, username).
+
+    Borrowers share one connected handle per key.  Handles nobody borrows
+    are disconnected after IDLE_TIMEOUT seconds or when the pool is full,
+    a handle failing the health check or reported broken is replaced by a
+    new connection on the next acquire.
+    '''
+    # Connected host handles kept at most
+    MAX_SIZE = 16
+    # Seconds an unborrowed host handle stays connected
+    IDLE_TIMEOUT = 600
+
+    # Job errors meaning the host connection itself is gone
+    CONNECTION_ERRORS = (Vix.VIX_E_HOST_NOT_CONNECTED,
+        Vix.VIX_E_HOST_TCP_SOCKET_ERROR,
+        Vix.VIX_E_HOST_TCP_CONN_LOST,
+        Vix.VIX_E_CANNOT_CONNECT_TO_HOST)
+
+    def __init__(self, maxsize = MAX_SIZE, idletimeout = IDLE_TIMEOUT, healthcheck = None):
+        self.maxsize = maxsize
+        self.idletimeout = idletimeout
+        if healthcheck is not None:
+            self.healthcheck = healthcheck
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.handles = {}
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.evictions = 0
+
+    def healthcheck(self, vix, hostHandle):
+        '''
+        Cheap local check that the handle is still a usable host handle
+        '''
+        hosttype = c_int()
+        err = vix.vix.Vix_GetProperties(hostHandle, Vix.VIX_PROPERTY_HOST_HOSTTYPE,
+            byref(hosttype), Vix.VIX_PROPERTY_NONE)
+        return err == Vix.VIX_OK
+
+    def acquire(self, vix, hostname, hostport, username, password):
+        key = (hostname, hostport, username)
+        self.lock.acquire()
+        try:
+            self.evictidle(vix, locked = True)
+            entry = self.hosts.get(key)
+            if entry is not None:
+                if entry.password == password and self.healthcheck(vix, entry.hostHandle):
+                    self.hits += 1
+                    return self._borrow(entry)
+                self._retire(vix, entry)
+                self.reconnects += 1
+            else:
+                self.misses += 1
+        finally:
+            self.lock.release()
+
+        # connect outside of the lock, logins to other hosts go on meanwhile
+        hostHandle = vix.HostConnect(hostname, hostport, username, password)
+        self.lock.acquire()
+        try:
+            entry = self.hosts.get(key)
+            if entry is not None and entry.password == password:
+                # somebody else connected first
+                vix.vix.VixHost_Disconnect(hostHandle)
+                return self._borrow(entry)
+            if entry is not None:
+                self._retire(vix, entry)
+            while len(self.hosts) >= self.maxsize and self._evictlru(vix):
+                pass
+            entry = PooledHost(key, hostHandle, password)
+            self.hosts[key] = entry
+            self.handles[hostHandle] = entry
+            return self._borrow(entry)
+        finally:
+            self.lock.release()
+
+    def release(self, vix, hostHandle, broken = False):
+        '''
+        Give the handle back, broken handles are reconnected on next acquire
+        '''
+        self.lock.acquire()
+        try:
+            entry = self.handles.get(hostHandle)
+            if entry is None:
+                return
+            entry.refs = max(0, entry.refs - 1)
+            entry.lastused = time.time()
+            if broken:
+                self._retire(vix, entry)
+                self.reconnects += 1
+            elif entry.retired and entry.refs == 0:
+                self._disconnect(vix, entry)
+            self.evictidle(vix, locked = True)
+        finally:
+            self.lock.release()
+
+    def evictidle(self, vix, locked = False):
+        '''
+        Disconnect handles nobody borrowed for idletimeout seconds
+        '''
+        if not locked:
+            self.lock.acquire()
+        try:
+            deadline = time.time() - self.idletimeout
+            for entry in self.hosts.values():
+                if entry.refs == 0 and entry.lastused < deadline:
+                    self._retire(vix, entry)
+                    self.evictions += 1
+        finally:
+            if not locked:
+                self.lock.release()
+
+    def clear(self, vix):
+        self.lock.acquire()
+        try:
+            for entry in self.hosts.values():
+                self._retire(vix, entry)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {"hits": self.hits,
+            "misses": self.misses,
+            "reconnects": self.reconnects,
+            "evictions": self.evictions,
+            "size": len(self.hosts),
+            "borrowed": len([entry for entry in self.hosts.values() if entry.refs > 0])}
+
+    def _borrow(self, entry):
+        entry.refs += 1
+        entry.lastused = time.time()
+        return entry.hostHandle
+
+    def _evictlru(self, vix):
+        idle = [entry for entry in self.hosts.values() if entry.refs == 0]
+        if not idle:
+            return False
+        idle.sort(key = lambda entry: entry.lastused)
+        self._retire(vix, idle[0])
+        self.evictions += 1
+        return True
+
+    def _retire(self, vix, entry):
+        # drop it from the pool, the connection goes once the last borrower is done
+        if self.hosts.get(entry.key) is entry:
+            del self.hosts[entry.key]
+        entry.retired = True
+        if entry.refs == 0:
+            self._disconnect(vix, entry)
+
+    def _disconnect(self, vix, entry):
+        if self.handles.pop(entry.hostHandle, None) is not None:
+            if Vix.vmCache is not None:
+                Vix.vmCache.invalidatehost(entry.hostHandle)
+            vix.vix.VixHost_Disconnect(entry.hostHandle)
+
+
+class VMHandleCache(object):
+    '''
+    LRU cache of opened VM handles keyed by (host handle, vmx path).
+
+    The cache owns one reference on every handle it holds and releases it
+    with Vix_ReleaseHandle when the entry expires after TTL seconds, is
+    pushed out by MAX_SIZE or is invalidated because the VM went away.
+    get() hands out a reference of the caller's own and put() takes one of
+    the cache's own, so callers release the handles they got or put either
+    way once done, and an eviction never pulls a handle from under them.
+    '''
+    # VM handles kept at most
+    MAX_SIZE = 256
+    # Seconds an opened VM handle is trusted before it is opened again
+    TTL = 300
+
+    def __init__(self, maxsize = MAX_SIZE, ttl = TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, hostHandle, vmxpath):
+        key = (hostHandle, vmxpath)
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[1] + self.ttl < time.time():
+                self._release(entry)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # re-insert as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            getvixlib().Vix_AddRefHandle(entry[0])
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    def put(self, hostHandle, vmxpath, vmHandle):
+        key = (hostHandle, vmxpath)
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] != vmHandle:
+                self._release(entry)
+            if entry is None or entry[0] != vmHandle:
+                getvixlib().Vix_AddRefHandle(vmHandle)
+            self.entries[key] = (vmHandle, time.time())
+            while len(self.entries) > self.maxsize:
+                self._release(self.entries.popitem(last = False)[1])
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def invalidate(self, hostHandle, vmxpath):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop((hostHandle, vmxpath), None)
+            if entry is not None:
+                self._release(entry)
+        finally:
+            self.lock.release()
+
+    def invalidatehandle(self, vmHandle):
+        self._drop(lambda key, entry: entry[0] == vmHandle)
+
+    def invalidatehost(self, hostHandle):
+        self._drop(lambda key, entry: key[0] == hostHandle)
+
+    def clear(self):
+        self._drop(lambda key, entry: True)
+
+    def stats(self):
+        return {"hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.entries)}
+
+    def _drop(self, match):
+        self.lock.acquire()
+        try:
+            for key, entry in self.entries.items():
+                if match(key, entry):
+                    del self.entries[key]
+                    self._release(entry)
+        finally:
+            self.lock.release()
+
+    def _release(self, entry):
+        Vix.forgetvmhandle(entry[0])
+        getvixlib().Vix_ReleaseHandle(entry[0])
+
+
+class GuestSessionCache(object):
+    '''
+    Guest logins kept on VM handles between calls, keyed by VM handle
+    since a handle holds one login at a time.
+
+    loginvm of the user logged in already on the handle is answered from
+    the cache.  A login is in use from each loginvm to its logoutvm, and
+    while it is a login under other credentials is refused; one no caller
+    uses that stayed idle for IDLE_TIMEOUT seconds, or is pushed out by
+    MAX_SIZE, is logged out from the guest.  Jobs failing
+    with one of SESSION_ERRORS drop the login and log in again once, and
+    the tools are not waited for while seen running within TOOLS_TTL
+    seconds.  Power offs, reverts and released handles forget the login.
+    '''
+    # Logins kept at most
+    MAX_SIZE = 64
+    # Seconds a login may stay unused before it is logged out
+    IDLE_TIMEOUT = 300
+    # Seconds tools seen running are trusted to still be running
+    TOOLS_TTL = 60
+    # Errors of guest jobs telling the login is gone
+    SESSION_ERRORS = frozenset([
+        Vix.VIX_E_TOOLS_NOT_RUNNING,
+        Vix.VIX_E_CANNOT_AUTHENTICATE_WITH_GUEST,
+        Vix.VIX_E_INTERACTIVE_SESSION_NOT_PRESENT,
+        Vix.VIX_E_INTERACTIVE_SESSION_USER_MISMATCH,
+    ])
+
+    def __init__(self, maxsize = MAX_SIZE, idletimeout = IDLE_TIMEOUT, toolsttl = TOOLS_TTL):
+        self.maxsize = maxsize
+        self.idletimeout = idletimeout
+        self.toolsttl = toolsttl
+        self.lock = threading.Lock()
+        # vmHandle: [(username, password), last used, callers using it],
+        # least recently used first; last used is None while logging in
+        self.entries = OrderedDict()
+        # vmHandle: when the tools were last seen running
+        self.tools = {}
+        self.hits = 0
+        self.misses = 0
+        self.logins = 0
+        self.dropped = 0
+        self.toolsskipped = 0
+        self.evictions = 0
+
+    def get(self, vmHandle, username, password):
+        '''
+        Whether the user is logged in on the handle already.  If not the
+        handle is kept for the caller, who logs in and hands the login to
+        put(), or to release() when it failed.  Raises VixException while
+        callers use a login under other credentials.
+        '''
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(vmHandle, None)
+            if entry is not None and entry[0] != (username, password) and entry[2]:
+                self.entries[vmHandle] = entry
+                self.misses += 1
+                raise VixException("Guest login in use by %s"%entry[0][0], Vix.VIX_E_OBJECT_IS_BUSY)
+            if entry is None or entry[0] != (username, password):
+                # the caller's login replaces an unused one of another user
+                entry = [(username, password), None, 0]
+            entry[2] += 1
+            self.entries[vmHandle] = entry
+            if entry[1] is None:
+                self.misses += 1
+                return False
+            entry[1] = time.time()
+            self.hits += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def taken(self, vmHandle, username, password):
+        '''
+        Whether callers use, or are making, a login under other credentials
+        '''
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(vmHandle)
+            return entry is not None and entry[0] != (username, password) and entry[2] > 0
+        finally:
+            self.lock.release()
+
+    def put(self, vmHandle, username, password, inuse = True):
+        '''
+        Keep a login that just succeeded, logging out the unused ones
+        pushed out.  inuse counts the caller as using it, a caller get()
+        kept the handle for is counted already.  False and nothing kept
+        while callers use a login under other credentials.
+        '''
+        now = time.time()
+        evicted = []
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(vmHandle)
+            users = 0
+            if entry is not None and entry[0] == (username, password):
+                users = entry[2]
+            elif entry is not None and entry[2]:
+                logging.error("Guest login of %s kept, it is in use"%entry[0][0])
+                return False
+            if inuse:
+                users += 1
+            self.entries.pop(vmHandle, None)
+            self.entries[vmHandle] = [(username, password), now, users]
+            # the login needed the tools running
+            self.tools[vmHandle] = now
+            self.logins += 1
+            excess = len(self.entries) - self.maxsize
+            if excess > 0:
+                evicted = [handle for handle, entry in self.entries.items() if not entry[2]][:excess]
+                for handle in evicted:
+                    del self.entries[handle]
+                self.evictions += len(evicted)
+        finally:
+            self.lock.release()
+        self._logout(evicted)
+        return True
+
+    def release(self, vmHandle):
+        '''
+        A caller is done with the login for now, or failed to log in, False
+        when none is kept
+        '''
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(vmHandle)
+            if entry is None:
+                return False
+            entry[2] = max(0, entry[2] - 1)
+            if entry[1] is not None:
+                entry[1] = time.time()
+            elif not entry[2]:
+                # nobody is logging in any more
+                del self.entries[vmHandle]
+            return True
+        finally:
+            self.lock.release()
+
+    def toolsrunning(self, vmHandle):
+        self.lock.acquire()
+        try:
+            seen = self.tools.get(vmHandle)
+            if seen is not None and time.time() - seen < self.toolsttl:
+                self.toolsskipped += 1
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def toolsgone(self, vmHandle):
+        self.lock.acquire()
+        try:
+            self.tools.pop(vmHandle, None)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, vmHandle):
+        '''
+        Forget the login and tools of a handle, True when a login was kept
+        '''
+        self.lock.acquire()
+        try:
+            self.tools.pop(vmHandle, None)
+            if self.entries.pop(vmHandle, None) is None:
+                return False
+            self.dropped += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def expire(self):
+        '''
+        Log out the logins no caller uses that stayed idle for longer than
+        idletimeout
+        '''
+        deadline = time.time() - self.idletimeout
+        expired = []
+        self.lock.acquire()
+        try:
+            for vmHandle, entry in self.entries.items():
+                if not entry[2] and entry[1] < deadline:
+                    del self.entries[vmHandle]
+                    expired.append(vmHandle)
+            self.evictions += len(expired)
+        finally:
+            self.lock.release()
+        self._logout(expired)
+
+    def clear(self):
+        '''
+        Log out every login kept
+        '''
+        self.lock.acquire()
+        try:
+            vmHandles = self.entries.keys()
+            self.entries.clear()
+            self.tools.clear()
+        finally:
+            self.lock.release()
+        self._logout(vmHandles)
+
+    def stats(self):
+        return {"hits": self.hits,
+            "misses": self.misses,
+            "logins": self.logins,
+            "dropped": self.dropped,
+            "tools_skipped": self.toolsskipped,
+            "evictions": self.evictions,
+            "size": len(self.entries)}
+
+    def _logout(self, vmHandles):
+        vix = getvixlib()
+        for vmHandle in vmHandles:
+            jobHandle = vix.VixVM_LogoutFromGuest(vmHandle, None, None)
+            err = vix.VixJob_Wait(jobHandle, Vix.VIX_PROPERTY_NONE)
+            vix.Vix_ReleaseHandle(jobHandle)
+            if err != Vix.VIX_OK:
+                logging.warning("VixVM_LogoutFromGuest of an idle login Failed (VixError %d)"%err)
+
+
+class GuestDirCache(object):
+    '''
+    Short lived cache of guest directory listings keyed by (VM handle,
+    directory).  Changes made through Vix drop the listings they touch;
+    changes made by other guest processes show up once TTL runs out.
+    '''
+    # Directory listings kept at most
+    MAX_SIZE = 1024
+    # Seconds a listing is trusted
+    TTL = 5
+
+    def __init__(self, maxsize = MAX_SIZE, ttl = TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, vmHandle, dirpath):
+        key = (vmHandle, self._dirkey(dirpath))
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[1] + self.ttl < time.time():
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    def put(self, vmHandle, dirpath, listing):
+        key = (vmHandle, self._dirkey(dirpath))
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = (listing, time.time())
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def invalidate(self, vmHandle, fulpathinvm):
+        '''
+        Drop the listing of the parent directory of fulpathinvm and every
+        listing at or below fulpathinvm itself
+        '''
+        path = self._dirkey(fulpathinvm)
+        parent = self._dirkey(guestpathmodule(path).dirname(path))
+        # "/" keeps its separator as key, everything is below it
+        stem = path.rstrip("/\\")
+        def match(key):
+            return key[0] == vmHandle and (key[1] == parent or key[1] == path
+                or key[1].startswith(stem + "/") or key[1].startswith(stem + "\\"))
+        self._drop(match)
+
+    def invalidatehandle(self, vmHandle):
+        self._drop(lambda key: key[0] == vmHandle)
+
+    def clear(self):
+        self._drop(lambda key: True)
+
+    def stats(self):
+        return {"hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.entries)}
+
+    def _dirkey(self, dirpath):
+        if guestpathmodule(dirpath) is ntpath:
+            dirpath = dirpath.lower()
+        return dirpath.rstrip("/\\") or dirpath
+
+    def _drop(self, match):
+        self.lock.acquire()
+        try:
+            for key in self.entries.keys():
+                if match(key):
+                    del self.entries[key]
+        finally:
+            self.lock.release()
+
+
+def _getstrings(vix, handle, *propids):
+    '''
+    String properties of a handle, freeing the buffers VIX hands out
+    '''
+    values = [c_void_p() for propid in propids]
+    args = []
+    for propid, value in zip(propids, values):
+        args += [propid, byref(value)]
+    err = vix.Vix_GetProperties(handle, *(args + [Vix.VIX_PROPERTY_NONE]))
+    if err != Vix.VIX_OK:
+        raise VixException("Vix_GetProperties Failed", err)
+    strings = []
+    for value in values:
+        if value.value:
+            strings.append(string_at(value.value))
+            vix.Vix_FreeBuffer(value)
+        else:
+            strings.append(None)
+    return strings
+
+
+class SnapshotNode(object):
+    '''
+    One snapshot of a SnapshotTree
+    '''
+    def __init__(self, handle, name, description, parent):
+        self.handle = handle
+        self.name = name
+        self.description = description
+        self.parent = parent
+        self.children = []
+
+    @property
+    def path(self):
+        '''
+        "root/child/grandchild", as VixVM_GetNamedSnapshot accepts it
+        '''
+        names = []
+        node = self
+        while node is not None:
+            names.append(node.name)
+            node = node.parent
+        return "/".join(reversed(names))
+
+    def __repr__(self):
+        return "<SnapshotNode %s>"%self.path
+
+
+class SnapshotTree(object):
+    '''
+    Snapshot tree of one VM read in a single traversal, with the nodes
+    indexed by name, path and handle and the current snapshot resolved.
+
+    The tree owns a reference on every snapshot handle it holds until the
+    last of its own references is given back by release(); it is created
+    with one, addref() takes another.
+    '''
+    def __init__(self, vmHandle):
+        self.vix = getvixlib()
+        self.vmHandle = vmHandle
+        self.lock = threading.Lock()
+        self.refs = 1
+        self.roots = []
+        self.nodes = []
+        self.byname = {}
+        self.bypath = {}
+        self.byhandle = {}
+        self.current = None
+        try:
+            self._read()
+        except:
+            self.release()
+            raise
+
+    def find(self, name):
+        '''
+        Node of a snapshot name or path, raising VixException when there is
+        no such snapshot or the name is not unique
+        '''
+        node = self.bypath.get(name)
+        if node is not None:
+            return node
+        nodes = self.byname.get(name, [])
+        if not nodes:
+            raise VixException("Snapshot %s not found"%name, Vix.VIX_E_SNAPSHOT_NOTFOUND)
+        if len(nodes) > 1:
+            raise VixException("Snapshot name %s is not unique"%name, Vix.VIX_E_SNAPSHOT_NONUNIQUE_NAME)
+        return nodes[0]
+
+    def addref(self):
+        self.lock.acquire()
+        try:
+            self.refs += 1
+        finally:
+            self.lock.release()
+
+    def release(self):
+        self.lock.acquire()
+        try:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+        finally:
+            self.lock.release()
+        for node in self.nodes:
+            self.vix.Vix_ReleaseHandle(node.handle)
+        self.nodes = []
+        self.roots = []
+        self.byname = {}
+        self.bypath = {}
+        self.byhandle = {}
+        self.current = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def _read(self):
+        num = c_int()
+        err = self.vix.VixVM_GetNumRootSnapshots(self.vmHandle, byref(num))
+        if err != Vix.VIX_OK:
+            raise VixException("VixVM_GetNumRootSnapshots Failed", err)
+        pending = []
+        for i in reversed(range(num.value)):
+            handle = c_int()
+            err = self.vix.VixVM_GetRootSnapshot(self.vmHandle, i, byref(handle))
+            if err != Vix.VIX_OK:
+                raise VixException("VixVM_GetRootSnapshot Failed", err)
+            pending.append((handle.value, None))
+        # depth first, deep snapshot chains would exhaust the recursion limit
+        while pending:
+            handle, parent = pending.pop()
+            node = self._add(handle, parent)
+            err = self.vix.VixSnapshot_GetNumChildren(handle, byref(num))
+            if err != Vix.VIX_OK:
+                raise VixException("VixSnapshot_GetNumChildren Failed", err)
+            for i in reversed(range(num.value)):
+                child = c_int()
+                err = self.vix.VixSnapshot_GetChild(handle, i, byref(child))
+                if err != Vix.VIX_OK:
+                    raise VixException("VixSnapshot_GetChild Failed", err)
+                pending.append((child.value, node))
+        self.current = self._current()
+
+    def _add(self, handle, parent):
+        try:
+            name, description = _getstrings(self.vix, handle,
+                Vix.VIX_PROPERTY_SNAPSHOT_DISPLAYNAME, Vix.VIX_PROPERTY_SNAPSHOT_DESCRIPTION)
+        except VixException:
+            self.vix.Vix_ReleaseHandle(handle)
+            raise
+        node = SnapshotNode(handle, name, description, parent)
+        if parent is None:
+            self.roots.append(node)
+        else:
+            parent.children.append(node)
+        self.nodes.append(node)
+        self.byname.setdefault(name, []).append(node)
+        self.bypath[node.path] = node
+        self.byhandle[handle] = node
+        return node
+
+    def _current(self):
+        '''
+        Node of the current snapshot, found by the path of names up to its root
+        '''
+        handle = c_int()
+        err = self.vix.VixVM_GetCurrentSnapshot(self.vmHandle, byref(handle))
+        if err != Vix.VIX_OK or handle.value == Vix.VIX_INVALID_HANDLE:
+            return None
+        names = []
+        while handle.value != Vix.VIX_INVALID_HANDLE:
+            try:
+                names.append(_getstrings(self.vix, handle.value, Vix.VIX_PROPERTY_SNAPSHOT_DISPLAYNAME)[0])
+                parent = c_int()
+                err = self.vix.VixSnapshot_GetParent(handle.value, byref(parent))
+            finally:
+                self.vix.Vix_ReleaseHandle(handle.value)
+            if err != Vix.VIX_OK:
+                break
+            handle = parent
+        return self.bypath.get("/".join(reversed(names)))
+
+
+class SnapshotTreeCache(object):
+    '''
+    LRU cache of SnapshotTree objects keyed by VM handle.  Creating,
+    reverting and removing snapshots through Vix drops the tree of the VM;
+    changes made by other clients show up once TTL runs out.  The cache
+    holds a reference on each tree and get() hands out one of the
+    caller's own, so a tree dropped meanwhile stays usable until the
+    caller releases it.
+    '''
+    # Trees kept at most
+    MAX_SIZE = 64
+    # Seconds a tree is trusted
+    TTL = 60
+
+    def __init__(self, maxsize = MAX_SIZE, ttl = TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, vmHandle):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(vmHandle, None)
+            if entry is not None and entry[1] + self.ttl < time.time():
+                entry[0].release()
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[vmHandle] = entry
+            self.hits += 1
+            entry[0].addref()
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    def put(self, vmHandle, tree):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(vmHandle, None)
+            if entry is None or entry[0] is not tree:
+                tree.addref()
+                if entry is not None:
+                    entry[0].release()
+            self.entries[vmHandle] = (tree, time.time())
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)[1][0].release()
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def invalidate(self, vmHandle):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(vmHandle, None)
+            if entry is not None:
+                entry[0].release()
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            for tree, created in self.entries.values():
+                tree.release()
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {"hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.entries)}
+
+
+class InventoryDiff(object):
+    '''
+    Changes of the VMs of a host between two inventory refreshes: vmx
+    paths added, removed, and changed between running and not running
+    '''
+    def __init__(self, added = None, removed = None, changed = None):
+        self.added = added or []
+        self.removed = removed or []
+        self.changed = changed or []
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __repr__(self):
+        return "<InventoryDiff +%d -%d ~%d>"%(len(self.added), len(self.removed), len(self.changed))
+
+
+class InventoryCache(object):
+    '''
+    VMs of each host, keyed by (host url, user), with whether they run.
+
+    refresh() lists the host with two FindItems searches, registered and
+    running VMs, which tell the power state without opening any VM, and
+    applies only the differences to the inventory it keeps, handing them
+    back as an InventoryDiff.  Removed VMs are dropped from Vix.vmCache.
+    vms() answers from the inventory until it is TTL seconds old.
+    '''
+    # Seconds an inventory is trusted
+    TTL = 120
+
+    def __init__(self, ttl = TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (url, username): [{vmx path: running}, refreshed at]
+        self.hosts = {}
+        self.hits = 0
+        self.refreshes = 0
+
+    def vms(self, vix):
+        self.lock.acquire()
+        try:
+            entry = self.hosts.get((vix.url, vix.username))
+            if entry is not None and entry[1] + self.ttl >= time.time():
+                self.hits += 1
+                return dict(entry[0])
+        finally:
+            self.lock.release()
+        self.refresh(vix)
+        self.lock.acquire()
+        try:
+            return dict(self.hosts[(vix.url, vix.username)][0])
+        finally:
+            self.lock.release()
+
+    def refresh(self, vix):
+        '''
+        List the host of vix again and return what changed since last time,
+        everything is added on the first refresh
+        '''
+        running = set(vix.find_vms(True))
+        found = dict((vmxpath, vmxpath in running) for vmxpath in vix.find_vms())
+        # started between the two searches
+        for vmxpath in running:
+            found[vmxpath] = True
+        key = (vix.url, vix.username)
+        self.lock.acquire()
+        try:
+            self.refreshes += 1
+            entry = self.hosts.setdefault(key, [{}, 0])
+            vms = entry[0]
+            diff = InventoryDiff(
+                sorted([vmxpath for vmxpath in found if vmxpath not in vms]),
+                sorted([vmxpath for vmxpath in vms if vmxpath not in found]),
+                sorted([vmxpath for vmxpath in found if vmxpath in vms and vms[vmxpath] != found[vmxpath]]))
+            for vmxpath in diff.removed:
+                del vms[vmxpath]
+            for vmxpath in diff.added + diff.changed:
+                vms[vmxpath] = found[vmxpath]
+            entry[1] = time.time()
+        finally:
+            self.lock.release()
+        if vix.vmCache is not None:
+            for vmxpath in diff.removed:
+                vix.vmCache.invalidate(vix.hostHandle, vmxpath)
+        return diff
+
+    def invalidate(self, url, username):
+        self.lock.acquire()
+        try:
+            self.hosts.pop((url, username), None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.hosts.clear()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {"hits": self.hits,
+            "refreshes": self.refreshes,
+            "hosts": len(self.hosts),
+            "vms": sum([len(entry[0]) for entry in self.hosts.values()])}
+
+
+class JobMetrics(object):
+    '''
+    Duration histograms and error counters of VIX jobs, per operation, host
+    and VM.  Set it as Vix.metrics to have every job recorded; snapshot()
+    and prometheus() export what was collected, top() tells which
+    operations and hosts took the most wall-clock time.  Jobs slower than
+    slowcall seconds are logged as they finish.
+    '''
+    # Upper bounds in seconds of the duration histogram buckets
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, buckets = BUCKETS, slowcall = None):
+        self.buckets = tuple(sorted(buckets))
+        self.slowcall = slowcall
+        self.lock = threading.Lock()
+        # (opname, host, vm): [count, seconds, max, bucket counts]
+        self.jobs = {}
+        # (opname, host, vm, error code): count
+        self.errors = {}
+
+    def record(self, opname, host, vm, seconds, err):
+        key = (opname, str(host), str(vm))
+        self.lock.acquire()
+        try:
+            entry = self.jobs.get(key)
+            if entry is None:
+                entry = self.jobs[key] = [0, 0.0, 0.0, [0] * len(self.buckets)]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry[3][i] += 1
+                    break
+            if err != Vix.VIX_OK:
+                errkey = key + (err,)
+                self.errors[errkey] = self.errors.get(errkey, 0) + 1
+        finally:
+            self.lock.release()
+        if self.slowcall is not None and seconds >= self.slowcall:
+            logging.warning("Slow VIX job %s on %s %s: %.3fs (VixError %d)"%(opname, host, vm, seconds, err))
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.jobs.clear()
+            self.errors.clear()
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        '''
+        List of dicts, one per operation, host and VM, ready for json.dumps
+        '''
+        self.lock.acquire()
+        try:
+            jobs = sorted(self.jobs.items())
+            errors = self.errors.items()
+        finally:
+            self.lock.release()
+        result = []
+        for (opname, host, vm), (count, seconds, longest, counts) in jobs:
+            result.append({"op": opname, "host": host, "vm": vm,
+                "count": count, "seconds": seconds, "max": longest,
+                "buckets": dict((str(bound), n) for bound, n in zip(self.buckets, counts)),
+                "errors": dict((str(key[3]), n) for key, n in errors if key[:3] == (opname, host, vm))})
+        return result
+
+    def tojson(self):
+        return json.dumps(self.snapshot(), sort_keys = True)
+
+    def prometheus(self):
+        '''
+        Prometheus text exposition of the histograms and error counters
+        '''
+        lines = ["# HELP pyvix_job_duration_seconds Duration of VIX jobs",
+            "# TYPE pyvix_job_duration_seconds histogram"]
+        entries = self.snapshot()
+        for entry in entries:
+            labels = _promlabels(op = entry["op"], host = entry["host"], vm = entry["vm"])
+            cumulative = 0
+            for bound in self.buckets:
+                cumulative += entry["buckets"][str(bound)]
+                lines.append("pyvix_job_duration_seconds_bucket{%s,le=\"%s\"} %d"%(labels, bound, cumulative))
+            lines.append("pyvix_job_duration_seconds_bucket{%s,le=\"+Inf\"} %d"%(labels, entry["count"]))
+            lines.append("pyvix_job_duration_seconds_sum{%s} %f"%(labels, entry["seconds"]))
+            lines.append("pyvix_job_duration_seconds_count{%s} %d"%(labels, entry["count"]))
+        lines.append("# HELP pyvix_job_errors_total VIX jobs finished with an error, by VixError code")
+        lines.append("# TYPE pyvix_job_errors_total counter")
+        for entry in entries:
+            for code, count in sorted(entry["errors"].items()):
+                lines.append("pyvix_job_errors_total{%s} %d"%(_promlabels(op = entry["op"],
+                    host = entry["host"], vm = entry["vm"], code = code), count))
+        return "\n".join(lines) + "\n"
+
+    def top(self, count = 10, by = ("op", "host")):
+        '''
+        The count groups of jobs that took the most seconds in total, as
+        (seconds, calls, group) tuples; by names the labels grouped on
+        '''
+        groups = {}
+        for entry in self.snapshot():
+            group = tuple(entry[label] for label in by)
+            total = groups.setdefault(group, [0.0, 0])
+            total[0] += entry["seconds"]
+            total[1] += entry["count"]
+        ranked = sorted(((seconds, calls, group) for group, (seconds, calls) in groups.items()), reverse = True)
+        return ranked[:count]
+
+
+class CircuitBreaker(object):
+    '''
+    Breaker of one host: after threshold host failures in a row it opens
+    and jobs on the host fail at once for cooldown seconds, then one job
+    is let through as the probe, closing it again when the host answers.
+    A probe that never reports back is followed by another one after
+    cooldown seconds.
+    '''
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        # when the breaker opened, None while closed
+        self.opened = None
+        self.probing = False
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return "closed"
+        if self.probing or time.time() - self.opened >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def blocked(self):
+        '''
+        Whether allow() would turn a job away, without taking the probe
+        '''
+        return self.opened is not None and time.time() - self.opened < self.cooldown
+
+    def allow(self):
+        '''
+        Whether a job may go, taking the probe when the cooldown is over
+        '''
+        self.lock.acquire()
+        try:
+            if self.opened is None:
+                return True
+            if time.time() - self.opened < self.cooldown:
+                return False
+            # the probe, the next one goes a cooldown later at the earliest
+            self.opened = time.time()
+            self.probing = True
+            return True
+        finally:
+            self.lock.release()
+
+    def success(self):
+        self.lock.acquire()
+        try:
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+        finally:
+            self.lock.release()
+
+    def failure(self):
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            if self.probing or (self.opened is None and self.failures >= self.threshold):
+                if self.opened is None:
+                    self.trips += 1
+                self.opened = time.time()
+                self.probing = False
+        finally:
+            self.lock.release()
+
+
+class JobPolicy(object):
+    '''
+    How jobs are waited for, set as Vix.jobPolicy.
+
+    Errors are told apart as retryable, those of RETRYABLE_ERRORS, and
+    fatal, all others.  Jobs started through _startjob are started again
+    after a retryable error, up to retries times, backing off exponentially
+    from backoff seconds up to maxbackoff, less a random part of up to
+    jitter of it so that workers do not retry in step.  deadlines maps
+    opnames to the seconds their jobs are waited for, deadline is the
+    default; a job running longer is abandoned and fails with
+    DEADLINE_EXCEEDED, VIX having no way to cancel it.  Each host has a
+    CircuitBreaker counting its connection errors and abandoned jobs;
+    while it is open, jobs on the host fail with BREAKER_OPEN before they
+    are started, and once its cooldown is over admit() lets exactly one
+    through as the probe.  Vix asks admit() before every job it starts,
+    AsyncVix before every job it submits.
+    '''
+    RETRYABLE_ERRORS = frozenset([
+        Vix.VIX_E_OBJECT_IS_BUSY,
+        Vix.VIX_E_FILE_ALREADY_LOCKED,
+        Vix.VIX_E_TIMEOUT_WAITING_FOR_TOOLS,
+        Vix.VIX_E_TOOLS_NOT_RUNNING,
+        Vix.VIX_E_CANNOT_CONNECT_TO_VM,
+        Vix.VIX_E_HOST_NOT_CONNECTED,
+        Vix.VIX_E_HOST_TCP_SOCKET_ERROR,
+        Vix.VIX_E_HOST_TCP_CONN_LOST,
+        Vix.VIX_E_CANNOT_CONNECT_TO_HOST,
+    ])
+    # Errors telling the host itself is in trouble, counted by its breaker
+    HOST_ERRORS = frozenset(HostPool.CONNECTION_ERRORS)
+    # Codes of the policy's own, above the 16 bits of VIX error codes so no
+    # job fails with them by itself; not connection errors either, Open
+    # must not reconnect to a host given up on
+    DEADLINE_EXCEEDED = 0x10001
+    BREAKER_OPEN = 0x10002
+    # Bounds in seconds of the completion polls of jobs with a deadline
+    POLL_MIN = 0.001
+    POLL_MAX = 0.05
+
+    def __init__(self, retries = 2, backoff = 0.5, maxbackoff = 30, jitter = 0.5,
+            deadlines = None, deadline = None, threshold = 5, cooldown = 30,
+            retryable = RETRYABLE_ERRORS):
+        self.retries = retries
+        self.backoffbase = backoff
+        self.maxbackoff = maxbackoff
+        self.jitter = jitter
+        self.deadlines = dict(deadlines or {})
+        self.deadline = deadline
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.retryableErrors = frozenset(retryable)
+        self.lock = threading.Lock()
+        # host: CircuitBreaker
+        self.breakers = {}
+        self.abandoned = 0
+        self.rejected = 0
+        # heap of [until, id, fn or None] called by the expiring thread
+        self.expiring = threading.Condition()
+        self.expiries = []
+        self._expiryids = itertools.count()
+        self._expirer = None
+
+    def retryable(self, err):
+        return err in self.retryableErrors
+
+    def backoff(self, attempt):
+        '''
+        Seconds to wait before the try after attempt, counted from 0
+        '''
+        delay = min(self.maxbackoff, self.backoffbase * (2 ** attempt))
+        return delay * (1 - self.jitter * random.random())
+
+    def breaker(self, host):
+        self.lock.acquire()
+        try:
+            breaker = self.breakers.get(str(host))
+            if breaker is None:
+                breaker = self.breakers[str(host)] = CircuitBreaker(self.threshold, self.cooldown)
+            return breaker
+        finally:
+            self.lock.release()
+
+    def admit(self, host):
+        '''
+        Whether a job may be started on the host; the job admitted while
+        the breaker is half-open is its probe, and must report through
+        wait() or record()
+        '''
+        if not self.breaker(host).allow():
+            self._reject()
+            return False
+        return True
+
+    def until(self, opname, started):
+        '''
+        When a job of opname begun at started is abandoned, None for never
+        '''
+        deadline = self.deadlines.get(opname, self.deadline)
+        if deadline is None:
+            return None
+        return started + deadline
+
+    def record(self, host, err):
+        '''
+        Count the outcome of a job admitted on the host into its breaker
+        '''
+        breaker = self.breaker(host)
+        if err == self.DEADLINE_EXCEEDED:
+            self.lock.acquire()
+            self.abandoned += 1
+            self.lock.release()
+            breaker.failure()
+        elif err in self.HOST_ERRORS:
+            breaker.failure()
+        else:
+            breaker.success()
+
+    def _reject(self):
+        self.lock.acquire()
+        self.rejected += 1
+        self.lock.release()
+
+    def wait(self, vix, opname, jobHandle, properties, started = None):
+        '''
+        Wait for a job of vix as VixJob_Wait would, within the deadline of
+        opname counted from started, now by default, and count the outcome
+        into the breaker of the host
+        '''
+        if started is None:
+            started = time.time()
+        until = self.until(opname, started)
+        if until is not None and not self._complete(vix, jobHandle, until):
+            logging.error("%s on %s abandoned after %.1fs"%(opname, vix.url, until - started))
+            err = self.DEADLINE_EXCEEDED
+        else:
+            err = vix.vix.VixJob_Wait(jobHandle, *(properties + (Vix.VIX_PROPERTY_NONE,)))
+        self.record(vix.url, err)
+        return err
+
+    def expire(self, until, fn):
+        '''
+        Have fn() called at until by the expiring thread, for the deadlines
+        of jobs nobody waits on; returns the entry for disarm()
+        '''
+        entry = [until, self._expiryids.next(), fn]
+        self.expiring.acquire()
+        try:
+            heapq.heappush(self.expiries, entry)
+            if self._expirer is None:
+                self._expirer = threading.Thread(target = self._expire, name = "vix-job-deadlines")
+                self._expirer.setDaemon(True)
+                self._expirer.start()
+            self.expiring.notify()
+        finally:
+            self.expiring.release()
+        return entry
+
+    def disarm(self, entry):
+        entry[2] = None
+
+    def _expire(self):
+        self.expiring.acquire()
+        try:
+            while True:
+                if not self.expiries:
+                    self.expiring.wait()
+                    continue
+                until, i, fn = self.expiries[0]
+                now = time.time()
+                if fn is not None and until > now:
+                    self.expiring.wait(until - now)
+                    continue
+                heapq.heappop(self.expiries)
+                if fn is None:
+                    continue
+                self.expiring.release()
+                try:
+                    fn()
+                except Exception, e:
+                    logging.error(e)
+                finally:
+                    self.expiring.acquire()
+        finally:
+            self.expiring.release()
+
+    def _complete(self, vix, jobHandle, until):
+        complete = c_byte(0)
+        interval = self.POLL_MIN
+        while True:
+            err = vix.vix.VixJob_CheckCompletion(jobHandle, byref(complete))
+            if err != Vix.VIX_OK or complete.value:
+                # VixJob_Wait reports the error, if any
+                return True
+            remaining = until - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, self.POLL_MAX)
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {"abandoned": self.abandoned,
+                "rejected": self.rejected,
+                "breakers": dict((host, {"state": breaker.state, "failures": breaker.failures,
+                    "trips": breaker.trips}) for host, breaker in self.breakers.items())}
+        finally:
+            self.lock.release()
+
 
+def _promlabels(**labels):
+    return ",".join("%s=\"%s\""%(name, value.replace("\\", "\\\\").replace("\"", "\\\""))
+        for name, value in sorted(labels.items()))
@@ -0,0 +1,278 @@
+# -*- coding:utf-8 -*-
+'''
+Admission of VIX jobs by rate per host and VM, fairly across tenants.
+
+Set a JobScheduler as Vix.jobScheduler and every guest operation of Vix,
+and every job of AsyncVix, waits for its turn before it is started.  A
+job is let through once the token bucket of its host and the one of its
+VM both have a token, so bursts are smoothed to the rate the host copes
+with and no single VM hogs it.  Among the jobs that could go, the one
+with the earliest virtual finish time goes first, weighted fair queuing
+over the tenants, Vix.tenant of the submitting Vix, so one tenant's
+burst only delays that tenant's own jobs.
+
+    Vix.jobScheduler = JobScheduler(hostrate = 20, vmrate = 5, weights = {"ci": 3, "adhoc": 1})
+    vix.tenant = "ci"
+
+stats() gives the queue depth, jobs let through and time waited per
+tenant, and the jobs let through per host.  close() fails the jobs still
+queued with VIX_E_CANCELLED.
+'''
+
+import time
+import logging
+import threading
+from collections import deque
+
+from pyvix import Vix, VixException
+
+# Jobs per second started on one host, and the bursts allowed above it
+HOST_RATE = 20
+HOST_BURST = 40
+# Jobs per second started on one VM, and the bursts allowed above it
+VM_RATE = 5
+VM_BURST = 10
+# Tenant of jobs of a Vix without one
+DEFAULT_TENANT = "default"
+
+
+class TokenBucket(object):
+    '''
+    rate tokens a second, up to burst of them; rate None lets everything
+    through.  Not locked, JobScheduler guards its buckets.
+    '''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+
+    def _refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(float(self.burst), self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now):
+        '''
+        Seconds until a token is there, 0 when there is one already
+        '''
+        if self.rate is None:
+            return 0.0
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate is not None:
+            self._refill(now)
+            self.tokens -= 1
+
+
+class _Entry(object):
+    __slots__ = ("start", "finish", "tenant", "host", "vm", "run", "abort", "queued", "cancelled")
+
+    def __init__(self, start, finish, tenant, host, vm, run, abort, queued):
+        self.start = start
+        self.finish = finish
+        self.tenant = tenant
+        self.host = host
+        self.vm = vm
+        self.run = run
+        self.abort = abort
+        self.queued = queued
+        self.cancelled = False
+
+
+class JobScheduler(object):
+    '''
+    Queues of jobs per tenant, let through by one dispatching thread.
+    hostrates maps hosts to (rate, burst) of their own, weights maps
+    tenants to their share, 1 for tenants not in it.
+    '''
+    def __init__(self, hostrate = HOST_RATE, hostburst = HOST_BURST, vmrate = VM_RATE, vmburst = VM_BURST,
+            weights = None, hostrates = None):
+        self.hostrate = hostrate
+        self.hostburst = hostburst
+        self.vmrate = vmrate
+        self.vmburst = vmburst
+        self.weights = dict(weights or {})
+        self.hostrates = dict(hostrates or {})
+        self.cond = threading.Condition()
+        # tenant: deque of _Entry in submission order
+        self.queues = {}
+        # tenant: virtual finish time of its last queued job
+        self.lastfinish = {}
+        self.vtime = 0.0
+        # host: TokenBucket, (host, vm): TokenBucket
+        self.hostbuckets = {}
+        self.vmbuckets = {}
+        self.closed = False
+        self._thread = None
+        # tenant: [queued, most queued, let through, seconds waited, longest wait]
+        self.tenants = {}
+        # host: jobs let through
+        self.hosts = {}
+
+    def submit(self, tenant, host, vm, run, abort = None):
+        '''
+        Queue a job, run() is called from the dispatching thread when it
+        may start, abort(exception) instead should close() come first; vm
+        is any key of the VM, None for host-wide jobs.  Returns a handle
+        for cancel().
+        '''
+        if tenant is None:
+            tenant = DEFAULT_TENANT
+        self.cond.acquire()
+        try:
+            if self.closed:
+                raise VixException("Job scheduler closed", Vix.VIX_E_CANCELLED)
+            start = max(self.vtime, self.lastfinish.get(tenant, 0.0))
+            finish = start + 1.0 / self.weights.get(tenant, 1)
+            self.lastfinish[tenant] = finish
+            entry = _Entry(start, finish, tenant, host, vm, run, abort, time.time())
+            self.queues.setdefault(tenant, deque()).append(entry)
+            counts = self.tenants.setdefault(tenant, [0, 0, 0, 0.0, 0.0])
+            counts[0] += 1
+            counts[1] = max(counts[1], counts[0])
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._dispatch, name = "vix-job-scheduler")
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self.cond.notify()
+            return entry
+        finally:
+            self.cond.release()
+
+    def cancel(self, entry):
+        '''
+        Drop a queued job, False when it was let through already
+        '''
+        self.cond.acquire()
+        try:
+            queue = self.queues.get(entry.tenant)
+            if entry.cancelled or queue is None or entry not in queue:
+                return False
+            queue.remove(entry)
+            entry.cancelled = True
+            self.tenants[entry.tenant][0] -= 1
+            return True
+        finally:
+            self.cond.release()
+
+    def wait(self, tenant, host, vm, timeout = None):
+        '''
+        Block until a job may start, False when timeout ran out first;
+        raises VixException when the scheduler is closed before
+        '''
+        admitted = threading.Event()
+        aborted = []
+        def abort(exception):
+            aborted.append(exception)
+            admitted.set()
+        entry = self.submit(tenant, host, vm, admitted.set, abort)
+        if not admitted.wait(timeout):
+            if self.cancel(entry):
+                return False
+            # let through or failed meanwhile, either is told right away
+            admitted.wait()
+        if aborted:
+            raise aborted[0]
+        return True
+
+    def close(self):
+        '''
+        Stop dispatching and fail the jobs still queued, through their
+        abort; later submits raise VixException
+        '''
+        self.cond.acquire()
+        try:
+            self.closed = True
+            entries = []
+            for tenant, queue in self.queues.items():
+                for entry in queue:
+                    entry.cancelled = True
+                    entries.append(entry)
+                queue.clear()
+                self.tenants[tenant][0] = 0
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        for entry in entries:
+            if entry.abort is None:
+                continue
+            try:
+                entry.abort(VixException("Job scheduler closed", Vix.VIX_E_CANCELLED))
+            except Exception, e:
+                logging.error(e)
+
+    def stats(self):
+        self.cond.acquire()
+        try:
+            return {"queued": sum([len(queue) for queue in self.queues.values()]),
+                "tenants": dict((tenant, {"queued": queued, "max_queued": most, "started": started,
+                    "wait_seconds": waited, "max_wait_seconds": longest})
+                    for tenant, (queued, most, started, waited, longest) in self.tenants.items()),
+                "hosts": dict(self.hosts)}
+        finally:
+            self.cond.release()
+
+    def _buckets(self, entry):
+        bucket = self.hostbuckets.get(entry.host)
+        if bucket is None:
+            rate, burst = self.hostrates.get(entry.host, (self.hostrate, self.hostburst))
+            bucket = self.hostbuckets[entry.host] = TokenBucket(rate, burst)
+        if entry.vm is None:
+            return (bucket,)
+        vmbucket = self.vmbuckets.get((entry.host, entry.vm))
+        if vmbucket is None:
+            vmbucket = self.vmbuckets[(entry.host, entry.vm)] = TokenBucket(self.vmrate, self.vmburst)
+        return (bucket, vmbucket)
+
+    def _pick(self, now):
+        '''
+        The job to let through next and None, or None and the seconds until
+        one may go, None when nothing is queued
+        '''
+        best = None
+        soonest = None
+        for queue in self.queues.values():
+            # the first job of the tenant its buckets let through
+            for entry in queue:
+                delay = max([bucket.delay(now) for bucket in self._buckets(entry)])
+                if not delay:
+                    if best is None or (entry.finish, entry.start) < (best.finish, best.start):
+                        best = entry
+                    break
+                if soonest is None or delay < soonest:
+                    soonest = delay
+        return best, soonest
+
+    def _dispatch(self):
+        self.cond.acquire()
+        try:
+            while not self.closed:
+                now = time.time()
+                entry, delay = self._pick(now)
+                if entry is None:
+                    self.cond.wait(delay)
+                    continue
+                self.queues[entry.tenant].remove(entry)
+                for bucket in self._buckets(entry):
+                    bucket.take(now)
+                self.vtime = max(self.vtime, entry.start)
+                counts = self.tenants[entry.tenant]
+                counts[0] -= 1
+                counts[2] += 1
+                counts[3] += now - entry.queued
+                counts[4] = max(counts[4], now - entry.queued)
+                self.hosts[entry.host] = self.hosts.get(entry.host, 0) + 1
+                self.cond.release()
+                try:
+                    entry.run()
+                except Exception, e:
+                    logging.error(e)
+                finally:
+                    self.cond.acquire()
+        finally:
+            self.cond.release()
@@ -0,0 +1,320 @@
+# -*- coding:utf-8 -*-
+'''
+Directory tree sync between host and guest.
+
+A manifest per (VM, guest directory) remembers the MD5 of every file last
+synced, so only changed files are copied.  Missing directories are made by
+one guest script, small files are packed into one tar archive copied and
+unpacked with a single job, and larger files are copied by concurrent
+AsyncVix jobs.  Unchanged local files are not even hashed again: the
+manifest also keeps their size and mtime.
+
+Listing, packing and unpacking in the guest runs through a POSIX shell
+(find, md5sum, tar), so the guest must provide those tools.
+'''
+
+import os
+import json
+import Queue
+import hashlib
+import logging
+import tarfile
+import tempfile
+import posixpath
+
+from pyvix import Vix, VixException, GUEST_TMP
+from asyncvix import AsyncVix
+from transfer import md5file, shellquote, STATE_DIR, PARALLEL
+
+# Files up to this size go into the packed archive
+PACK_LIMIT = 256 * 1024
+
+
+def _guestrel(rel):
+    '''
+    rel as listed by the guest, normalised; a path leaving the synced
+    directory is refused, the guest is not trusted with the host's files
+    '''
+    norm = posixpath.normpath(rel)
+    if (norm in (".", "..") or norm.startswith("../") or posixpath.isabs(norm)
+            or "\\" in norm or ":" in norm.split("/")[0]):
+        raise VixException("Guest path %r leaves the synced directory"%rel, Vix.VIX_E_FILE_NAME_INVALID)
+    return norm
+
+
+def sync_to_guest(vix, local_dir, guest_dir, **kwargs):
+    '''
+    Push the files of local_dir changed since the last sync into guest_dir,
+    returning the relative paths copied
+    '''
+    return DirectorySync(vix, **kwargs).to_guest(local_dir, guest_dir)
+
+def sync_from_guest(vix, guest_dir, local_dir, **kwargs):
+    '''
+    Fetch the files of guest_dir that differ from local_dir, returning the
+    relative paths copied
+    '''
+    return DirectorySync(vix, **kwargs).from_guest(guest_dir, local_dir)
+
+
+class DirectorySync(object):
+    '''
+    Syncs directory trees of the VM opened by a logged in Vix
+    '''
+    def __init__(self, vix, pack = True, packlimit = PACK_LIMIT, parallel = PARALLEL,
+            delete = False, interpreter = "/bin/sh", statedir = STATE_DIR):
+        self.vix = vix
+        self.av = AsyncVix(vix)
+        self.pack = pack
+        self.packlimit = packlimit
+        self.parallel = parallel
+        self.delete = delete
+        self.interpreter = interpreter
+        self.statedir = os.path.join(statedir, "sync")
+
+    def to_guest(self, local_dir, guest_dir):
+        manifest = self._load("to", local_dir, guest_dir)
+        local = self._scan(local_dir, manifest)
+        synced = manifest["synced"]
+        changed = sorted(rel for rel, (size, mtime, md5) in local.items() if synced.get(rel) != md5)
+        deleted = sorted(rel for rel in synced if rel not in local)
+
+        dirs = set(self._localdirs(local_dir)) - set(manifest["dirs"])
+        for rel in changed:
+            dirs.add(posixpath.dirname(rel))
+        dirs.discard("")
+        if dirs:
+            self._run("mkdir -p %s\n"%" ".join(shellquote(posixpath.join(guest_dir, rel))
+                for rel in sorted(dirs)))
+
+        packed, single = self._partition(changed, dict((rel, local[rel][0]) for rel in changed))
+        archive = None
+        script = []
+        copies = [(os.path.join(local_dir, *rel.split("/")), posixpath.join(guest_dir, rel))
+            for rel in single]
+        if packed:
+            archive = self._pack(local_dir, packed)
+            archiveinvm = posixpath.join(GUEST_TMP, "guest-" + os.path.basename(archive))
+            copies.append((archive, archiveinvm))
+            script.append("tar -xf %s -C %s && rm -f %s"%(shellquote(archiveinvm),
+                shellquote(guest_dir), shellquote(archiveinvm)))
+        try:
+            self._copyall([lambda src = src, dst = dst: self.av.cphost2vm(src, dst)
+                for src, dst in copies])
+        finally:
+            if archive is not None:
+                os.remove(archive)
+        if self.delete and deleted:
+            script.append("rm -f %s"%" ".join(shellquote(posixpath.join(guest_dir, rel))
+                for rel in deleted))
+        if script:
+            self._run(" && ".join(script) + "\n")
+
+        for rel in changed:
+            synced[rel] = local[rel][2]
+        if self.delete:
+            for rel in deleted:
+                del synced[rel]
+        manifest["local"] = local
+        manifest["dirs"] = self._localdirs(local_dir)
+        self._save(manifest)
+        return changed
+
+    def from_guest(self, guest_dir, local_dir):
+        manifest = self._load("from", local_dir, guest_dir)
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+        local = self._scan(local_dir, manifest)
+        guest, sizes = self._guestscan(guest_dir)
+        changed = sorted(rel for rel, md5 in guest.items()
+            if rel not in local or local[rel][2] != md5)
+        deleted = sorted(rel for rel in local if rel not in guest)
+
+        for rel in changed:
+            parent = os.path.join(local_dir, *rel.split("/")[:-1])
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+        packed, single = self._partition(changed, sizes)
+        copies = [(posixpath.join(guest_dir, rel), os.path.join(local_dir, *rel.split("/")))
+            for rel in single]
+        archive = None
+        if packed:
+            fd, archive = tempfile.mkstemp(".tar", "pyvix-sync-")
+            os.close(fd)
+            archiveinvm = posixpath.join(GUEST_TMP, "guest-" + os.path.basename(archive))
+            self._run("tar -cf %s -C %s %s\n"%(shellquote(archiveinvm), shellquote(guest_dir),
+                " ".join(shellquote(rel) for rel in packed)))
+            copies.append((archiveinvm, archive))
+        try:
+            self._copyall([lambda src = src, dst = dst: self.av.cpvm2host(src, dst)
+                for src, dst in copies])
+            if archive is not None:
+                self._run("rm -f %s\n"%shellquote(archiveinvm))
+                tar = tarfile.open(archive)
+                try:
+                    tar.extractall(local_dir, self._members(tar, packed))
+                finally:
+                    tar.close()
+        finally:
+            if archive is not None:
+                os.remove(archive)
+        if self.delete:
+            for rel in deleted:
+                os.remove(os.path.join(local_dir, *rel.split("/")))
+                del local[rel]
+
+        for rel in changed:
+            st = os.stat(os.path.join(local_dir, *rel.split("/")))
+            local[rel] = [st.st_size, int(st.st_mtime), guest[rel]]
+        manifest["local"] = local
+        manifest["synced"] = dict(guest)
+        self._save(manifest)
+        return changed
+
+    def _load(self, direction, local_dir, guest_dir):
+        key = "|".join([direction, str(self.vix.url), str(self.vix.vmfolder),
+            os.path.abspath(local_dir), guest_dir])
+        manifestpath = os.path.join(self.statedir, hashlib.md5(key).hexdigest() + ".json")
+        manifest = {"local": {}, "synced": {}, "dirs": []}
+        if os.path.exists(manifestpath):
+            f = open(manifestpath, "r")
+            try:
+                manifest.update(json.load(f))
+            except ValueError, e:
+                logging.error("Unreadable manifest %s: %s"%(manifestpath, e))
+            f.close()
+        manifest["path"] = manifestpath
+        return manifest
+
+    def _save(self, manifest):
+        manifestpath = manifest.pop("path")
+        if not os.path.isdir(self.statedir):
+            os.makedirs(self.statedir)
+        f = open(manifestpath + ".tmp", "w")
+        try:
+            json.dump(manifest, f)
+        finally:
+            f.close()
+        if os.path.exists(manifestpath):
+            os.remove(manifestpath)
+        os.rename(manifestpath + ".tmp", manifestpath)
+
+    def _scan(self, local_dir, manifest):
+        '''
+        {relpath: [size, mtime, md5]} of the local tree, hashing only the
+        files whose size or mtime moved since the manifest was written
+        '''
+        known = manifest["local"]
+        local = {}
+        for root, dirs, files in os.walk(local_dir):
+            for name in files:
+                filepath = os.path.join(root, name)
+                rel = os.path.relpath(filepath, local_dir).replace(os.sep, "/")
+                st = os.stat(filepath)
+                entry = known.get(rel)
+                if entry is None or entry[0] != st.st_size or entry[1] != int(st.st_mtime):
+                    entry = [st.st_size, int(st.st_mtime), md5file(filepath)]
+                local[rel] = entry
+        return local
+
+    def _localdirs(self, local_dir):
+        dirs = []
+        for root, subdirs, files in os.walk(local_dir):
+            for name in subdirs:
+                dirs.append(os.path.relpath(os.path.join(root, name), local_dir).replace(os.sep, "/"))
+        return sorted(dirs)
+
+    def _guestscan(self, guest_dir):
+        '''
+        ({relpath: md5}, {relpath: size}) of the guest tree, in one script
+        and one copy
+        '''
+        listing = posixpath.join(GUEST_TMP, "pyvix-sync-%s.lst"%hashlib.md5(guest_dir).hexdigest())
+        self._run(("cd %s && find . -type f -exec md5sum {} + > %s && "
+            "find . -type f -exec wc -c {} + | grep -v ' total$' >> %s\n")%(
+            shellquote(guest_dir), shellquote(listing), shellquote(listing)))
+        fd, localpath = tempfile.mkstemp(".lst", "pyvix-sync-")
+        os.close(fd)
+        try:
+            if not self.vix.cpvm2host(listing, localpath):
+                raise VixException("Fetching %s failed"%listing, Vix.VIX_E_FILE_ERROR)
+            f = open(localpath, "r")
+            try:
+                lines = f.read().splitlines()
+            finally:
+                f.close()
+        finally:
+            os.remove(localpath)
+        self.vix.rmfileinvm(listing)
+        guest = {}
+        sizes = {}
+        for line in lines:
+            value, rel = line.strip().split(None, 1)
+            rel = _guestrel(rel.lstrip("*")[2:])
+            if len(value) == 32:
+                guest[rel] = value
+            else:
+                sizes[rel] = int(value)
+        return guest, sizes
+
+    def _members(self, tar, rels):
+        '''
+        The members of a packed archive from the guest, which must be
+        the regular files asked for, each once
+        '''
+        wanted = set(rels)
+        members = tar.getmembers()
+        for member in members:
+            if not member.isfile() or _guestrel(member.name) not in wanted:
+                raise VixException("Unexpected member %r in %s"%(member.name, tar.name), Vix.VIX_E_FILE_ERROR)
+            wanted.remove(_guestrel(member.name))
+        return members
+
+    def _partition(self, changed, sizes):
+        if not self.pack:
+            return [], list(changed)
+        packed = [rel for rel in changed if sizes.get(rel, 0) <= self.packlimit]
+        single = [rel for rel in changed if sizes.get(rel, 0) > self.packlimit]
+        return packed, single
+
+    def _pack(self, local_dir, rels):
+        fd, archive = tempfile.mkstemp(".tar", "pyvix-sync-")
+        os.close(fd)
+        tar = tarfile.open(archive, "w")
+        try:
+            for rel in rels:
+                tar.add(os.path.join(local_dir, *rel.split("/")), rel)
+        finally:
+            tar.close()
+        return archive
+
+    def _copyall(self, copies):
+        '''
+        Run the copy jobs, self.parallel at a time
+        '''
+        pending = list(copies)
+        finished = Queue.Queue()
+        inflight = 0
+        error = None
+        while pending or inflight:
+            while pending and error is None and inflight < self.parallel:
+                pending.pop(0)().add_done_callback(finished.put)
+                inflight += 1
+            if not inflight:
+                break
+            future = finished.get()
+            inflight -= 1
+            if future.exception() is not None:
+                logging.error("%s"%future.exception())
+                error = future.exception()
+        if error is not None:
+            raise error
+
+    def _run(self, script):
+        '''
+        Run a script in the guest, raising VixException unless it exits 0,
+        so a failed mkdir or unpack is never recorded as synced
+        '''
+        result = self.vix.exec_in_guest(script.rstrip("\n"), self.interpreter, capture = False)
+        if not result.ok:
+            raise VixException("Guest script exited %d: %s"%(result.exitcode, script.strip()), Vix.VIX_E_FAIL)
@@ -0,0 +1,245 @@
+# -*- coding:utf-8 -*-
+'''
+Tests of the pymodule packages, run against the in-process libvix of
+fakevix from the pymodule directory:
+
+    python -m unittest discover -s tests -t .
+
+AsyncVix binds its poller to the first library it sees, so every test of
+a run shares the one fake getfake() installs; FakeTestCase puts back the
+process-wide settings of Vix and the fake a test changed.
+'''
+
+import os
+import time
+import shlex
+import hashlib
+import fnmatch
+import logging
+import tarfile
+import posixpath
+import unittest
+from cStringIO import StringIO
+
+from pyvix import Vix
+
+# Settings of Vix shared by every instance, which tests switch on and off
+SETTINGS = ["hostPool", "vmCache", "dirCache", "snapshotCache", "metrics", "inventoryCache",
+    "jobPolicy", "jobScheduler", "tenant", "guestSessions"]
+
+RUNNING = Vix.VIX_POWERSTATE_POWERED_ON | Vix.VIX_POWERSTATE_TOOLS_RUNNING
+
+_fake = None
+_nextvm = [0]
+
+
+def getfake():
+    '''
+    The FakeVixLib all tests run against, installed on first use
+    '''
+    global _fake
+    if _fake is None:
+        import fakevix
+        logging.basicConfig(level = logging.CRITICAL)
+        _fake = fakevix.install()
+    return _fake
+
+
+def vmxpath(name):
+    '''
+    Path of a VM no other test uses
+    '''
+    _nextvm[0] += 1
+    return "[ds1] %s%d/%s%d.vmx"%(name, _nextvm[0], name, _nextvm[0])
+
+
+def waitfor(predicate, timeout = 2):
+    '''
+    Poll predicate until it holds or timeout seconds passed, its last value
+    '''
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+class FakeTestCase(unittest.TestCase):
+    '''
+    Test on the shared fake, with the settings of Vix, the failures, the
+    latencies and the script hook of the fake put back afterwards
+    '''
+    def setUp(self):
+        self.fake = getfake()
+        self.settings = dict((name, getattr(Vix, name)) for name in SETTINGS)
+        self.latencies = dict(self.fake.latencies)
+        self.latency = self.fake.latency
+
+    def tearDown(self):
+        for name, value in self.settings.items():
+            setattr(Vix, name, value)
+        self.fake.clearfailures()
+        self.fake.scripthook = None
+        self.fake.latencies = self.latencies
+        self.fake.latency = self.latency
+
+    def connect(self, *vmxpaths, **kwargs):
+        '''
+        A Vix connected to the fake host, the VMs of vmxpaths added in the
+        powerstate given; the last one is opened
+        '''
+        powerstate = kwargs.get("powerstate", Vix.VIX_POWERSTATE_POWERED_OFF)
+        for path in vmxpaths:
+            self.fake.addvm(path, powerstate)
+        vix = Vix()
+        vix.Connect("fakehost", 0, "root", "")
+        for path in vmxpaths:
+            vix.Open(path)
+        return vix
+
+    def guest(self, name = "guest", shell = None):
+        '''
+        A Vix logged into a running VM of its own, whose scripts run in
+        shell, a GuestShell by default
+        '''
+        path = vmxpath(name)
+        vix = self.connect(path, powerstate = RUNNING)
+        vix.vmuser, vix.vmpassword = "root", "pw"
+        self.assertTrue(vix.loginvm())
+        self.fake.scripthook = shell or GuestShell()
+        return vix, self.fake.vms[path]
+
+    def handles(self):
+        return self.fake.stats()["handles"]
+
+    def calls(self, name):
+        return self.fake.stats()["calls"].get(name, 0)
+
+
+class GuestShell(object):
+    '''
+    scripthook of the fake running the few shell commands sync and
+    transfer hand the guest on the files of the simulated VM: cd, mkdir
+    -p, rm, tar, find, md5sum, wc, cut, grep, cat, split and ls.
+    exitcodes makes a command fail with the exit code given, as
+    {"tar": 2}.
+    '''
+    def __init__(self, exitcodes = None):
+        self.exitcodes = dict(exitcodes or {})
+
+    def __call__(self, vm, interpreter, text):
+        cwd = "/"
+        for line in text.splitlines():
+            for command in line.split(" && "):
+                words = shlex.split(command)
+                if not words:
+                    continue
+                if words[0] == "cd":
+                    cwd = self._path(cwd, words[1])
+                    continue
+                code = self._pipeline(vm, cwd, words)
+                if code:
+                    return code
+        return 0
+
+    def _path(self, cwd, path):
+        return posixpath.normpath(posixpath.join(cwd, path))
+
+    def _pipeline(self, vm, cwd, words):
+        redirect = None
+        if len(words) > 2 and words[-2] in (">", ">>"):
+            redirect = words[-2:]
+            words = words[:-2]
+        output = ""
+        while words:
+            if "|" in words:
+                command, words = words[:words.index("|")], words[words.index("|") + 1:]
+            else:
+                command, words = words, []
+            code = self.exitcodes.get(command[0], 0)
+            if code:
+                return code
+            output = getattr(self, "_" + command[0])(vm, cwd, command[1:], output)
+        if redirect is not None:
+            path = self._path(cwd, redirect[1])
+            if redirect[0] == ">>":
+                output = vm.files.get(path, "") + output
+            vm.files[path] = output
+        return 0
+
+    def _files(self, vm, cwd, pattern):
+        return sorted(path for path in vm.files if fnmatch.fnmatch(path, self._path(cwd, pattern)))
+
+    def _mkdir(self, vm, cwd, args, stdin):
+        for arg in args[1:]:
+            path = self._path(cwd, arg)
+            while path not in vm.dirs:
+                vm.dirs.add(path)
+                path = posixpath.dirname(path)
+        return ""
+
+    def _rm(self, vm, cwd, args, stdin):
+        for arg in args[1:]:
+            path = self._path(cwd, arg)
+            vm.files.pop(path, None)
+            if "r" in args[0]:
+                prefix = path + "/"
+                vm.dirs = set(name for name in vm.dirs if name != path and not name.startswith(prefix))
+                vm.files = dict(item for item in vm.files.items() if not item[0].startswith(prefix))
+        return ""
+
+    def _tar(self, vm, cwd, args, stdin):
+        archive = self._path(cwd, args[1])
+        directory = self._path(cwd, args[3])
+        if args[0] == "-xf":
+            tar = tarfile.open(fileobj = StringIO(vm.files[archive]))
+            for member in tar.getmembers():
+                path = self._path(directory, member.name)
+                self._mkdir(vm, "/", ["-p", posixpath.dirname(path)], "")
+                vm.files[path] = tar.extractfile(member).read()
+            return ""
+        buf = StringIO()
+        tar = tarfile.open(fileobj = buf, mode = "w")
+        for rel in args[4:]:
+            data = vm.files[self._path(directory, rel)]
+            info = tarfile.TarInfo(rel)
+            info.size = len(data)
+            tar.addfile(info, StringIO(data))
+        tar.close()
+        vm.files[archive] = buf.getvalue()
+        return ""
+
+    def _find(self, vm, cwd, args, stdin):
+        tool = args[args.index("-exec") + 1]
+        rels = ["./" + path[len(cwd) + 1:] for path in sorted(vm.files) if path.startswith(cwd + "/")]
+        if tool == "md5sum":
+            return "".join("%s  %s\n"%(hashlib.md5(vm.files[self._path(cwd, rel)]).hexdigest(), rel)
+                for rel in rels)
+        lines = ["%d %s\n"%(len(vm.files[self._path(cwd, rel)]), rel) for rel in rels]
+        return "".join(lines) + "%d total\n"%sum(len(data) for data in vm.files.values())
+
+    def _md5sum(self, vm, cwd, args, stdin):
+        return "%s  %s\n"%(hashlib.md5(vm.files[self._path(cwd, args[0])]).hexdigest(), args[0])
+
+    def _cut(self, vm, cwd, args, stdin):
+        return "".join(line.split(" ")[0] + "\n" for line in stdin.splitlines())
+
+    def _grep(self, vm, cwd, args, stdin):
+        if args[0] == "-v":
+            return "".join(line + "\n" for line in stdin.splitlines() if not line.endswith(" total"))
+        return "%d\n"%len([line for line in stdin.splitlines() if line.startswith("part")])
+
+    def _cat(self, vm, cwd, args, stdin):
+        return "".join(vm.files[path] for arg in args for path in self._files(vm, cwd, arg))
+
+    def _split(self, vm, cwd, args, stdin):
+        size = int(args[args.index("-b") + 1])
+        data = vm.files[self._path(cwd, args[-2])]
+        prefix = self._path(cwd, args[-1])
+        for index, offset in enumerate(range(0, len(data), size)):
+            vm.files[prefix + "%05d"%index] = data[offset:offset + size]
+        return ""
+
+    def _ls(self, vm, cwd, args, stdin):
+        path = self._path(cwd, args[0])
+        return "".join(posixpath.basename(name) + "\n" for name in sorted(vm.files)
+            if posixpath.dirname(name) == path)
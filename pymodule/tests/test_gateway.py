@@ -0,0 +1,121 @@
+# -*- coding:utf-8 -*-
+'''
+Sessions of the gateway, through vmmclient connections of both protocols
+'''
+
+import time
+import threading
+import unittest
+
+import gateway
+import fakevix
+import pyvix
+from pyvix import Vix
+from vmmclient import DaemonConnection, DaemonError
+from tests import FakeTestCase, RUNNING, vmxpath, waitfor
+
+
+class GatewayTestCase(FakeTestCase):
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.gateway = gateway.Gateway(("127.0.0.1", 0), 4)
+        thread = threading.Thread(target = self.gateway.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.path = vmxpath("gw")
+        self.vm = self.fake.addvm(self.path, RUNNING)
+        self.connections = []
+
+    def tearDown(self):
+        for conn in self.connections:
+            conn.quit()
+        self.gateway.shutdown()
+        FakeTestCase.tearDown(self)
+
+    def session(self, proto = 2):
+        conn = DaemonConnection(self.gateway.address, proto = proto)
+        self.connections.append(conn)
+        conn.command("connect;fakehost;root;pw")
+        conn.command("open;%s"%self.path)
+        return conn
+
+    def code(self, conn, command):
+        try:
+            return conn.command(command, timeout = 5).code
+        except DaemonError, e:
+            return e.code
+
+    def test_framed(self):
+        conn = self.session()
+        self.assertEqual(conn.command("test").code, 0)
+        self.assertEqual(self.code(conn, "login;root;pw"), 0)
+        # arguments holding ';' make it through frames
+        self.vm.files["/opt/a;b"] = "semicolon"
+        self.assertEqual(conn.call("fetch", "/opt/a;b").result(5).data, "semicolon")
+        futures = [conn.submit("powerstate") for i in range(10)]
+        self.assertEqual(set(future.result(5).text for future in futures), set(["4"]))
+
+    def test_fetch(self):
+        data = "\x7fELF" + "\0" * 1000 + "end" + "\0" * 600
+        self.vm.files["/opt/blob"] = data
+        for proto in (1, 2):
+            conn = self.session(proto)
+            conn.command("login;root;pw")
+            self.assertEqual(conn.command("fetch;/opt/blob").data, data)
+
+    def test_login_in_use(self):
+        # a handle holds one guest login, another user waits for it
+        alice, bob, carol = self.session(), self.session(), self.session()
+        self.assertEqual(self.code(alice, "login;alice;pw"), 0)
+        self.assertEqual(self.code(carol, "login;alice;pw"), 0)
+        self.assertEqual(self.code(bob, "login;bob;pw"), gateway.VE_011)
+        self.assertEqual(self.code(alice, "logout"), 0)
+        self.assertEqual(self.code(bob, "login;bob;pw"), gateway.VE_011)
+        self.assertEqual(self.code(carol, "logout"), 0)
+        self.assertEqual(self.code(bob, "login;bob;pw"), 0)
+
+    def test_snapshot_ids(self):
+        # a session deletes no snapshot it was not told the id of
+        vix = Vix()
+        vix.Connect("fakehost", 0, "root", "pw")
+        vix.Open(self.path)
+        vix.CreateSnapshot("s1")
+        vix.CreateSnapshot("s2")
+        vix.vix.Vix_ReleaseHandle(vix.snapshotHandle)
+        a, b = self.session(), self.session()
+        ida = a.command("getnamess;s1").fields()[0]
+        idb = b.command("getnamess;s2").fields()[0]
+        self.assertEqual(self.code(a, "delssid;%s"%idb), gateway.VE_015)
+        self.assertEqual(self.code(a, "delssid;%s"%ida), 0)
+        self.assertEqual(self.code(a, "delssid;%s"%ida), gateway.VE_015)
+        vix.Disconnect()
+
+    def test_snapshot_ids_concurrent(self):
+        # getnamess of one client side by side takes one reference, given
+        # back when the client leaves
+        Vix.snapshotCache = pyvix.SnapshotTreeCache()
+        vix = Vix()
+        vix.Connect("fakehost", 0, "root", "pw")
+        vix.Open(self.path)
+        vix.CreateSnapshot("s1")
+        vix.vix.Vix_ReleaseHandle(vix.snapshotHandle)
+        conn = self.session()
+        # widen the window between finding the handle unknown and keeping it
+        addref = vix.vix.Vix_AddRefHandle
+        def slowaddref(handle):
+            time.sleep(0.01)
+            return addref(handle)
+        vix.vix.Vix_AddRefHandle = slowaddref
+        self.addCleanup(setattr, vix.vix, "Vix_AddRefHandle", addref)
+        futures = [conn.submit("getnamess;s1") for i in range(8)]
+        ids = set(int(future.result(5).fields()[0]) for future in futures)
+        conn.quit()
+        self.connections.remove(conn)
+        Vix.snapshotCache.clear()
+        self.assertTrue(waitfor(lambda: [self.fake._get(snapshotHandle, fakevix.FakeSnapshot)
+            for snapshotHandle in ids] == [None] * len(ids)))
+        vix.Disconnect()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+# -*- coding:utf-8 -*-
+'''
+Guest logins kept by GuestSessionCache
+'''
+
+import copy
+import time
+import unittest
+
+import asyncvix
+from pyvix import Vix, GuestSessionCache
+from tests import FakeTestCase, RUNNING, vmxpath
+
+
+class GuestSessionCacheTestCase(FakeTestCase):
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        Vix.guestSessions = self.sessions = GuestSessionCache(idletimeout = 0.05)
+        self.vix = self.connect(vmxpath("login"), powerstate = RUNNING)
+        self.vix.vmuser, self.vix.vmpassword = "root", "pw"
+        self.handle = self.vix.vmHandle
+
+    def tearDown(self):
+        self.vix.Disconnect()
+        FakeTestCase.tearDown(self)
+
+    def users(self):
+        entry = self.sessions.entries.get(self.handle)
+        return entry and entry[2]
+
+    def expire(self):
+        time.sleep(0.06)
+        self.sessions.expire()
+
+    def test_hit(self):
+        logins = self.calls("VixVM_LoginInGuest")
+        waits = self.calls("VixVM_WaitForToolsInGuest")
+        self.assertTrue(self.vix.loginvm())
+        self.assertTrue(self.vix.loginvm())
+        self.assertEqual(self.calls("VixVM_LoginInGuest") - logins, 1)
+        self.assertEqual(self.calls("VixVM_WaitForToolsInGuest") - waits, 1)
+        self.assertEqual((self.sessions.hits, self.sessions.misses), (1, 1))
+        self.assertEqual(self.users(), 2)
+
+    def test_expire(self):
+        # a login is only logged out once every caller is done with it
+        logouts = self.calls("VixVM_LogoutFromGuest")
+        self.vix.loginvm()
+        self.vix.loginvm()
+        self.vix.logoutvm()
+        self.expire()
+        self.assertEqual(self.users(), 1)
+        self.vix.logoutvm()
+        self.assertEqual(self.calls("VixVM_LogoutFromGuest"), logouts)
+        self.expire()
+        self.assertEqual(self.users(), None)
+        self.assertEqual(self.calls("VixVM_LogoutFromGuest") - logouts, 1)
+
+    def test_tools_gone(self):
+        # a login the tools lost is made again, waiting for them this time
+        self.vix.loginvm()
+        self.vix.logoutvm()
+        self.sessions.invalidate(self.handle)
+        self.sessions.tools[self.handle] = time.time()
+        self.fake.fail("VixVM_LoginInGuest", Vix.VIX_E_TOOLS_NOT_RUNNING, count = 1)
+        waits = self.calls("VixVM_WaitForToolsInGuest")
+        self.assertTrue(self.vix.loginvm())
+        self.assertEqual(self.calls("VixVM_WaitForToolsInGuest") - waits, 1)
+
+    def test_async(self):
+        # an AsyncVix login is kept unused, power offs forget it
+        av = asyncvix.AsyncVix(self.vix)
+        self.assertEqual(av.loginvm("root", "pw").exception(2), None)
+        self.assertEqual(self.users(), 0)
+        logins = self.calls("VixVM_LoginInGuest")
+        self.assertTrue(self.vix.loginvm())
+        self.assertEqual(self.calls("VixVM_LoginInGuest"), logins)
+        self.vix.logoutvm()
+        self.assertEqual(av.PowerOff().exception(2), None)
+        time.sleep(0.05)
+        self.assertEqual(self.users(), None)
+
+    def test_other_user(self):
+        # a handle holds one login, another user waits until it is unused
+        self.vix.loginvm()
+        other = copy.copy(self.vix)
+        other.vmuser, other.vmpassword = "guest", "pw"
+        logins = self.calls("VixVM_LoginInGuest")
+        self.assertFalse(other.loginvm())
+        error = asyncvix.AsyncVix(other).loginvm("guest", "pw").exception(2)
+        self.assertEqual(error.errorCode, Vix.VIX_E_OBJECT_IS_BUSY)
+        self.assertEqual(self.calls("VixVM_LoginInGuest"), logins)
+        self.assertEqual(self.sessions.entries[self.handle][0], ("root", "pw"))
+        # the first user's logout keeps its own login
+        logouts = self.calls("VixVM_LogoutFromGuest")
+        self.assertTrue(self.vix.logoutvm())
+        self.assertEqual(self.calls("VixVM_LogoutFromGuest"), logouts)
+        self.assertTrue(other.loginvm())
+        self.assertEqual(self.sessions.entries[self.handle][0:3:2], [("guest", "pw"), 1])
+
+    def test_failed_login(self):
+        # a login that failed leaves nothing behind for the next caller
+        self.fake.fail("VixVM_LoginInGuest", Vix.VIX_E_GUEST_USER_PERMISSIONS, count = 1)
+        self.assertFalse(self.vix.loginvm())
+        self.assertEqual(self.users(), None)
+        self.assertTrue(self.vix.loginvm())
+        self.assertEqual(self.users(), 1)
+
+    def test_eviction(self):
+        # only logins beyond maxsize no caller uses are logged out
+        sessions = GuestSessionCache(maxsize = 64)
+        sessions._logout = lambda vmHandles: self.assertEqual(vmHandles, [])
+        for handle in range(40):
+            sessions.put(handle, "root", "pw", inuse = False)
+        self.assertEqual((len(sessions.entries), sessions.evictions), (40, 0))
+        sessions.maxsize = 2
+        sessions.get(0, "root", "pw")
+        evicted = []
+        sessions._logout = evicted.extend
+        sessions.put(40, "root", "pw")
+        self.assertEqual(evicted, range(1, 40))
+        self.assertEqual(sorted(sessions.entries), [0, 40])
+
+
+if __name__ == "__main__":
+    unittest.main()
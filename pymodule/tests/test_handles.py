@@ -0,0 +1,134 @@
+# -*- coding:utf-8 -*-
+'''
+Every handle pyvix and the batch modules take is given back, with and
+without the VM handle cache
+'''
+
+import unittest
+
+import pyvix
+from pyvix import Vix
+
+import fleet
+import fakevix
+import clonefarm
+import warmpool
+from tests import FakeTestCase, vmxpath, waitfor
+
+
+class HandleTestCase(FakeTestCase):
+    cache = None
+
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        Vix.vmCache = self.cache and pyvix.VMHandleCache(maxsize = 2)
+        self.base = self.handles()
+
+    def leaked(self, *vixes):
+        '''
+        Handles alive besides the hosts of vixes once they closed their VMs
+        and Vix.vmCache is emptied, then disconnect; disconnecting would
+        free them
+        '''
+        if Vix.vmCache is not None:
+            Vix.vmCache.clear()
+        for vix in vixes:
+            vix.CloseVM()
+        leaked = self.handles() - self.base - len(vixes)
+        for vix in vixes:
+            vix.Disconnect()
+        return leaked
+
+    def snapshot(self, vix, name):
+        vix.CreateSnapshot(name)
+        vix.vix.Vix_ReleaseHandle(vix.snapshotHandle)
+
+    def test_cache(self):
+        # a Vix keeps using its VM after the cache evicted it, and nothing
+        # is left once the Vix and the cache let go
+        paths = [vmxpath("c") for i in range(3)]
+        a = self.connect(paths[0])
+        b = self.connect(*paths[1:])
+        a.Open(paths[0])
+        self.assertTrue(a.poweronvm())
+        self.assertFalse(None in a.power_states(paths + paths[:1]).values())
+        self.assertEqual(self.leaked(a, b), 0)
+
+    def test_fleet(self):
+        paths = [vmxpath("f") for i in range(4)]
+        vix = self.connect()
+        for path in paths:
+            self.fake.addvm(path)
+            vix.Open(path)
+            self.snapshot(vix, "base")
+        for results in (fleet.power_on_many(vix, paths), fleet.revert_many(vix, paths),
+                fleet.revert_many(vix, paths, "base", poweron = True), fleet.power_off_many(vix, paths)):
+            for result in results:
+                self.assertTrue(result.ok, result)
+        self.assertEqual(self.leaked(vix), 0)
+
+    def test_clonefarm(self):
+        # nothing but the clones handed to the caller outlives a clone batch
+        gold = vmxpath("gold")
+        vix = self.connect(gold)
+        self.snapshot(vix, "base")
+        for result in clonefarm.clone_many(vix, gold, "base",
+                [vmxpath("k").replace("[ds1]", "[ds%d]"%(i % 2 + 1)) for i in range(6)], poweron = True):
+            self.assertTrue(result.ok, result)
+            vix.vix.Vix_ReleaseHandle(result.vmHandle)
+        self.assertEqual(self.leaked(vix), 0)
+
+    def test_clonefarm_closed(self):
+        # the clones still running when the caller stops are released
+        gold = vmxpath("gold")
+        vix = self.connect(gold)
+        self.snapshot(vix, "base")
+        results = clonefarm.clone_many(vix, gold, "base", [vmxpath("e") for i in range(6)], poweron = True)
+        result = results.next()
+        vix.vix.Vix_ReleaseHandle(result.vmHandle)
+        results.close()
+        self.assertEqual(self.leaked(vix), 0)
+
+    def test_warmpool(self):
+        # a closed pool lets go of its ready VMs and of those released later
+        paths = [vmxpath("w") for i in range(3)]
+        vix = self.connect()
+        for path in paths:
+            self.fake.addvm(path, Vix.VIX_POWERSTATE_POWERED_ON)
+            vix.Open(path)
+            self.snapshot(vix, "clean")
+        pool = warmpool.WarmPool(vix)
+        pool.add("linux", paths, "clean")
+        vm = pool.acquire("linux", timeout = 5)
+        self.assertTrue(waitfor(lambda: pool.stats()["templates"]["linux"][warmpool.READY] == 2))
+        pool.close()
+        pool.release(vm)
+        self.assertEqual(self.leaked(vix), 0)
+
+    def test_snapshot_tree(self):
+        # a borrowed tree outlives its cache entry, and nothing outlives both
+        Vix.snapshotCache = pyvix.SnapshotTreeCache()
+        vix = self.connect(vmxpath("t"))
+        self.snapshot(vix, "base")
+        self.snapshot(vix, "top")
+        tree = vix.GetSnapshotTree()
+        again = vix.GetSnapshotTree()
+        self.assertTrue(again is tree)
+        again.release()
+        vix.snapshotchanged()
+        node = tree.find("base/top")
+        self.assertEqual(self.fake._get(node.handle, fakevix.FakeSnapshot).name, "top")
+        tree.release()
+        self.assertEqual(self.fake._get(node.handle, fakevix.FakeSnapshot), None)
+        vix.RevertToNamedSnapshot("base")
+        vix.GetSnapshotTree().release()
+        Vix.snapshotCache.clear()
+        self.assertEqual(self.leaked(vix), 0)
+
+
+class CachedHandleTestCase(HandleTestCase):
+    cache = True
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding:utf-8 -*-
+'''
+Batches keep within their own limit and within the limit of the host or
+datastore shared by all batches
+'''
+
+import time
+import threading
+import unittest
+
+import fleet
+import clonefarm
+from tests import FakeTestCase, vmxpath
+
+
+class LimitTestCase(FakeTestCase):
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.fake.latency = 0.02
+        self.vix = self.connect()
+
+    def tearDown(self):
+        fleet.sethostlimit(self.vix.url, fleet.HOST_INFLIGHT)
+        clonefarm.setdatastorelimit(self.vix.url, "ds1", clonefarm.DATASTORE_INFLIGHT)
+        self.vix.Disconnect()
+        FakeTestCase.tearDown(self)
+
+    def most(self, slots, results):
+        '''
+        Most slots taken at once while results are drained
+        '''
+        seen = [0]
+        done = threading.Event()
+        def watch():
+            while not done.isSet():
+                seen[0] = max(seen[0], slots.taken)
+                time.sleep(0.001)
+        watcher = threading.Thread(target = watch)
+        watcher.start()
+        try:
+            for result in results:
+                self.assertTrue(result.ok, result)
+        finally:
+            done.set()
+            watcher.join()
+        return seen[0]
+
+    def vms(self, name, count):
+        paths = [vmxpath(name) for i in range(count)]
+        for path in paths:
+            self.fake.addvm(path)
+        return paths
+
+    def test_batch_limit(self):
+        # a later batch with a lower limit than the first keeps to its own
+        slots = fleet.hostslots(self.vix.url)
+        self.assertEqual(self.most(slots, fleet.power_on_many(self.vix, self.vms("a", 6), limit = 6)), 6)
+        self.assertEqual(self.most(slots, fleet.power_on_many(self.vix, self.vms("b", 6), limit = 2)), 2)
+
+    def test_host_limit(self):
+        # the host limit bounds a batch allowed more, and may change later
+        slots = fleet.hostslots(self.vix.url)
+        fleet.sethostlimit(self.vix.url, 3)
+        self.assertEqual(self.most(slots, fleet.power_on_many(self.vix, self.vms("h", 6), limit = 6)), 3)
+        fleet.sethostlimit(self.vix.url, 1)
+        self.assertEqual(self.most(slots, fleet.power_off_many(self.vix, self.vms("i", 4))), 1)
+
+    def test_datastore_limit(self):
+        gold = vmxpath("gold")
+        self.fake.addvm(gold)
+        self.vix.Open(gold)
+        self.vix.CreateSnapshot("base")
+        self.vix.vix.Vix_ReleaseHandle(self.vix.snapshotHandle)
+        slots = clonefarm.datastoreslots(self.vix.url, "ds1")
+        def clones(name, **kwargs):
+            for result in clonefarm.clone_many(self.vix, gold, "base",
+                    [vmxpath(name) for i in range(5)], **kwargs):
+                self.vix.vix.Vix_ReleaseHandle(result.vmHandle)
+                yield result
+        self.assertEqual(self.most(slots, clones("c", limit = 1)), 1)
+        clonefarm.setdatastorelimit(self.vix.url, "ds1", 2)
+        self.assertEqual(self.most(slots, clones("d", limit = 4)), 2)
+        self.vix.CloseVM()
+
+
+if __name__ == "__main__":
+    unittest.main()
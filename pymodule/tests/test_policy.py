@@ -0,0 +1,154 @@
+# -*- coding:utf-8 -*-
+'''
+Retries, deadlines and circuit breakers of JobPolicy
+'''
+
+import time
+import threading
+import unittest
+
+import asyncvix
+from pyvix import Vix, VixException, JobPolicy, CircuitBreaker, HostPool
+from tests import FakeTestCase, vmxpath, waitfor
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def test_threshold(self):
+        breaker = CircuitBreaker(3, 10)
+        for i in range(2):
+            breaker.failure()
+        self.assertEqual(breaker.state, "closed")
+        breaker.success()
+        for i in range(2):
+            breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.trips, 1)
+
+    def test_one_probe(self):
+        breaker = CircuitBreaker(1, 0.05)
+        breaker.failure()
+        time.sleep(0.06)
+        allowed = []
+        threads = [threading.Thread(target = lambda: allowed.append(breaker.allow())) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(allowed.count(True), 1)
+        self.assertEqual(breaker.state, "half-open")
+        # a probe that never reports back is followed by another
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, "closed")
+
+    def test_failed_probe(self):
+        breaker = CircuitBreaker(1, 0.05)
+        breaker.failure()
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertEqual(breaker.trips, 1)
+
+
+class JobPolicyTestCase(FakeTestCase):
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.vix = self.connect(vmxpath("p"))
+
+    def tearDown(self):
+        self.vix.Disconnect()
+        FakeTestCase.tearDown(self)
+
+    def test_codes(self):
+        codes = (JobPolicy.DEADLINE_EXCEEDED, JobPolicy.BREAKER_OPEN)
+        self.assertNotEqual(*codes)
+        for code in codes:
+            self.assertFalse(code in HostPool.CONNECTION_ERRORS)
+            self.assertTrue(code > 0xFFFF)
+
+    def test_retry(self):
+        Vix.jobPolicy = JobPolicy(backoff = 0.01)
+        calls = self.calls("VixVM_PowerOn")
+        self.fake.fail("VixVM_PowerOn", Vix.VIX_E_OBJECT_IS_BUSY, count = 2)
+        self.assertTrue(self.vix.poweronvm())
+        self.assertEqual(self.calls("VixVM_PowerOn") - calls, 3)
+
+    def test_fatal(self):
+        Vix.jobPolicy = JobPolicy(backoff = 0.01)
+        calls = self.calls("VixVM_PowerOn")
+        self.fake.fail("VixVM_PowerOn", Vix.VIX_E_VM_NOT_FOUND, count = 1)
+        self.assertFalse(self.vix.poweronvm())
+        self.assertEqual(self.calls("VixVM_PowerOn") - calls, 1)
+
+    def test_deadline(self):
+        Vix.jobPolicy = policy = JobPolicy(deadlines = {"VixVM_PowerOff": 0.05}, threshold = 1, cooldown = 10)
+        self.fake.latencies["VixVM_PowerOff"] = 0.5
+        started = time.time()
+        self.assertFalse(self.vix.poweroffvm())
+        self.assertTrue(time.time() - started < 0.4)
+        self.assertEqual(policy.stats()["abandoned"], 1)
+        # the host is given up on, nothing is started on it any more
+        calls = dict(self.fake.stats()["calls"])
+        self.assertFalse(self.vix.poweronvm())
+        self.assertFalse(self.vix.registevm(vmxpath("r")))
+        try:
+            self.vix.CreateSnapshot("s")
+            self.fail("CreateSnapshot started with the breaker open")
+        except VixException, e:
+            self.assertEqual(e.errorCode, JobPolicy.BREAKER_OPEN)
+        self.assertEqual(self.fake.stats()["calls"], calls)
+        self.assertEqual(policy.stats()["rejected"], 3)
+
+    def test_find_deadline(self):
+        # a search outliving its timeout or deadline is abandoned, and counts
+        # against the host like any other job
+        self.fake.latencies["VixHost_FindItems"] = 1.3
+        handles = self.handles()
+        for timeout, deadline in ((1, None), (-1, 0.05)):
+            Vix.jobPolicy = policy = JobPolicy(deadlines = {"VixHost_FindItems": deadline},
+                threshold = 1, cooldown = 10)
+            started = time.time()
+            try:
+                list(self.vix.find_vms(timeout = timeout))
+                self.fail("find_vms waited past its deadline")
+            except VixException, e:
+                self.assertEqual(e.errorCode, JobPolicy.DEADLINE_EXCEEDED)
+            self.assertTrue(time.time() - started < max(timeout, deadline) + 0.2)
+            self.assertEqual(policy.stats()["abandoned"], 1)
+        calls = self.calls("VixHost_FindItems")
+        try:
+            list(self.vix.find_vms())
+            self.fail("VixHost_FindItems started with the breaker open")
+        except VixException, e:
+            self.assertEqual(e.errorCode, JobPolicy.BREAKER_OPEN)
+        self.assertEqual(self.calls("VixHost_FindItems"), calls)
+        self.assertTrue(waitfor(lambda: self.handles() == handles))
+
+    def test_async_refused(self):
+        Vix.jobPolicy = policy = JobPolicy(threshold = 1, cooldown = 10)
+        policy.record(self.vix.url, Vix.VIX_E_HOST_NOT_CONNECTED)
+        calls = self.calls("VixVM_PowerOn")
+        error = asyncvix.AsyncVix(self.vix).PowerOn().exception(2)
+        self.assertEqual(error.errorCode, JobPolicy.BREAKER_OPEN)
+        self.assertEqual(self.calls("VixVM_PowerOn"), calls)
+
+    def test_async_deadline(self):
+        # a late result of an abandoned job is released when it comes
+        Vix.jobPolicy = policy = JobPolicy(deadlines = {"VixVM_Open": 0.05})
+        self.fake.latencies["VixVM_Open"] = 0.2
+        path = vmxpath("late")
+        self.fake.addvm(path)
+        handles = self.handles()
+        for poller in (asyncvix.getpoller(), asyncvix.getcallbacks()):
+            error = asyncvix.AsyncVix(self.vix, poller).Open(path).exception(2)
+            self.assertEqual(error.errorCode, JobPolicy.DEADLINE_EXCEEDED)
+        self.assertTrue(waitfor(lambda: policy.stats()["abandoned"] == 2 and self.handles() == handles))
+
+
+if __name__ == "__main__":
+    unittest.main()
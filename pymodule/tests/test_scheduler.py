@@ -0,0 +1,115 @@
+# -*- coding:utf-8 -*-
+'''
+Admission of jobs by JobScheduler
+'''
+
+import time
+import threading
+import unittest
+
+from pyvix import Vix, VixException
+from asyncvix import AsyncVix
+from scheduler import JobScheduler, TokenBucket
+from tests import FakeTestCase, vmxpath, waitfor
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_burst(self):
+        bucket = TokenBucket(10, 2)
+        now = bucket.stamp
+        for i in range(2):
+            self.assertEqual(bucket.delay(now), 0)
+            bucket.take(now)
+        self.assertAlmostEqual(bucket.delay(now), 0.1)
+        self.assertEqual(bucket.delay(now + 0.11), 0)
+
+    def test_unlimited(self):
+        bucket = TokenBucket(None, 0)
+        self.assertEqual(bucket.delay(time.time()), 0)
+
+
+class JobSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = JobScheduler(hostrate = 100, hostburst = 1, vmrate = None)
+        self.started = []
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def submit(self, tenant, count, host = "esx1", vm = None):
+        return [self.scheduler.submit(tenant, host, vm, lambda: self.started.append(tenant))
+            for i in range(count)]
+
+    def test_weighted(self):
+        self.scheduler.weights = {"ci": 3}
+        self.submit("adhoc", 10)
+        self.submit("ci", 10)
+        self.assertTrue(waitfor(lambda: len(self.started) == 20))
+        # after the job that went at once, ci gets three turns to one
+        self.assertTrue(self.started[1:9].count("ci") >= 5, self.started)
+
+    def test_hosts(self):
+        # a busy host does not hold up the jobs of another
+        self.submit("a", 20, "busy")
+        self.submit("a", 1, "idle")
+        self.assertTrue(waitfor(lambda: "a" in self.started and self.scheduler.stats()["hosts"].get("idle")))
+        self.assertTrue(len(self.started) < 20)
+
+    def test_wait(self):
+        self.assertTrue(self.scheduler.wait(None, "esx1", None))
+        self.submit("a", 50)
+        self.assertFalse(self.scheduler.wait(None, "esx1", None, 0.01))
+        self.assertEqual(self.scheduler.stats()["tenants"]["default"]["queued"], 0)
+
+    def test_cancel(self):
+        entries = self.submit("a", 5)
+        self.assertTrue(self.scheduler.cancel(entries[-1]))
+        self.assertFalse(self.scheduler.cancel(entries[-1]))
+        self.assertTrue(waitfor(lambda: len(self.started) == 4))
+        time.sleep(0.05)
+        self.assertEqual(len(self.started), 4)
+        self.assertFalse(self.scheduler.cancel(entries[0]))
+
+    def test_close(self):
+        aborted = []
+        self.scheduler.hostrate = 1
+        for i in range(3):
+            self.scheduler.submit("a", "slow", None, lambda: None, aborted.append)
+        errors = []
+        def wait():
+            try:
+                self.scheduler.wait("a", "slow", None)
+            except VixException, e:
+                errors.append(e.errorCode)
+        waiters = [threading.Thread(target = wait) for i in range(3)]
+        for waiter in waiters:
+            waiter.start()
+        time.sleep(0.05)
+        self.scheduler.close()
+        for waiter in waiters:
+            waiter.join(2)
+        self.assertEqual(errors, [Vix.VIX_E_CANCELLED] * 3)
+        self.assertEqual([e.errorCode for e in aborted], [Vix.VIX_E_CANCELLED] * 2)
+        self.assertEqual(self.scheduler.stats()["queued"], 0)
+        self.assertRaises(VixException, self.scheduler.submit, "a", "slow", None, lambda: None)
+
+
+class ScheduledJobTestCase(FakeTestCase):
+    def test_close(self):
+        # queued AsyncVix jobs fail with the scheduler, later ones run again
+        vix = self.connect(vmxpath("s"))
+        Vix.jobScheduler = scheduler = JobScheduler(hostrate = 2, hostburst = 1)
+        futures = [AsyncVix(vix).PowerOn() for i in range(4)]
+        time.sleep(0.05)
+        scheduler.close()
+        errors = [future.exception(2) for future in futures]
+        self.assertEqual(errors[0], None)
+        self.assertEqual([e.errorCode for e in errors[1:]], [Vix.VIX_E_CANCELLED] * 3)
+        self.assertTrue(isinstance(AsyncVix(vix).PowerOn().exception(1), VixException))
+        Vix.jobScheduler = None
+        self.assertEqual(AsyncVix(vix).PowerOn().exception(1), None)
+        vix.Disconnect()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+# -*- coding:utf-8 -*-
+'''
+Directory sync between the host and the guest of the fake
+'''
+
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import sync
+from pyvix import VixException
+from tests import FakeTestCase, GuestShell
+
+
+def _write(filepath, data):
+    if not os.path.isdir(os.path.dirname(filepath)):
+        os.makedirs(os.path.dirname(filepath))
+    f = open(filepath, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def _read(filepath):
+    f = open(filepath, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+class GuestRelTestCase(unittest.TestCase):
+    def test_normalised(self):
+        self.assertEqual(sync._guestrel("a/b"), "a/b")
+        self.assertEqual(sync._guestrel("./a//b"), "a/b")
+        self.assertEqual(sync._guestrel("a/../b"), "b")
+
+    def test_refused(self):
+        for rel in ("../x", "a/../../x", "/etc/passwd", "C:/x", "a\\..\\..\\x", ".", ".."):
+            self.assertRaises(VixException, sync._guestrel, rel)
+
+
+class MembersTestCase(unittest.TestCase):
+    def archive(self, *members):
+        buf = StringIO()
+        tar = tarfile.open(fileobj = buf, mode = "w")
+        for info in members:
+            tar.addfile(info, StringIO("x" * info.size))
+        tar.close()
+        buf.seek(0)
+        return tarfile.open(fileobj = buf)
+
+    def member(self, name, kind = tarfile.REGTYPE):
+        info = tarfile.TarInfo(name)
+        info.type = kind
+        info.size = kind == tarfile.REGTYPE and 1 or 0
+        if kind == tarfile.SYMTYPE:
+            info.linkname = "/etc/passwd"
+        return info
+
+    def members(self, tar, rels):
+        return sync.DirectorySync.__dict__["_members"](None, tar, rels)
+
+    def test_expected(self):
+        tar = self.archive(self.member("a"), self.member("d/b"))
+        self.assertEqual([m.name for m in self.members(tar, ["a", "d/b"])], ["a", "d/b"])
+
+    def test_unexpected(self):
+        for members in ([self.member("a"), self.member("l", tarfile.SYMTYPE)],
+                [self.member("a"), self.member("a")],
+                [self.member("../a")]):
+            self.assertRaises(VixException, self.members, self.archive(*members), ["a", "l"])
+
+
+class DirectorySyncTestCase(FakeTestCase):
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.vix, self.vm = self.guest("sync")
+        self.tmp = tempfile.mkdtemp(prefix = "pyvix-test-")
+        self.local = os.path.join(self.tmp, "local")
+        self.statedir = os.path.join(self.tmp, "state")
+        _write(os.path.join(self.local, "small.txt"), "small\n")
+        _write(os.path.join(self.local, "sub", "deep", "b.txt"), "b" * 10)
+        _write(os.path.join(self.local, "big.bin"), "\0\1" * 1000)
+
+    def tearDown(self):
+        self.vix.Disconnect()
+        shutil.rmtree(self.tmp, True)
+        FakeTestCase.tearDown(self)
+
+    def sync(self, **kwargs):
+        return sync.DirectorySync(self.vix, packlimit = 100, statedir = self.statedir, **kwargs)
+
+    def test_to_guest(self):
+        self.assertEqual(self.sync().to_guest(self.local, "/srv/app"),
+            ["big.bin", "small.txt", "sub/deep/b.txt"])
+        self.assertEqual(self.vm.files["/srv/app/sub/deep/b.txt"], "b" * 10)
+        self.assertEqual(self.vm.files["/srv/app/big.bin"], "\0\1" * 1000)
+        self.assertFalse([path for path in self.vm.files if path.endswith(".tar")])
+        self.assertEqual(self.sync().to_guest(self.local, "/srv/app"), [])
+        _write(os.path.join(self.local, "small.txt"), "changed\n")
+        self.assertEqual(self.sync().to_guest(self.local, "/srv/app"), ["small.txt"])
+        self.assertEqual(self.vm.files["/srv/app/small.txt"], "changed\n")
+
+    def test_failed_unpack(self):
+        # files the guest failed to unpack are copied again next time
+        self.fake.scripthook = GuestShell({"tar": 2})
+        self.assertRaises(VixException, self.sync().to_guest, self.local, "/srv/app")
+        self.assertFalse("/srv/app/small.txt" in self.vm.files)
+        self.fake.scripthook = GuestShell()
+        self.assertEqual(self.sync().to_guest(self.local, "/srv/app"),
+            ["big.bin", "small.txt", "sub/deep/b.txt"])
+        self.assertEqual(self.vm.files["/srv/app/small.txt"], "small\n")
+
+    def test_failed_mkdir(self):
+        self.fake.scripthook = GuestShell({"mkdir": 1})
+        self.assertRaises(VixException, self.sync().to_guest, self.local, "/srv/app")
+        self.fake.scripthook = GuestShell()
+        self.assertEqual(len(self.sync().to_guest(self.local, "/srv/app")), 3)
+
+    def test_delete(self):
+        self.sync().to_guest(self.local, "/srv/app")
+        os.remove(os.path.join(self.local, "small.txt"))
+        self.sync(delete = True).to_guest(self.local, "/srv/app")
+        self.assertFalse("/srv/app/small.txt" in self.vm.files)
+
+    def test_from_guest(self):
+        self.vm.files["/data/a.txt"] = "a"
+        self.vm.files["/data/x/y.bin"] = "\0" * 300
+        local = os.path.join(self.tmp, "fetched")
+        self.assertEqual(self.sync().from_guest("/data", local), ["a.txt", "x/y.bin"])
+        self.assertEqual(_read(os.path.join(local, "x", "y.bin")), "\0" * 300)
+        self.assertEqual(self.sync().from_guest("/data", local), [])
+        self.vm.files["/data/a.txt"] = "b"
+        self.assertEqual(self.sync().from_guest("/data", local), ["a.txt"])
+        self.assertEqual(_read(os.path.join(local, "a.txt")), "b")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding:utf-8 -*-
+'''
+Chunked transfers between the host and the guest of the fake
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyvix import Vix, VixException, GUEST_TMP
+from transfer import ChunkedTransfer, md5file
+from tests import FakeTestCase, GuestShell
+
+
+class ChunkedTransferTestCase(FakeTestCase):
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.shell = GuestShell()
+        self.vix, self.vm = self.guest("transfer", self.shell)
+        self.tmp = tempfile.mkdtemp(prefix = "pyvix-test-")
+        self.data = "".join(chr(i % 251) for i in range(5000)) + "\0" * 10
+        self.source = os.path.join(self.tmp, "source.bin")
+        f = open(self.source, "wb")
+        f.write(self.data)
+        f.close()
+        self.guestpath = GUEST_TMP + "/target.bin"
+
+    def tearDown(self):
+        self.vix.Disconnect()
+        shutil.rmtree(self.tmp, True)
+        FakeTestCase.tearDown(self)
+
+    def transfer(self):
+        return ChunkedTransfer(self.vix, chunksize = 1024, parallel = 2,
+            statedir = os.path.join(self.tmp, "state"))
+
+    def test_roundtrip(self):
+        self.transfer().put(self.source, self.guestpath)
+        self.assertEqual(self.vm.files[self.guestpath], self.data)
+        self.assertFalse([path for path in self.vm.files if ".parts" in path])
+        target = os.path.join(self.tmp, "target.bin")
+        self.transfer().get(self.guestpath, target)
+        self.assertEqual(md5file(target), md5file(self.source))
+        self.assertFalse(os.listdir(os.path.join(self.tmp, "state")))
+
+    def test_resume(self):
+        # the chunks copied before a failure are not copied again
+        self.shell.exitcodes["cat"] = 1
+        self.assertRaises(VixException, self.transfer().put, self.source, self.guestpath)
+        calls = self.calls("VixVM_CopyFileFromHostToGuest")
+        del self.shell.exitcodes["cat"]
+        self.transfer().put(self.source, self.guestpath)
+        self.assertEqual(self.vm.files[self.guestpath], self.data)
+        self.assertEqual(self.calls("VixVM_CopyFileFromHostToGuest") - calls, 0)
+
+    def test_failed_chunk(self):
+        self.fake.fail("VixVM_CopyFileFromHostToGuest", Vix.VIX_E_FILE_ERROR, count = 1)
+        self.assertRaises(VixException, self.transfer().put, self.source, self.guestpath)
+        calls = self.calls("VixVM_CopyFileFromHostToGuest")
+        self.transfer().put(self.source, self.guestpath)
+        self.assertEqual(self.vm.files[self.guestpath], self.data)
+        self.assertTrue(self.calls("VixVM_CopyFileFromHostToGuest") - calls < 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
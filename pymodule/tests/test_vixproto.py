@@ -0,0 +1,61 @@
+# -*- coding:utf-8 -*-
+'''
+Frames of the version 2 wire format
+'''
+
+import unittest
+
+import vixproto
+from vixproto import REQUEST, REPLY, FLAG_MORE, FLAG_FILE, DATA_CHUNK, FrameReader, ProtocolError
+
+
+class RequestTestCase(unittest.TestCase):
+    def test_roundtrip(self):
+        fields = ["copyto", "a;b", "", "\0" * 3, "x" * 100000]
+        frame = vixproto.encoderequest(7, fields)
+        (reqid,), body = FrameReader(REQUEST).feed(frame)[0]
+        self.assertEqual(reqid, 7)
+        self.assertEqual(vixproto.decodefields(body), fields)
+
+    def test_truncated(self):
+        body = vixproto.encoderequest(1, ["open", "vm"])[REQUEST.size:]
+        self.assertRaises(ProtocolError, vixproto.decodefields, body[:-1])
+        self.assertRaises(ProtocolError, vixproto.decodefields, body[:2])
+
+
+class ReplyTestCase(unittest.TestCase):
+    def frames(self, wire, size = None):
+        reader = FrameReader(REPLY)
+        frames = []
+        size = size or len(wire)
+        for offset in range(0, len(wire), size):
+            frames.extend(reader.feed(wire[offset:offset + size]))
+        self.assertEqual(reader.size, 0)
+        return frames
+
+    def test_text(self):
+        self.assertEqual(self.frames(vixproto.replyframes(3, -2, "no such vm")),
+            [((3, -2, 0), "no such vm")])
+
+    def test_file(self):
+        data = "".join(chr(i % 256) for i in range(DATA_CHUNK * 2 + 10)) + "\0\0"
+        frames = self.frames(vixproto.replyframes(5, 0, data = data))
+        self.assertEqual([flags for (reqid, code, flags), body in frames],
+            [FLAG_MORE, FLAG_MORE, FLAG_MORE, FLAG_FILE])
+        self.assertEqual("".join(body for header, body in frames), data)
+
+    def test_empty_file(self):
+        self.assertEqual(self.frames(vixproto.replyframes(5, 0, data = "")), [((5, 0, FLAG_FILE), "")])
+
+    def test_small_reads(self):
+        wire = vixproto.replyframes(1, 0, "first") + vixproto.replyframes(2, 0, data = "a" * 1000)
+        self.assertEqual(self.frames(wire, 1), self.frames(wire))
+        self.assertEqual(self.frames(wire, 7), self.frames(wire))
+
+    def test_oversized(self):
+        wire = vixproto.replyheader(1, 0, 0, vixproto.MAX_FRAME + 1)
+        self.assertRaises(ProtocolError, FrameReader(REPLY).feed, wire)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding:utf-8 -*-
+'''
+Replies of the legacy daemon protocol as ReplyParser takes them apart
+'''
+
+import unittest
+
+from vmmclient import ReplyParser, DaemonError, MAXPACKLEN, EOF
+
+
+def padded(data):
+    '''
+    File reply of an older daemon, padding its last block with NULs
+    '''
+    return "[0]" + data + "\0" * (-len(data) % MAXPACKLEN) + EOF
+
+
+class ReplyParserTestCase(unittest.TestCase):
+    def parse(self, wire, expected, size = None, parser = None):
+        '''
+        Replies of the commands expected, (filemode, sink) each, fed wire
+        in reads of size bytes
+        '''
+        parser = parser or ReplyParser()
+        for filemode, sink in expected:
+            parser.expect(filemode, sink)
+        replies = []
+        size = size or len(wire)
+        for offset in range(0, len(wire), size):
+            replies.extend(parser.feed(wire[offset:offset + size]))
+        self.assertEqual(len(replies), len(expected))
+        return replies
+
+    def test_text(self):
+        reply, = self.parse("[0]1;poweredOn[EOF]", [(False, None)])
+        self.assertTrue(reply.ok)
+        self.assertEqual(reply.fields(), ["1", "poweredOn"])
+        reply, = self.parse("[-3]no such snapshot[EOF]", [(False, None)])
+        self.assertEqual((reply.code, reply.text), (-3, "no such snapshot"))
+
+    def test_file(self):
+        data = "line\n" * 300
+        reply, = self.parse("[0]" + data + EOF, [(True, None)])
+        self.assertEqual(reply.data, data)
+
+    def test_trailing_nuls(self):
+        # a binary file keeps the NULs it ends in
+        data = "binary\0\0" + "\0" * 1025
+        reply, = self.parse("[0]" + data + EOF, [(True, None)], 100)
+        self.assertEqual(reply.data, data)
+
+    def test_padded(self):
+        data = "x" * 300
+        reply, = self.parse(padded(data), [(True, None)], parser = ReplyParser(True))
+        self.assertEqual(reply.data, data)
+
+    def test_file_error(self):
+        # the daemon could not open its file and answered with text
+        reply, = self.parse("[-7]F:gone[EOF]", [(True, None)])
+        self.assertEqual((reply.code, reply.data), (-7, None))
+        reply, = self.parse(EOF, [(True, None)])
+        self.assertEqual(reply.code, -1)
+
+    def test_byte_by_byte(self):
+        data = "abc[EO" * 50
+        wire = "[0]ok[EOF]" + "[0]" + data + EOF + "[1]failed[EOF]"
+        expected = [(False, None), (True, None), (False, None)]
+        for size in (1, 2, 5, 7):
+            replies = self.parse(wire, expected, size)
+            self.assertEqual([reply.code for reply in replies], [0, 0, 1])
+            self.assertEqual(replies[1].data, data)
+
+    def test_pipelined(self):
+        parser = ReplyParser()
+        parser.expect()
+        parser.expect()
+        replies = parser.feed("[0]a[EOF][0]b")
+        self.assertEqual([reply.text for reply in replies], ["a"])
+        self.assertEqual([reply.text for reply in parser.feed("[EOF]")], ["b"])
+
+    def test_sink(self):
+        pieces = []
+        data = "y" * 5000
+        reply, = self.parse("[0]" + data + EOF, [(True, pieces.append)], 512)
+        self.assertEqual(reply.data, None)
+        self.assertEqual("".join(pieces), data)
+        self.assertTrue(len(pieces) > 1)
+
+    def test_missing_eof(self):
+        parser = ReplyParser()
+        parser.expect()
+        self.assertRaises(DaemonError, parser.feed, "[0]" + "z" * (MAXPACKLEN + 2 * len(EOF)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,245 @@
+# -*- coding:utf-8 -*-
+'''
+Chunked, resumable and verified file transfer between host and guest.
+
+Large files are cut into CHUNK_SIZE pieces which are copied by several
+concurrent guest-operation jobs and joined again on the other side.  The
+chunks already copied are remembered in a manifest under the state
+directory, so running the same transfer again after a failure only
+copies what is missing.  The joined file is checked against an MD5 digest
+computed while streaming the original, the way CID_HPUT checks its copies
+with md5file.
+
+Joining, splitting and digesting in the guest runs through a POSIX shell
+(cat, split, md5sum), so the guest must provide those tools.
+'''
+
+import os
+import json
+import Queue
+import shutil
+import hashlib
+import logging
+import tempfile
+import posixpath
+
+from pyvix import Vix, VixException
+from asyncvix import AsyncVix
+
+# Size of one chunk copied by one guest job
+CHUNK_SIZE = 64 * 1024 * 1024
+# Chunk copies in flight at once
+PARALLEL = 4
+# Where the manifests and chunks of unfinished transfers are kept
+STATE_DIR = os.path.join(tempfile.gettempdir(), "pyvix-transfer")
+
+# Read size while streaming files through the digest
+READ_SIZE = 1024 * 1024
+
+
+def md5file(filepath):
+    '''
+    Streamed MD5 hex digest of a host file
+    '''
+    md5 = hashlib.md5()
+    f = open(filepath, "rb")
+    try:
+        data = f.read(READ_SIZE)
+        while data:
+            md5.update(data)
+            data = f.read(READ_SIZE)
+    finally:
+        f.close()
+    return md5.hexdigest()
+
+
+def shellquote(text):
+    return "'%s'"%text.replace("'", "'\\''")
+
+
+class ChunkedTransfer(object):
+    '''
+    Transfers files of the VM opened by a logged in Vix
+    '''
+    def __init__(self, vix, chunksize = CHUNK_SIZE, parallel = PARALLEL,
+            interpreter = "/bin/sh", statedir = STATE_DIR):
+        self.vix = vix
+        self.av = AsyncVix(vix)
+        self.chunksize = chunksize
+        self.parallel = parallel
+        self.interpreter = interpreter
+        self.statedir = statedir
+
+    def put(self, localfulpath, fulpathinvm):
+        '''
+        Copy a host file into the guest, resuming an interrupted earlier put
+        '''
+        st = os.stat(localfulpath)
+        workdir, manifest = self._manifest("put", localfulpath, fulpathinvm,
+            "%d:%d"%(st.st_size, int(st.st_mtime)))
+        if "md5" not in manifest:
+            manifest["md5"], manifest["chunks"] = self._split(localfulpath, workdir)
+            self._save(workdir, manifest)
+        partsinvm = fulpathinvm + ".parts"
+        self.vix.mkdirinvm(partsinvm)
+        chunks = [("part.%05d"%i) for i in range(manifest["chunks"])]
+        self._copyall(workdir, manifest, chunks, lambda name: self.av.cphost2vm(
+            os.path.join(workdir, name), posixpath.join(partsinvm, name)))
+
+        script = "cat %s/part.* > %s && md5sum %s | cut -d' ' -f1 > %s.md5 && rm -rf %s\n"%(
+            shellquote(partsinvm), shellquote(fulpathinvm), shellquote(fulpathinvm),
+            shellquote(fulpathinvm), shellquote(partsinvm))
+        self._run(script)
+        digest = self._guestdigest(fulpathinvm + ".md5", workdir)
+        if digest != manifest["md5"]:
+            # a chunk got damaged on the way, start over next time
+            shutil.rmtree(workdir, True)
+            raise VixException("md5 mismatch after putting %s"%localfulpath, Vix.VIX_E_FILE_ERROR)
+        shutil.rmtree(workdir, True)
+
+    def get(self, fulpathinvm, localfulpath):
+        '''
+        Copy a guest file to the host, resuming an interrupted earlier get
+        '''
+        workdir, manifest = self._manifest("get", localfulpath, fulpathinvm, "")
+        partsinvm = fulpathinvm + ".parts"
+        if "md5" not in manifest:
+            script = ("rm -rf %s && mkdir -p %s && split -a 5 -d -b %d %s %s/part. && "
+                "md5sum %s | cut -d' ' -f1 > %s/md5 && ls %s | grep -c '^part' >> %s/md5\n")%(
+                shellquote(partsinvm), shellquote(partsinvm), self.chunksize,
+                shellquote(fulpathinvm), shellquote(partsinvm), shellquote(fulpathinvm),
+                shellquote(partsinvm), shellquote(partsinvm), shellquote(partsinvm))
+            self._run(script)
+            lines = self._fetch(posixpath.join(partsinvm, "md5"), workdir).split()
+            manifest["md5"], manifest["chunks"] = lines[0], int(lines[1])
+            self._save(workdir, manifest)
+        chunks = [("part.%05d"%i) for i in range(manifest["chunks"])]
+        self._copyall(workdir, manifest, chunks, lambda name: self.av.cpvm2host(
+            posixpath.join(partsinvm, name), os.path.join(workdir, name)))
+
+        md5 = hashlib.md5()
+        target = open(localfulpath + ".part", "wb")
+        try:
+            for name in chunks:
+                f = open(os.path.join(workdir, name), "rb")
+                try:
+                    data = f.read(READ_SIZE)
+                    while data:
+                        md5.update(data)
+                        target.write(data)
+                        data = f.read(READ_SIZE)
+                finally:
+                    f.close()
+        finally:
+            target.close()
+        if md5.hexdigest() != manifest["md5"]:
+            os.remove(localfulpath + ".part")
+            shutil.rmtree(workdir, True)
+            raise VixException("md5 mismatch after getting %s"%fulpathinvm, Vix.VIX_E_FILE_ERROR)
+        if os.path.exists(localfulpath):
+            os.remove(localfulpath)
+        os.rename(localfulpath + ".part", localfulpath)
+        self._run("rm -rf %s\n"%shellquote(partsinvm))
+        shutil.rmtree(workdir, True)
+
+    def _manifest(self, direction, localfulpath, fulpathinvm, version):
+        key = "|".join([direction, str(self.vix.url), str(self.vix.vmfolder),
+            os.path.abspath(localfulpath), fulpathinvm, version])
+        workdir = os.path.join(self.statedir, hashlib.md5(key).hexdigest())
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        manifest = {"done": []}
+        manifestpath = os.path.join(workdir, "manifest.json")
+        if os.path.exists(manifestpath):
+            f = open(manifestpath, "r")
+            try:
+                manifest = json.load(f)
+            except ValueError, e:
+                logging.error("Unreadable manifest %s: %s"%(manifestpath, e))
+            f.close()
+        return workdir, manifest
+
+    def _save(self, workdir, manifest):
+        manifestpath = os.path.join(workdir, "manifest.json")
+        f = open(manifestpath + ".tmp", "w")
+        try:
+            json.dump(manifest, f)
+        finally:
+            f.close()
+        if os.path.exists(manifestpath):
+            os.remove(manifestpath)
+        os.rename(manifestpath + ".tmp", manifestpath)
+
+    def _split(self, localfulpath, workdir):
+        '''
+        Cut the file into chunk files, digesting it on the same pass
+        '''
+        md5 = hashlib.md5()
+        count = 0
+        source = open(localfulpath, "rb")
+        try:
+            while True:
+                chunk = open(os.path.join(workdir, "part.%05d"%count), "wb")
+                try:
+                    left = self.chunksize
+                    while left > 0:
+                        data = source.read(min(left, READ_SIZE))
+                        if not data:
+                            break
+                        md5.update(data)
+                        chunk.write(data)
+                        left -= len(data)
+                finally:
+                    chunk.close()
+                count += 1
+                if left > 0:
+                    break
+        finally:
+            source.close()
+        return md5.hexdigest(), count
+
+    def _copyall(self, workdir, manifest, chunks, copy):
+        '''
+        Copy the chunks not done yet, PARALLEL at a time, recording each success
+        '''
+        pending = [name for name in chunks if name not in manifest["done"]]
+        finished = Queue.Queue()
+        inflight = 0
+        error = None
+        while pending or inflight:
+            while pending and error is None and inflight < self.parallel:
+                name = pending.pop(0)
+                copy(name).add_done_callback(lambda future, name = name: finished.put((name, future)))
+                inflight += 1
+            if not inflight:
+                break
+            name, future = finished.get()
+            inflight -= 1
+            if future.exception() is not None:
+                logging.error("Copying chunk %s failed: %s"%(name, future.exception()))
+                error = future.exception()
+                continue
+            manifest["done"].append(name)
+            self._save(workdir, manifest)
+        if error is not None:
+            raise error
+
+    def _run(self, script):
+        if not self.vix.runscriptinvm(self.interpreter, script):
+            raise VixException("Guest script failed: %s"%script.strip(), Vix.VIX_E_FAIL)
+
+    def _fetch(self, fulpathinvm, workdir):
+        localfulpath = os.path.join(workdir, "fetched")
+        if not self.vix.cpvm2host(fulpathinvm, localfulpath):
+            raise VixException("Fetching %s failed"%fulpathinvm, Vix.VIX_E_FILE_ERROR)
+        f = open(localfulpath, "r")
+        try:
+            return f.read()
+        finally:
+            f.close()
+            os.remove(localfulpath)
+
+    def _guestdigest(self, md5pathinvm, workdir):
+        digest = self._fetch(md5pathinvm, workdir).strip()
+        self.vix.rmfileinvm(md5pathinvm)
+        return digest
@@ -0,0 +1,136 @@
+# -*- coding:utf-8 -*-
+'''
+Protocol version 2 of the vmmengine wire format.
+
+The legacy format reads one ';' separated command per read() of at most
+MAXPACKLEN bytes and ends replies with an "[EOF]" text, so arguments can not
+hold ';' or be long, and a file holding "[EOF]" cuts its reply short.
+Version 2 uses length-prefixed binary frames instead:
+
+    request:  length, request id (!II), then the command and its arguments,
+              each a !I length followed by that many bytes
+    reply:    length, request id, code, flags (!IIiB), then the body
+
+A text reply is one frame whose body is the text.  A file reply is any
+number of FLAG_MORE frames carrying the data, in pieces of at most
+DATA_CHUNK bytes, then an empty FLAG_FILE frame.  Replies carry the id of
+their request, so a server may answer requests in any order and interleave
+the frames of different replies.
+
+A legacy connection switches by sending the command "proto;2".  The
+gateway answers "[0]2[EOF]" and both sides speak version 2 from the next
+byte on; vmmengine does not know the command and answers "[0][EOF]", and
+the connection stays legacy.
+'''
+
+import struct
+
+# Protocol version negotiated with NEGOTIATE
+VERSION = 2
+NEGOTIATE = "proto;%d"%VERSION
+
+# Frame headers, both start with the length of the body that follows
+REQUEST = struct.Struct("!II")
+REPLY = struct.Struct("!IIiB")
+FIELD = struct.Struct("!I")
+
+# Reply flags
+FLAG_MORE = 1   # a piece of file data, more frames of the reply follow
+FLAG_FILE = 2   # last frame of a file reply
+
+# Largest frame body accepted
+MAX_FRAME = 64 * 1024 * 1024
+# Bytes of file data per reply frame
+DATA_CHUNK = 256 * 1024
+
+
+class ProtocolError(Exception):
+    '''
+    Raised for frames that can not be parsed
+    '''
+    pass
+
+
+def encoderequest(reqid, fields):
+    '''
+    Request frame of a command and its arguments
+    '''
+    body = "".join([FIELD.pack(len(field)) + field for field in fields])
+    return REQUEST.pack(len(body), reqid) + body
+
+
+def decodefields(body):
+    '''
+    Command and arguments of a request frame body
+    '''
+    fields = []
+    pos = 0
+    while pos < len(body):
+        if pos + FIELD.size > len(body):
+            raise ProtocolError("Truncated field header")
+        length = FIELD.unpack_from(body, pos)[0]
+        pos += FIELD.size
+        if pos + length > len(body):
+            raise ProtocolError("Truncated field")
+        fields.append(body[pos:pos + length])
+        pos += length
+    return fields
+
+
+def replyheader(reqid, code, flags, length):
+    return REPLY.pack(length, reqid, code, flags)
+
+
+def replyframe(reqid, code, flags = 0, body = ""):
+    return REPLY.pack(len(body), reqid, code, flags) + body
+
+
+def replyframes(reqid, code, text = "", data = None):
+    '''
+    Frames of a whole reply, a file reply when data is not None
+    '''
+    if data is None:
+        return replyframe(reqid, code, 0, text)
+    frames = [replyframe(reqid, code, FLAG_MORE, data[offset:offset + DATA_CHUNK])
+        for offset in range(0, len(data), DATA_CHUNK)]
+    frames.append(replyframe(reqid, code, FLAG_FILE))
+    return "".join(frames)
+
+
+class FrameReader(object):
+    '''
+    Incremental splitter of a byte stream into (header fields, body)
+    frames, the header fields without the leading length.  The pieces of
+    a frame are only joined once it is all there, so a large frame coming
+    in small reads is copied a bounded number of times, not once per read.
+    '''
+    def __init__(self, header):
+        self.header = header
+        self.chunks = []
+        self.size = 0
+        # bytes it takes to get on: a header, or the frame it starts
+        self.need = header.size
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size < self.need:
+            return []
+        buf = "".join(self.chunks)
+        pos = 0
+        frames = []
+        self.need = self.header.size
+        while len(buf) - pos >= self.header.size:
+            fields = self.header.unpack_from(buf, pos)
+            if fields[0] > MAX_FRAME:
+                raise ProtocolError("Frame of %d bytes"%fields[0])
+            end = pos + self.header.size + fields[0]
+            if len(buf) < end:
+                self.need = end - pos
+                break
+            frames.append((fields[1:], buf[pos + self.header.size:end]))
+            pos = end
+        rest = buf[pos:]
+        self.chunks = rest and [rest] or []
+        self.size = len(rest)
+        return frames
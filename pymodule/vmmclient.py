@@ -0,0 +1,648 @@
+# -*- coding:utf-8 -*-
+'''
+Client of the vmmengine daemon.
+
+vmmengine takes one ';' separated command per read() and answers
+"[code]text" followed by "[EOF]".  Commands answering "F:<tmpfile>"
+(listguests, dir, sslist, and fetch of the gateway) have the file streamed
+instead: "[0]", the content at its exact length, then "[EOF]".  Older
+daemons padded the last MAXPACKLEN block of the content with NULs; with
+padded = True, for those only, trailing NULs of the content are dropped.
+
+Connections are asyncore dispatchers driven by one DaemonLoop thread, so
+a single process can keep many daemon sessions busy.  Every command
+returns an asyncvix.JobFuture.  ReplyParser reads the replies
+incrementally: text replies are bounded by MAXPACKLEN, and file replies
+are handed to a sink or to stream() as they arrive, never joined more than
+once.  A file reply ends at the first "[EOF]", so files holding that text
+can not be fetched this way.
+
+The daemon keeps no buffer of its own between reads and takes whatever
+one read() returns as one command, so commands are sent as NUL padded
+MAXPACKLEN records, one at a time: with more of them on the way, TCP is
+free to hand a read() a record and a half.
+
+A connection made with proto=2 asks for the framed protocol of vixproto
+first.  Where the server agrees (the gateway does, vmmengine does not and
+the connection stays as above), commands go out as frames: call() takes
+arguments holding ';' or of any length, up to FRAMED_DEPTH commands are in
+flight, and replies are matched to their commands by request id, in
+whatever order they come.
+
+    pool = DaemonPool(("127.0.0.1", 4564))
+    conn = pool.acquire("esx1", "root", "secret")
+    conn.command("open;[ds] vm1/vm1.vmx")
+    futures = [conn.submit("poweron"), conn.submit("powerstate")]
+    listing = conn.command("listguests").data
+    pool.release(conn)
+'''
+
+import os
+import re
+import time
+import Queue
+import socket
+import asyncore
+import logging
+import threading
+from collections import deque
+
+import vixproto
+from asyncvix import JobFuture
+
+# Size of the daemon's read and write buffers, see config.h
+MAXPACKLEN = 256
+# Trailer of every reply
+EOF = "[EOF]"
+# Commands whose "F:" reply is streamed as a file
+FILE_COMMANDS = ("listguests", "dir", "sslist", "fetch")
+# Commands in flight at once on a connection without frames, see above
+PIPELINE_DEPTH = 1
+# Commands in flight at once on a connection speaking the framed protocol
+FRAMED_DEPTH = 32
+# Bytes read from the socket at once
+RECV_SIZE = 64 * 1024
+
+_REPLY = re.compile(r"\[(-?\d+)\](.*)$", re.S)
+
+
+class DaemonError(Exception):
+    '''
+    Raised when the daemon answers with a VE_* code other than VE_000, or
+    the connection is lost
+    '''
+    def __init__(self, message, code = None):
+        if code is not None:
+            message = "%s (VE %d)"%(message, code)
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class DaemonReply(object):
+    '''
+    Answer to one command: its code, the text after it and, for streamed
+    file replies without a sink, the file content
+    '''
+    def __init__(self, code, text = "", data = None):
+        self.code = code
+        self.text = text
+        self.data = data
+
+    @property
+    def ok(self):
+        return self.code == 0
+
+    def fields(self):
+        return self.text.split(";")
+
+    def __repr__(self):
+        if self.data is not None:
+            return "<DaemonReply [%d] %d bytes>"%(self.code, len(self.data))
+        return "<DaemonReply [%d]%s>"%(self.code, self.text)
+
+
+def _handon(sink, blocks, data):
+    '''
+    Give a piece of a streamed file to the sink, or keep it in blocks
+    '''
+    if not data:
+        return
+    if sink is None:
+        blocks.append(data)
+    elif hasattr(sink, "write"):
+        sink.write(data)
+    else:
+        sink(data)
+
+
+def _commandline(fields):
+    '''
+    Request line of a command and its arguments, ValueError when the
+    daemon could not take them apart again
+    '''
+    line = ";".join(fields)
+    if len(line) >= MAXPACKLEN or "\0" in line:
+        raise ValueError("Command longer than %d bytes: %s"%(MAXPACKLEN - 1, line[:32]))
+    if [field for field in fields if ";" in field]:
+        raise ValueError("Argument holding ';': %s"%line[:32])
+    return line
+
+
+class ReplyParser(object):
+    '''
+    Incremental parser of the replies on one connection.  expect() is
+    called once per command sent, in order; feed() takes whatever the
+    socket returned and gives back the replies completed by it.  padded
+    drops the NULs older daemons padded file replies with, and so any the
+    file ended in.
+    '''
+    def __init__(self, padded = False):
+        self.padded = padded
+        self.pending = deque()
+        self.buf = ""
+        self.pos = 0
+        self.state = None
+        self.sink = None
+        self.blocks = None
+
+    def expect(self, filemode = False, sink = None):
+        '''
+        sink, a callable or an object with write(), receives a streamed
+        file piece by piece instead of it being kept in the reply
+        '''
+        self.pending.append((filemode, sink))
+
+    def feed(self, data):
+        # what is left over is no more than a trailer or a text reply, the
+        # streamed blocks are handed on as they come, so this join is short
+        if self.pos < len(self.buf):
+            self.buf = self.buf[self.pos:] + data
+        else:
+            self.buf = data
+        self.pos = 0
+        replies = []
+        while self.pending:
+            reply = self._step()
+            if reply is None:
+                break
+            replies.append(reply)
+        return replies
+
+    def _available(self):
+        return len(self.buf) - self.pos
+
+    def _step(self):
+        '''
+        Parse on until a reply is finished, None when more data is needed
+        '''
+        while True:
+            if self.state is None:
+                filemode, sink = self.pending[0]
+                self.state = filemode and "head" or "text"
+                self.sink = sink
+                self.blocks = []
+            if self.state == "head":
+                if self._available() < 3:
+                    return None
+                if self.buf[self.pos:self.pos + 3] == "[0]":
+                    self.pos += 3
+                    self.state = "block"
+                else:
+                    # an error text, or the daemon could not open its file
+                    self.state = "text"
+            elif self.state == "text":
+                end = self.buf.find(EOF, self.pos)
+                if end < 0:
+                    if self._available() > MAXPACKLEN + len(EOF):
+                        raise DaemonError("Reply without %s"%EOF)
+                    return None
+                text = self.buf[self.pos:end]
+                self.pos = end + len(EOF)
+                return self._done(self._parse(text))
+            elif self.state == "block":
+                end = self.buf.find(EOF, self.pos)
+                if end < 0:
+                    # hand on all but what may be the start of the trailer,
+                    # or the padding of an older daemon
+                    keep = max(self.pos, len(self.buf) - len(EOF) + 1)
+                    piece = self._unpad(self.buf[self.pos:keep])
+                    self._emit(piece)
+                    self.pos += len(piece)
+                    return None
+                self._emit(self._unpad(self.buf[self.pos:end]))
+                self.pos = end + len(EOF)
+                data = None
+                if self.sink is None:
+                    data = "".join(self.blocks)
+                return self._done(DaemonReply(0, "", data))
+
+    def _unpad(self, data):
+        if self.padded:
+            return data.rstrip("\0")
+        return data
+
+    def _emit(self, data):
+        _handon(self.sink, self.blocks, data)
+
+    def _done(self, reply):
+        self.pending.popleft()
+        self.state = None
+        self.sink = None
+        self.blocks = None
+        return reply
+
+    def _parse(self, text):
+        match = _REPLY.match(text)
+        if match is None:
+            # nothing but the trailer: the file of an "F:" reply was gone
+            return DaemonReply(-1, text)
+        return DaemonReply(int(match.group(1)), match.group(2))
+
+
+class _Waker(asyncore.file_dispatcher):
+    '''
+    Pipe the loop sleeps on too, so other threads can make it notice new
+    commands at once
+    '''
+    def __init__(self, socketmap):
+        self.rfd, self.wfd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.rfd, socketmap)
+
+    def wake(self):
+        os.write(self.wfd, "x")
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+
+
+class DaemonLoop(object):
+    '''
+    Thread running asyncore over the sockets of all daemon connections
+    '''
+    def __init__(self):
+        self.map = {}
+        self.waker = _Waker(self.map)
+        self.thread = threading.Thread(target = self._run, name = "vmmengine-client")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def wake(self):
+        self.waker.wake()
+
+    def _run(self):
+        while True:
+            try:
+                asyncore.loop(30, True, self.map)
+            except Exception, e:
+                logging.error("vmmengine client loop: %s"%e)
+
+
+_loop = None
+_loopLock = threading.Lock()
+
+def getloop():
+    '''
+    Return the process-wide DaemonLoop, started on first use
+    '''
+    global _loop
+    _loopLock.acquire()
+    try:
+        if _loop is None:
+            _loop = DaemonLoop()
+        return _loop
+    finally:
+        _loopLock.release()
+
+
+class DaemonConnection(asyncore.dispatcher):
+    '''
+    One TCP session with the daemon, which holds its own ESXi connection,
+    opened VM and guest login.  submit() may be called from any thread.
+    '''
+    def __init__(self, address, depth = PIPELINE_DEPTH, loop = None, proto = 1, padded = False):
+        self.loop = loop or getloop()
+        asyncore.dispatcher.__init__(self, map = self.loop.map)
+        self.address = address
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.parser = ReplyParser(padded)
+        self.queue = deque()
+        self.inflight = deque()
+        self.outbuf = ""
+        self.closed = False
+        # protocol spoken, 2 once the server agreed to frames
+        self.proto = 1
+        self.negotiation = None
+        # framed protocol: reply reader, request id: (future, sink, blocks)
+        self.frames = None
+        self.waiting = {}
+        self.nextid = 1
+        if proto >= vixproto.VERSION:
+            self.negotiation = JobFuture("proto")
+            self.queue.append((vixproto.NEGOTIATE.split(";"), None, False, self.negotiation))
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect(address)
+        self.loop.wake()
+
+    def submit(self, command, sink = None, filemode = None):
+        '''
+        Queue a command line, returning a JobFuture of its DaemonReply.
+        The future fails with DaemonError for codes other than VE_000.
+        '''
+        return self._submit([token for token in command.split(";") if token], sink, filemode)
+
+    def call(self, name, *args, **kwargs):
+        '''
+        Queue a command with its arguments, which may hold anything once
+        the connection speaks the framed protocol; sink and filemode as
+        for submit()
+        '''
+        return self._submit([name] + list(args), kwargs.get("sink"), kwargs.get("filemode"))
+
+    def _submit(self, fields, sink, filemode):
+        if self.proto == 1 and self.negotiation is None:
+            _commandline(fields)
+        name = fields and fields[0] or ""
+        if filemode is None:
+            filemode = name in FILE_COMMANDS
+        future = JobFuture(name)
+        self.lock.acquire()
+        try:
+            if self.closed:
+                future.set_exception(DaemonError("Connection to %s:%d closed"%self.address))
+                return future
+            self.queue.append((fields, sink, filemode, future))
+        finally:
+            self.lock.release()
+        self.loop.wake()
+        return future
+
+    def command(self, command, sink = None, timeout = None):
+        '''
+        Run a command and wait for its DaemonReply
+        '''
+        return self.submit(command, sink).result(timeout)
+
+    def stream(self, command):
+        '''
+        Generator of the pieces of a streamed file reply as they come in,
+        raising DaemonError at the end if the command failed
+        '''
+        pieces = Queue.Queue()
+        future = self.submit(command, pieces.put, True)
+        # pieces are all handed on before the future is done
+        future.add_done_callback(lambda future: pieces.put(None))
+        piece = pieces.get()
+        while piece is not None:
+            yield piece
+            piece = pieces.get()
+        future.result()
+
+    def pending(self):
+        return len(self.queue) + len(self.inflight) + len(self.waiting)
+
+    def quit(self):
+        '''
+        Say goodbye once the queued commands are answered
+        '''
+        self.lock.acquire()
+        try:
+            self.queue.append((["quit"], None, False, None))
+        finally:
+            self.lock.release()
+        self.loop.wake()
+
+    ##### asyncore side, all in the loop thread
+
+    def writable(self):
+        if not self.connected:
+            return True
+        if self.outbuf:
+            return True
+        self.lock.acquire()
+        try:
+            # only frames tell where one command ends and the next starts
+            depth = self.proto == vixproto.VERSION and self.depth or PIPELINE_DEPTH
+            while self.queue and len(self.inflight) + len(self.waiting) < depth:
+                if self.negotiation is not None and self.inflight:
+                    # nothing more until the server said which protocol
+                    break
+                fields, sink, filemode, future = self.queue.popleft()
+                if self.proto == vixproto.VERSION:
+                    reqid = 0
+                    if future is not None:
+                        reqid = self.nextid
+                        self.nextid += 1
+                        self.waiting[reqid] = (future, sink, [])
+                    self.outbuf += vixproto.encoderequest(reqid, fields)
+                else:
+                    try:
+                        line = _commandline(fields)
+                    except ValueError, e:
+                        future.set_exception(e)
+                        continue
+                    self.outbuf += line.ljust(MAXPACKLEN, "\0")
+                    if future is not None:
+                        self.parser.expect(filemode, sink)
+                        self.inflight.append(future)
+                if future is None:
+                    # quit has no answer
+                    break
+        finally:
+            self.lock.release()
+        return bool(self.outbuf)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_read(self):
+        data = self.recv(RECV_SIZE)
+        if not data:
+            return
+        if self.frames is not None:
+            self._readframes(data)
+            return
+        try:
+            replies = self.parser.feed(data)
+        except DaemonError, e:
+            self._fail(e)
+            return
+        for reply in replies:
+            future = self.inflight.popleft()
+            if future is self.negotiation:
+                self._negotiated(reply)
+            self._resolve(future, reply)
+
+    def _negotiated(self, reply):
+        '''
+        Switch to frames if the server agreed, it sent nothing after that
+        '''
+        self.lock.acquire()
+        try:
+            self.negotiation = None
+            if reply.ok and reply.text == str(vixproto.VERSION):
+                self.proto = vixproto.VERSION
+                self.frames = vixproto.FrameReader(vixproto.REPLY)
+                self.depth = max(self.depth, FRAMED_DEPTH)
+        finally:
+            self.lock.release()
+
+    def _readframes(self, data):
+        try:
+            frames = self.frames.feed(data)
+        except vixproto.ProtocolError, e:
+            self._fail(DaemonError("Reply from %s:%d: %s"%(self.address + (e,))))
+            return
+        for (reqid, code, flags), body in frames:
+            entry = self.waiting.get(reqid)
+            if entry is None:
+                logging.error("Reply to unknown request %d from %s:%d"%((reqid,) + self.address))
+                continue
+            future, sink, blocks = entry
+            if flags & vixproto.FLAG_MORE:
+                _handon(sink, blocks, body)
+                continue
+            self.lock.acquire()
+            try:
+                del self.waiting[reqid]
+            finally:
+                self.lock.release()
+            if flags & vixproto.FLAG_FILE:
+                reply = DaemonReply(code, "", None)
+                if sink is None:
+                    reply.data = "".join(blocks)
+            else:
+                reply = DaemonReply(code, body)
+            self._resolve(future, reply)
+
+    def _resolve(self, future, reply):
+        if reply.ok:
+            future.set_result(reply)
+        else:
+            future.set_exception(DaemonError("%s: %s"%(future.opname, reply.text), reply.code))
+
+    def handle_close(self):
+        self._fail(DaemonError("Connection to %s:%d closed"%self.address))
+
+    def handle_error(self):
+        self._fail(DaemonError("Connection to %s:%d failed"%self.address))
+
+    def _fail(self, error):
+        self.close()
+        self.lock.acquire()
+        try:
+            self.closed = True
+            futures = list(self.inflight) + [entry[3] for entry in self.queue]
+            futures += [entry[0] for entry in self.waiting.values()]
+            self.inflight.clear()
+            self.waiting.clear()
+            self.queue.clear()
+        finally:
+            self.lock.release()
+        for future in futures:
+            if future is not None:
+                future.set_exception(error)
+
+
+class DaemonPool(object):
+    '''
+    Daemon connections kept per ESXi host and user.  A connection handed
+    out by acquire() is already connected to the host; what the caller
+    opened or logged into on it stays that way for the next borrower.
+    '''
+    # Connections open at most
+    MAX_SIZE = 16
+    # Seconds an idle connection is kept
+    IDLE_TIMEOUT = 300
+
+    def __init__(self, address, maxsize = MAX_SIZE, idletimeout = IDLE_TIMEOUT,
+            depth = PIPELINE_DEPTH, loop = None, proto = 1, padded = False):
+        self.address = address
+        self.maxsize = maxsize
+        self.idletimeout = idletimeout
+        self.depth = depth
+        self.loop = loop
+        self.proto = proto
+        self.padded = padded
+        self.cond = threading.Condition()
+        # (host, user): [(connection, released at)]
+        self.idle = {}
+        self.size = 0
+
+    def acquire(self, host, user, password, timeout = None):
+        key = (host, user)
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            self._evictidle()
+            while True:
+                entries = self.idle.get(key)
+                if entries:
+                    return entries.pop()[0]
+                if self.size < self.maxsize:
+                    self.size += 1
+                    break
+                if self._evictlru():
+                    continue
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise DaemonError("No daemon connection free for %s@%s"%(user, host))
+                self.cond.wait(remaining)
+        finally:
+            self.cond.release()
+        try:
+            conn = DaemonConnection(self.address, self.depth, self.loop, self.proto, self.padded)
+            conn.poolkey = key
+            conn.command("connect;%s;%s;%s"%(host, user, password))
+            return conn
+        except Exception:
+            self._shrink()
+            raise
+
+    def release(self, conn, broken = False):
+        if broken or conn.closed:
+            conn.quit()
+            self._shrink()
+            return
+        self.cond.acquire()
+        try:
+            self.idle.setdefault(conn.poolkey, []).append((conn, time.time()))
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def clear(self):
+        self.cond.acquire()
+        try:
+            for entries in self.idle.values():
+                for conn, released in entries:
+                    conn.quit()
+                    self.size -= 1
+            self.idle.clear()
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def _shrink(self):
+        self.cond.acquire()
+        try:
+            self.size -= 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def _evictidle(self):
+        deadline = time.time() - self.idletimeout
+        for key, entries in self.idle.items():
+            for entry in [entry for entry in entries if entry[1] < deadline]:
+                entries.remove(entry)
+                entry[0].quit()
+                self.size -= 1
+
+    def _evictlru(self):
+        '''
+        Close the longest idle connection of any key to make room
+        '''
+        oldest = None
+        for key, entries in self.idle.items():
+            for entry in entries:
+                if oldest is None or entry[1] < oldest[1][1]:
+                    oldest = (key, entry)
+        if oldest is None:
+            return False
+        self.idle[oldest[0]].remove(oldest[1])
+        oldest[1][0].quit()
+        self.size -= 1
+        return True
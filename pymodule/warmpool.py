@@ -0,0 +1,344 @@
+# -*- coding:utf-8 -*-
+'''
+Pool of VMs kept reverted, powered on and logged in, leased on demand.
+
+Getting a clean VM the usual way is a revert, a power on and a login that
+waits up to TOOLS_TIMEOUT for the guest tools, minutes before any work.
+WarmPool does all of that ahead of time for the VMs given to it per
+template, and again in the background each time a VM comes back, so
+acquire() returns at once as long as a VM of the template is ready.
+
+    pool = WarmPool(vix)
+    pool.add("linux", ["[ds] ci1/ci1.vmx", "[ds] ci2/ci2.vmx"], "clean", ("root", "secret"))
+    vm = pool.acquire("linux", timeout = 600)
+    try:
+        vm.vix.runscriptinvm("/bin/sh", "make test")
+    finally:
+        pool.release(vm)
+
+Leases and recycles are counted in stats(), with the time callers waited,
+the time VMs were leased and the time they sat ready; with Vix.metrics set
+the waits and recycles are recorded there too, as "WarmPool.acquire" and
+"WarmPool.recycle" of the template.
+'''
+
+import copy
+import time
+import logging
+import threading
+from collections import deque
+
+from pyvix import Vix, VixException
+from asyncvix import AsyncVix, JobFuture
+from fleet import _Chain
+
+# Seconds before a VM that could not be made ready is tried again
+RETRY_DELAY = 60
+
+# States of a VM of the pool
+PREPARING = "preparing"
+READY = "ready"
+LEASED = "leased"
+BROKEN = "broken"
+
+
+class WarmVM(object):
+    '''
+    One VM of the pool.  While leased, vix is a Vix of its own on the VM,
+    logged into the guest, for the leaseholder to work with.
+    '''
+    def __init__(self, template, vmxpath, snapshot, login):
+        self.template = template
+        self.vmxpath = vmxpath
+        self.snapshot = snapshot
+        self.login = login
+        self.state = PREPARING
+        # when the VM entered its state
+        self.since = time.time()
+        self.vmHandle = None
+        self.vix = None
+        self.failures = 0
+
+    def __repr__(self):
+        return "<WarmVM %s %s %s>"%(self.template, self.vmxpath, self.state)
+
+
+class WarmPool(object):
+    '''
+    VMs per template, prepared by AsyncVix jobs of the wrapped Vix
+    '''
+    def __init__(self, vix, retrydelay = RETRY_DELAY):
+        self.vix = vix
+        self.av = AsyncVix(vix)
+        self.retrydelay = retrydelay
+        self.cond = threading.Condition()
+        # template: [WarmVM]
+        self.vms = {}
+        # template: deque of READY WarmVMs, longest ready first
+        self.ready = {}
+        self.timers = []
+        self.closed = False
+        self.waiting = 0
+        self.leases = 0
+        self.waittime = 0.0
+        self.maxwait = 0.0
+        self.leasetime = 0.0
+        self.idletime = 0.0
+        self.recycles = 0
+        self.recycletime = 0.0
+        self.failures = 0
+
+    def add(self, template, vmxpaths, snapshot = None, login = None):
+        '''
+        Put VMs into the pool under template and start preparing them.
+        They are reverted to the named snapshot, the current one when
+        snapshot is None, and logged into with login, (user, password).
+        '''
+        vms = [WarmVM(template, vmxpath, snapshot, login) for vmxpath in vmxpaths]
+        self.cond.acquire()
+        try:
+            self.vms.setdefault(template, []).extend(vms)
+            self.ready.setdefault(template, deque())
+        finally:
+            self.cond.release()
+        for vm in vms:
+            self._recycle(vm)
+
+    def acquire(self, template, timeout = None):
+        '''
+        Lease a ready VM of the template, waiting up to timeout seconds
+        for one when none is ready
+        '''
+        started = time.time()
+        deadline = None
+        if timeout is not None:
+            deadline = started + timeout
+        self.cond.acquire()
+        try:
+            if template not in self.ready:
+                raise VixException("No warm VMs of %s"%template)
+            self.waiting += 1
+            try:
+                while not self.ready[template]:
+                    if self.closed:
+                        raise VixException("Warm pool closed")
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise VixException("No warm VM of %s ready"%template, Vix.VIX_E_UNFINISHED_JOB)
+                    self.cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            vm = self.ready[template].popleft()
+            now = time.time()
+            self.leases += 1
+            self.waittime += now - started
+            self.maxwait = max(self.maxwait, now - started)
+            self.idletime += now - vm.since
+            vm.state = LEASED
+            vm.since = now
+            vm.vix = self._leasevix(vm)
+        finally:
+            self.cond.release()
+        self.vix.recordjob("WarmPool.acquire", started, Vix.VIX_OK, template)
+        return vm
+
+    def release(self, vm):
+        '''
+        Give a leased VM back, it is made clean again in the background,
+        or dropped once the pool is closed
+        '''
+        self.cond.acquire()
+        try:
+            if vm.state != LEASED:
+                return
+            self.leasetime += time.time() - vm.since
+            vm.vix = None
+            if self.closed:
+                self._drop(vm)
+                return
+        finally:
+            self.cond.release()
+        self._recycle(vm)
+
+    def close(self):
+        '''
+        Stop recycling and release the handles of the VMs; leased VMs keep
+        theirs until they are released, those being prepared until that ends
+        '''
+        self.cond.acquire()
+        try:
+            self.closed = True
+            timers, self.timers = self.timers, []
+            for vms in self.vms.values():
+                for vm in vms:
+                    if vm.state in (READY, BROKEN):
+                        self._drop(vm)
+            for ready in self.ready.values():
+                ready.clear()
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        for timer in timers:
+            timer.cancel()
+
+    def stats(self):
+        self.cond.acquire()
+        try:
+            templates = {}
+            for template, vms in self.vms.items():
+                counts = dict((state, 0) for state in (PREPARING, READY, LEASED, BROKEN))
+                for vm in vms:
+                    counts[vm.state] += 1
+                templates[template] = counts
+            return {"leases": self.leases,
+                "waiting": self.waiting,
+                "wait_seconds": self.waittime,
+                "max_wait_seconds": self.maxwait,
+                "lease_seconds": self.leasetime,
+                "idle_seconds": self.idletime,
+                "recycles": self.recycles,
+                "recycle_seconds": self.recycletime,
+                "failures": self.failures,
+                "templates": templates}
+        finally:
+            self.cond.release()
+
+    def _leasevix(self, vm):
+        vix = copy.copy(self.vix)
+        vix.vmHandle = vm.vmHandle
+        vix.vmfolder = vm.vmxpath
+        if vm.login is not None:
+            vix.vmuser, vix.vmpassword = vm.login
+        return vix
+
+    def _recycle(self, vm):
+        self.cond.acquire()
+        try:
+            if self.closed:
+                return
+            vm.state = PREPARING
+            vm.since = time.time()
+        finally:
+            self.cond.release()
+        _WarmChain(self, vm).start()
+
+    def _prepared(self, vm, vmHandle, error, elapsed):
+        '''
+        End of the preparing chain of a VM, from the thread resolving its jobs
+        '''
+        err = Vix.VIX_OK
+        self.cond.acquire()
+        try:
+            if vm.vmHandle is None and vmHandle not in (None, Vix.VIX_INVALID_HANDLE):
+                # the reference the chain took is the pool's from now on
+                vm.vmHandle = vmHandle
+            vm.since = time.time()
+            if error is not None:
+                err = getattr(error, "errorCode", Vix.VIX_E_FAIL)
+            if self.closed:
+                self._drop(vm)
+            elif error is None:
+                self.recycles += 1
+                self.recycletime += elapsed
+                vm.state = READY
+                vm.failures = 0
+                self.ready[vm.template].append(vm)
+                self.cond.notify()
+            else:
+                self.failures += 1
+                vm.failures += 1
+                vm.state = BROKEN
+                logging.error("Warm VM %s failed: %s"%(vm.vmxpath, error))
+                timer = threading.Timer(self.retrydelay, self._retry, [vm])
+                timer.setDaemon(True)
+                self.timers.append(timer)
+                timer.start()
+        finally:
+            self.cond.release()
+        self.vix.recordjob("WarmPool.recycle", time.time() - elapsed, err, vm.template)
+
+    def _drop(self, vm):
+        '''
+        Release the handle of a VM of the closed pool, with cond held
+        '''
+        if vm.vmHandle is not None:
+            self.vix.vix.Vix_ReleaseHandle(vm.vmHandle)
+            vm.vmHandle = None
+        vm.state = BROKEN
+        vm.since = time.time()
+
+    def _retry(self, vm):
+        self.cond.acquire()
+        try:
+            self.timers = [timer for timer in self.timers if timer.isAlive() and timer is not threading.currentThread()]
+        finally:
+            self.cond.release()
+        self._recycle(vm)
+
+    def _steps(self, vm):
+        return [lambda av, vmHandle: self._revert(vm, vmHandle),
+            self._poweron,
+            lambda av, vmHandle: av.waitfortools(Vix.TOOLS_TIMEOUT, vmHandle),
+            lambda av, vmHandle: self._login(vm, vmHandle)]
+
+    def _revert(self, vm, vmHandle):
+        vix = self.vix
+        tree = vix.GetSnapshotTree(vmHandle)
+        try:
+            node = tree.current
+            if vm.snapshot is not None:
+                node = tree.find(vm.snapshot)
+            if node is None:
+                raise VixException("%s has no current snapshot"%vm.vmxpath, Vix.VIX_E_SNAPSHOT_NOTFOUND)
+            # ours until the revert is done, the tree goes away with it
+            snapshotHandle = node.handle
+            vix.vix.Vix_AddRefHandle(snapshotHandle)
+        finally:
+            tree.release()
+        future = self.av.RevertToSnapshot(snapshotHandle, vmHandle)
+        future.add_done_callback(lambda future: vix.vix.Vix_ReleaseHandle(snapshotHandle))
+        return future
+
+    def _poweron(self, av, vmHandle):
+        '''
+        Power on unless the snapshot was taken of a running VM
+        '''
+        if self.vix.power_state(vmHandle) & Vix.VIX_POWERSTATE_POWERED_ON:
+            return _resolved("VixVM_PowerOn")
+        return av.PowerOn(vmHandle)
+
+    def _login(self, vm, vmHandle):
+        if vm.login is None:
+            return _resolved("VixVM_LoginInGuest")
+        return self.av.loginvm(vm.login[0], vm.login[1], vmHandle)
+
+
+def _resolved(opname):
+    '''
+    Future of a step that has nothing to do
+    '''
+    future = JobFuture(opname)
+    future.set_result(None)
+    return future
+
+
+class _WarmChain(_Chain):
+    '''
+    Open the VM once, then revert, power on, wait for the tools and log in;
+    the reference to the handle is handed on to the pool
+    '''
+    def __init__(self, pool, vm):
+        _Chain.__init__(self, pool.av, vm.vmxpath, pool._steps(vm), None)
+        self.pool = pool
+        self.vm = vm
+
+    def start(self):
+        if self.vm.vmHandle is not None:
+            self._next(self.vm.vmHandle)
+        else:
+            _Chain.start(self)
+
+    def _done(self, error):
+        self.pool._prepared(self.vm, self.vmHandle, error, time.time() - self.started)
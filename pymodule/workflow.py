@@ -0,0 +1,466 @@
+# -*- coding:utf-8 -*-
+'''
+Declarative multi-VM scenarios run as a dependency graph.
+
+A scenario names its VMs and lists steps, each one VIX operation on one VM
+and the steps it must come after.  Steps whose dependencies are through
+run at the same time, as AsyncVix jobs, within the same per-host limit as
+fleet and the same per-datastore limit as clonefarm.  Steps failing with a
+transient error, a busy VM or tools not up yet, are tried again; steps
+depending on a failed step are skipped.
+
+    spec = {
+        "vms": {
+            "web": {"vmx": "[ds1] web/web.vmx", "login": ["root", "secret"]},
+            "db": {"vmx": "[ds2] db/db.vmx", "login": ["root", "secret"]},
+        },
+        "steps": [
+            {"name": "revert-web", "vm": "web", "op": "revert", "snapshot": "clean"},
+            {"name": "revert-db", "vm": "db", "op": "revert", "snapshot": "clean"},
+            {"name": "on-web", "vm": "web", "op": "poweron", "after": ["revert-web"]},
+            {"name": "on-db", "vm": "db", "op": "poweron", "after": ["revert-db"]},
+            {"name": "login-web", "vm": "web", "op": "login", "after": ["on-web"]},
+            {"name": "login-db", "vm": "db", "op": "login", "after": ["on-db"]},
+            {"name": "test", "vm": "web", "op": "runscript", "interpreter": "/bin/sh",
+                "script": "make test", "after": ["login-web", "login-db"]},
+        ],
+    }
+    report = Scenario(vix, spec).run()
+    print report.format()
+
+Steps of one VM not ordered by "after" may run at the same time.  The
+report holds a StepResult per step and the critical path, the chain of
+steps each of which was the last to end before the next one could start.
+The spec may also be read from a JSON or, with PyYAML installed, a YAML
+file by loadspec().
+'''
+
+import time
+import json
+import heapq
+import threading
+import Queue
+
+from pyvix import Vix, VixException, JobPolicy
+from asyncvix import AsyncVix, JobFuture
+from fleet import HOST_INFLIGHT, hostslots
+from clonefarm import DATASTORE_INFLIGHT, datastore, datastoreslots
+
+# Tries of a step after its first one, unless the spec says otherwise
+RETRIES = 2
+# Seconds before a step is tried again, times the number of its tries
+RETRY_DELAY = 5
+
+# Errors worth another try of the step, those of Vix.jobPolicy when set
+TRANSIENT_ERRORS = JobPolicy.RETRYABLE_ERRORS
+
+
+def loadspec(path):
+    '''
+    Scenario spec of a JSON file, or of a YAML one by its extension
+    '''
+    f = open(path)
+    try:
+        if path.endswith(".yaml") or path.endswith(".yml"):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def _revert(av, vmHandle, vm, step):
+    vix = av.vix
+    tree = vix.GetSnapshotTree(vmHandle)
+    try:
+        node = tree.current
+        if step.get("snapshot") is not None:
+            node = tree.find(step["snapshot"])
+        if node is None:
+            raise VixException("%s has no snapshot %s"%(vm["vmx"], step.get("snapshot", "current")),
+                Vix.VIX_E_SNAPSHOT_NOTFOUND)
+        # ours until the revert is done, the tree goes away with it
+        snapshotHandle = node.handle
+        vix.vix.Vix_AddRefHandle(snapshotHandle)
+    finally:
+        tree.release()
+    future = av.RevertToSnapshot(snapshotHandle, vmHandle)
+    future.add_done_callback(lambda future: vix.vix.Vix_ReleaseHandle(snapshotHandle))
+    return future
+
+def _login(av, vmHandle, vm, step):
+    vmuser, vmpassword = step.get("login") or vm["login"]
+    return av.loginvm(vmuser, vmpassword, vmHandle)
+
+# op: function(av, vmHandle, vm spec, step spec) returning the JobFuture of the step
+OPS = {
+    "revert": _revert,
+    "poweron": lambda av, vmHandle, vm, step: av.PowerOn(vmHandle),
+    "poweroff": lambda av, vmHandle, vm, step: av.PowerOff(vmHandle),
+    "waittools": lambda av, vmHandle, vm, step: av.waitfortools(step.get("timeout", Vix.TOOLS_TIMEOUT), vmHandle),
+    "login": _login,
+    "snapshot": lambda av, vmHandle, vm, step: av.CreateSnapshot(step["snapshot"], step.get("description"), vmHandle),
+    "copyin": lambda av, vmHandle, vm, step: av.cphost2vm(step["src"], step["dst"], vmHandle),
+    "copyout": lambda av, vmHandle, vm, step: av.cpvm2host(step["src"], step["dst"], vmHandle),
+    "runscript": lambda av, vmHandle, vm, step: av.runscriptinvm(step["interpreter"], step["script"], vmHandle),
+    "runprogram": lambda av, vmHandle, vm, step: av.runprograminvm(step["program"], step.get("args", ""), vmHandle),
+}
+
+
+class StepResult(object):
+    '''
+    Outcome of one step.  ready is when its dependencies were through,
+    firststarted when it was first tried, started and ended bound its last
+    try; they are None for skipped steps.
+    '''
+    def __init__(self, name, vm, op, error = None, tries = 0, ready = None, started = None, ended = None):
+        self.name = name
+        self.vm = vm
+        self.op = op
+        self.error = error
+        self.tries = tries
+        self.ready = ready
+        self.started = started
+        self.firststarted = started
+        self.ended = ended
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def skipped(self):
+        return self.started is None
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return self.ended - self.started
+
+    @property
+    def waited(self):
+        '''
+        Seconds from ready to the start of the first try, waiting for slots
+        '''
+        if self.ready is None or self.started is None:
+            return 0.0
+        return max(0.0, self.firststarted - self.ready)
+
+    def __repr__(self):
+        if self.ok:
+            return "<StepResult %s ok %.2fs>"%(self.name, self.elapsed)
+        return "<StepResult %s failed %.2fs: %s>"%(self.name, self.elapsed, self.error)
+
+
+class ScenarioReport(object):
+    '''
+    StepResults of a run in spec order, with its critical path
+    '''
+    def __init__(self, results, started, ended, deps):
+        self.results = results
+        self.started = started
+        self.ended = ended
+        self.critical_path = self._criticalpath(deps)
+
+    @property
+    def ok(self):
+        for result in self.results:
+            if not result.ok:
+                return False
+        return True
+
+    @property
+    def elapsed(self):
+        return self.ended - self.started
+
+    def _criticalpath(self, deps):
+        byname = dict((result.name, result) for result in self.results)
+        ended = [result for result in self.results if result.ended is not None]
+        if not ended:
+            return []
+        path = []
+        result = max(ended, key = lambda result: result.ended)
+        while result is not None:
+            path.append(result)
+            # the dependency that ended last held this step back
+            before = [byname[name] for name in deps[result.name] if byname[name].ended is not None]
+            result = None
+            if before:
+                result = max(before, key = lambda result: result.ended)
+        path.reverse()
+        return path
+
+    def format(self):
+        '''
+        Table of the steps, the ones of the critical path marked with "*"
+        '''
+        critical = set(id(result) for result in self.critical_path)
+        lines = ["  %-20s %-10s %-10s %8s %8s %8s %5s  %s"%("step", "vm", "op", "start", "wait", "run", "tries", "result")]
+        for result in self.results:
+            if result.skipped:
+                start = "-"
+            else:
+                start = "%.2f"%(result.firststarted - self.started)
+            status = "ok"
+            if not result.ok:
+                status = str(result.error)
+            lines.append("%s %-20s %-10s %-10s %8s %8.2f %8.2f %5d  %s"%(id(result) in critical and "*" or " ",
+                result.name, result.vm, result.op, start, result.waited, result.elapsed, result.tries, status))
+        lines.append("total %.2fs, critical path %s"%(self.elapsed,
+            " -> ".join([result.name for result in self.critical_path])))
+        return "\n".join(lines)
+
+
+class Scenario(object):
+    '''
+    A checked spec, run with run().  limits of the spec, {"host": n,
+    "datastore": n}, bound the steps of one run in flight on the host and
+    on each datastore, within the limits shared with the other batches of
+    the process; retries and retry_delay apply to steps without their own.
+    '''
+    def __init__(self, vix, spec):
+        self.vix = vix
+        self.vms = dict(spec.get("vms", {}))
+        self.steps = list(spec.get("steps", []))
+        limits = spec.get("limits", {})
+        self.hostlimit = limits.get("host", HOST_INFLIGHT)
+        self.datastorelimit = limits.get("datastore", DATASTORE_INFLIGHT)
+        self.retries = spec.get("retries", RETRIES)
+        self.retrydelay = spec.get("retry_delay", RETRY_DELAY)
+        self.byname = {}
+        # step name: names of the steps it comes after
+        self.deps = {}
+        # step name: names of the steps coming after it
+        self.dependents = {}
+        self._check()
+
+    def _check(self):
+        for step in self.steps:
+            name = step.get("name")
+            if name is None or name in self.byname:
+                raise ValueError("Step names must be given and unique: %r"%name)
+            if step.get("vm") not in self.vms:
+                raise ValueError("Step %s is on unknown VM %r"%(name, step.get("vm")))
+            if step.get("op") not in OPS:
+                raise ValueError("Step %s has unknown op %r"%(name, step.get("op")))
+            if step["op"] == "login" and not (step.get("login") or self.vms[step["vm"]].get("login")):
+                raise ValueError("Step %s has no login for VM %s"%(name, step["vm"]))
+            self.byname[name] = step
+            self.deps[name] = list(step.get("after", []))
+            self.dependents[name] = []
+        for name, after in self.deps.items():
+            for dep in after:
+                if dep not in self.byname:
+                    raise ValueError("Step %s comes after unknown step %r"%(name, dep))
+                self.dependents[dep].append(name)
+        # Kahn's algorithm, whatever is left over is on a cycle
+        counts = dict((name, len(after)) for name, after in self.deps.items())
+        free = [name for name, count in counts.items() if count == 0]
+        while free:
+            for name in self.dependents[free.pop()]:
+                counts[name] -= 1
+                if counts[name] == 0:
+                    free.append(name)
+        cycle = sorted([name for name, count in counts.items() if count])
+        if cycle:
+            raise ValueError("Steps depend on each other in a cycle: %s"%", ".join(cycle))
+
+    def run(self):
+        '''
+        Run every step that can run and return the ScenarioReport
+        '''
+        return _Run(self).run()
+
+
+class _Run(object):
+    '''
+    State of one run of a Scenario, driven from the calling thread
+    '''
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.av = AsyncVix(scenario.vix)
+        self.finished = Queue.Queue()
+        # VM name: JobFuture of its handle
+        self.opens = {}
+        self.opensLock = threading.Lock()
+        self.results = {}
+        for step in scenario.steps:
+            self.results[step["name"]] = StepResult(step["name"], step["vm"], step["op"])
+        self.waiting = dict((name, len(after)) for name, after in scenario.deps.items())
+        self.ready = []
+        # heap of (due time, step name) of steps to try again
+        self.retrying = []
+        self.inflight = 0
+        # steps of this run in flight on the host and on each datastore
+        self.onhost = 0
+        self.onstore = {}
+
+    def run(self):
+        started = time.time()
+        for step in self.scenario.steps:
+            if not self.waiting[step["name"]]:
+                self._ready(step["name"], started)
+        try:
+            while self.ready or self.retrying or self.inflight:
+                now = time.time()
+                while self.retrying and self.retrying[0][0] <= now:
+                    self.ready.append(heapq.heappop(self.retrying)[1])
+                for name in list(self.ready):
+                    if self._acquire(name, False):
+                        self.ready.remove(name)
+                        self._start(name)
+                if not self.inflight and self.ready and not self.retrying:
+                    # every slot is taken by other batches, wait for the next one
+                    name = self.ready.pop(0)
+                    self._acquire(name, True)
+                    self._start(name)
+                timeout = None
+                if self.retrying:
+                    timeout = max(0.0, self.retrying[0][0] - time.time())
+                if self.inflight:
+                    try:
+                        name, error = self.finished.get(True, timeout)
+                    except Queue.Empty:
+                        continue
+                    self._finished(name, error)
+                elif timeout is not None:
+                    time.sleep(timeout)
+        finally:
+            # stopped early, the slots are ours until the jobs end
+            while self.inflight:
+                name, error = self.finished.get()
+                self._release(name)
+                self.inflight -= 1
+            self._close()
+        return ScenarioReport([self.results[step["name"]] for step in self.scenario.steps],
+            started, time.time(), self.scenario.deps)
+
+    def _ready(self, name, now):
+        self.results[name].ready = now
+        self.ready.append(name)
+
+    def _store(self, name):
+        scenario = self.scenario
+        return datastore(scenario.vms[scenario.byname[name]["vm"]]["vmx"])
+
+    def _acquire(self, name, blocking):
+        scenario = self.scenario
+        store = self._store(name)
+        if self.onhost >= scenario.hostlimit or self.onstore.get(store, 0) >= scenario.datastorelimit:
+            return False
+        host = hostslots(scenario.vix.url)
+        if not host.acquire(blocking):
+            return False
+        if not datastoreslots(scenario.vix.url, store).acquire(blocking):
+            host.release()
+            return False
+        self.onhost += 1
+        self.onstore[store] = self.onstore.get(store, 0) + 1
+        return True
+
+    def _release(self, name):
+        store = self._store(name)
+        datastoreslots(self.scenario.vix.url, store).release()
+        hostslots(self.scenario.vix.url).release()
+        self.onhost -= 1
+        self.onstore[store] -= 1
+
+    def _start(self, name):
+        step = self.scenario.byname[name]
+        result = self.results[name]
+        result.tries += 1
+        result.started = time.time()
+        if result.tries == 1:
+            result.firststarted = result.started
+        self.inflight += 1
+        vm = self.scenario.vms[step["vm"]]
+        def opened(future):
+            if future.exception() is not None:
+                self._forget(step["vm"], future)
+                self.finished.put((name, future.exception()))
+                return
+            try:
+                future = OPS[step["op"]](self.av, future.result(), vm, step)
+            except Exception, e:
+                self.finished.put((name, e))
+                return
+            future.add_done_callback(lambda future: self.finished.put((name, future.exception())))
+        self._open(step["vm"]).add_done_callback(opened)
+
+    def _open(self, vmname):
+        '''
+        JobFuture of the handle of the VM, opened by the first step on it
+        '''
+        vix = self.av.vix
+        vmxpath = self.scenario.vms[vmname]["vmx"]
+        self.opensLock.acquire()
+        try:
+            future = self.opens.get(vmname)
+            if future is None:
+                vmHandle = None
+                if vix.vmCache is not None:
+                    vmHandle = vix.vmCache.get(vix.hostHandle, vmxpath)
+                if vmHandle is not None:
+                    future = JobFuture("VixVM_Open")
+                    future.set_result(vmHandle)
+                else:
+                    future = self.av.Open(vmxpath)
+                    if vix.vmCache is not None:
+                        future.add_done_callback(lambda future: future.exception() is None and
+                            vix.vmCache.put(vix.hostHandle, vmxpath, future.result()))
+                self.opens[vmname] = future
+            return future
+        finally:
+            self.opensLock.release()
+
+    def _forget(self, vmname, future):
+        '''
+        Drop a failed open so the next try opens the VM again
+        '''
+        self.opensLock.acquire()
+        try:
+            if self.opens.get(vmname) is future:
+                del self.opens[vmname]
+        finally:
+            self.opensLock.release()
+
+    def _close(self):
+        '''
+        Release the references taken on the VM handles, cached or not
+        '''
+        vix = self.av.vix
+        for future in self.opens.values():
+            if future.done() and future.exception() is None:
+                vix.vix.Vix_ReleaseHandle(future.result())
+
+    def _finished(self, name, error):
+        self._release(name)
+        self.inflight -= 1
+        now = time.time()
+        step = self.scenario.byname[name]
+        result = self.results[name]
+        result.ended = now
+        result.error = error
+        if error is not None:
+            retries = step.get("retries", self.scenario.retries)
+            transient = TRANSIENT_ERRORS
+            if Vix.jobPolicy is not None:
+                transient = Vix.jobPolicy.retryableErrors
+            if getattr(error, "errorCode", None) in transient and result.tries <= retries:
+                delay = step.get("retry_delay", self.scenario.retrydelay) * result.tries
+                heapq.heappush(self.retrying, (now + delay, name))
+                return
+            self._skip(name)
+            return
+        for dependent in self.scenario.dependents[name]:
+            self.waiting[dependent] -= 1
+            if not self.waiting[dependent]:
+                self._ready(dependent, now)
+
+    def _skip(self, name):
+        for dependent in self.scenario.dependents[name]:
+            result = self.results[dependent]
+            if result.error is None:
+                result.error = VixException("Skipped, %s failed"%name, Vix.VIX_E_CANCELLED)
+                self._skip(dependent)
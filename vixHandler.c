@@ -4,6 +4,7 @@
 #include <sys/types.h>
 #include <sys/stat.h>
 #include <fcntl.h>
+#include <unistd.h>
 
 /* Create a host session */
 VIX_BOOL NewHostTicket(char* hostName, int hostPort, char* userName, char* passWord, HOSTTICKET * ptrHT){
@@ -349,13 +350,17 @@ VIX_BOOL DeleteDirectoryInGuest(VMTICKET* nVMTicket, char* pathName){
 }
 
 /* List the directory in VM */
-VIX_BOOL ListDirInGuest(VMTICKET* nVMTicket, char* dirpath){
-	
+VIX_BOOL ListDirInGuest(VMTICKET* nVMTicket, char* dirpath, int fd){
+	/* Write one "flags;size;modtime;name" line per entry into fd */
 	VixHandle locJobHandle = VIX_INVALID_HANDLE;
 	VixError locErr;
 	int num = -1;
 	int i = -1;
 	char * fname = NULL;
+	int fflags = 0;
+	int64 fsize = 0;
+	int64 fmodtime = 0;
+	char buffer[MAXPATHLEN + 64] = "\0";
 
 	locJobHandle = VixVM_ListDirectoryInGuest(nVMTicket->vmHandle, dirpath, 0, NULL, NULL);
 	locErr = VixJob_Wait(locJobHandle, VIX_PROPERTY_NONE);
@@ -366,8 +371,20 @@ VIX_BOOL ListDirInGuest(VMTICKET* nVMTicket, char* dirpath){
 	   
 	num = VixJob_GetNumProperties(locJobHandle, VIX_PROPERTY_JOB_RESULT_ITEM_NAME);
 	for (i = 0; i < num; i++) {
-		locErr = VixJob_GetNthProperties(locJobHandle, i, VIX_PROPERTY_JOB_RESULT_ITEM_NAME,&fname, VIX_PROPERTY_NONE);
-		fprintf(stderr, "file #%d '%s'\n", i, fname);
+		locErr = VixJob_GetNthProperties(locJobHandle, i,
+			VIX_PROPERTY_JOB_RESULT_ITEM_NAME, &fname,
+			VIX_PROPERTY_JOB_RESULT_FILE_SIZE, &fsize,
+			VIX_PROPERTY_JOB_RESULT_FILE_FLAGS, &fflags,
+			VIX_PROPERTY_JOB_RESULT_FILE_MOD_TIME, &fmodtime,
+			VIX_PROPERTY_NONE);
+		if (VIX_FAILED(locErr)) {
+			Vix_ReleaseHandle(locJobHandle);
+			return VIX_FALSE;
+		}
+		if(fd > 0){
+			snprintf(buffer, sizeof(buffer), "%d;%"FMT64"d;%"FMT64"d;%s\n", fflags, fsize, fmodtime, fname);
+			write(fd, buffer, strlen(buffer));
+		}
 		Vix_FreeBuffer(fname);
 	}
 	Vix_ReleaseHandle(locJobHandle);
@@ -79,7 +79,7 @@ VIX_BOOL RunProgramInGuest(VMTICKET* nVMTicket, char* progName, char* args);
 VIX_BOOL RunScriptInGuest(VMTICKET* nVMTicket, char* interpreter, char* scriptText, int block);
 
 /* List the directory in VM */
-VIX_BOOL ListDirInGuest(VMTICKET* nVMTicket, char* dirpath);
+VIX_BOOL ListDirInGuest(VMTICKET* nVMTicket, char* dirpath, int fd);
 
 /* Create an original VM snapshot */
 VIX_BOOL CreateVMSnapshot(VMTICKET* nVMTicket, char* ssname, char* ssdesc);
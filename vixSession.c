@@ -97,20 +97,61 @@ abort:
 
 }
 
+int ListSnapshotChildren(VixHandle snapshotHandle, char * parentName, int fd, int dfd){
+	/* Write the children of a snapshot depth first, reusing the child handles instead of looking every name up again */
+	int ret = 0, i, n;
+	int numChildren = -1;
+	VixError err = VIX_OK;
+	VixHandle childSnapshotHandle = VIX_INVALID_HANDLE;
+	char * snapshotName = NULL;
+	char * snapshotDesc = NULL;
+	char buffer[BUFMAXLEN] = "\0";
+	char ssName[MAX_NAMELEN] = "\0";
+
+	err = VixSnapshot_GetNumChildren(snapshotHandle,&numChildren);
+	if(VIX_OK != err){
+		return -1;
+	}
+	for(i=0;i<numChildren;i++){
+		err = VixSnapshot_GetChild(snapshotHandle,i,&childSnapshotHandle);
+		if(VIX_OK != err){
+			return -1;
+		}
+		err = Vix_GetProperties(childSnapshotHandle,VIX_PROPERTY_SNAPSHOT_DISPLAYNAME, &snapshotName, VIX_PROPERTY_SNAPSHOT_DESCRIPTION, &snapshotDesc, VIX_PROPERTY_NONE);
+		if(VIX_OK != err){
+			Vix_ReleaseHandle(childSnapshotHandle);
+			return -1;
+		}
+		bzero(buffer, sizeof(buffer));
+		snprintf(buffer, sizeof(buffer), "%s\t%s\t%s;", snapshotName, snapshotDesc ? snapshotDesc : null, parentName);
+		bzero(ssName, sizeof(ssName));
+		strncpy(ssName, snapshotName, MAX_NAMELEN - 1);
+		dumplog(dfd, buffer);
+		Vix_FreeBuffer(snapshotName);
+		Vix_FreeBuffer(snapshotDesc);
+		write(fd, buffer, strlen(buffer));
+		ret++;
+		n = ListSnapshotChildren(childSnapshotHandle, ssName, fd, dfd);
+		Vix_ReleaseHandle(childSnapshotHandle);
+		if(n < 0){
+			return -1;
+		}
+		ret += n;
+	}
+	return ret;
+}
+
 int VixListSnapshotsProc(VMTICKET * vmTicket, int fd){
-	/* Traverse Snapshots Tree of vm and save into global file as list */
-	int ret = -1, i;
+	/* Traverse Snapshots Tree of vm and save into global file as list, returns the number of snapshots or -1 */
+	int ret = -1, i, n, total = 0;
 	int numRootSnapshots = -1;
 	VixError err = VIX_OK;
 	VixHandle vmHandle = VIX_INVALID_HANDLE;
 	VixHandle snapshotHandle = VIX_INVALID_HANDLE;
-	VixHandle childSnapshotHandle = VIX_INVALID_HANDLE;
 	char * snapshotName = NULL;
 	char * snapshotDesc = NULL;
 	char buffer[BUFMAXLEN] = "\0";
 	char ssName[MAX_NAMELEN] = "\0";
-	char ssDesc[MAX_URLLEN] = "\0";	
-	INFOLIST il;
 
 	int dfd = openlog();
 
@@ -119,8 +160,6 @@ int VixListSnapshotsProc(VMTICKET * vmTicket, int fd){
 		return ret;
 	}
 	vmHandle = vmTicket->vmHandle;
-	
-	InitInfoList(&il);
 
 	dumplog(dfd, "Start Tree");
 	err = VixVM_GetNumRootSnapshots(vmHandle,&numRootSnapshots);
@@ -137,69 +176,29 @@ int VixListSnapshotsProc(VMTICKET * vmTicket, int fd){
 		if(VIX_OK != err){
 			goto abort;
 		}
-		if(snapshotDesc == NULL){
-			snapshotDesc = (char *)malloc(sizeof(null) + 1);
-			bzero(snapshotDesc, sizeof(null) + 1);
-			strcpy(snapshotDesc, null);
-		}
-		AppendInfoNode(&il,snapshotName,snapshotDesc);
 		bzero(buffer, sizeof(buffer));
-		sprintf(buffer, "%s\t%s\tNone;", snapshotName, snapshotDesc);
+		snprintf(buffer, sizeof(buffer), "%s\t%s\tNone;", snapshotName, snapshotDesc ? snapshotDesc : null);
+		bzero(ssName, sizeof(ssName));
+		strncpy(ssName, snapshotName, MAX_NAMELEN - 1);
 		dumplog(dfd, buffer);
 		Vix_FreeBuffer(snapshotName);
 		Vix_FreeBuffer(snapshotDesc);
-		ret++;
 		write(fd, buffer, strlen(buffer));
-	}
-	while(PickInfoNode(&il, ssName, ssDesc) == 1){
-		dumplog(dfd, "ss in queue");
-		dumplog(dfd, ssName);
-		err = VixVM_GetNamedSnapshot(vmHandle,ssName,&snapshotHandle);
-		if(VIX_OK != err){
-			goto abort;
-		}
-		err = VixSnapshot_GetNumChildren(snapshotHandle,&numRootSnapshots);
-		if(VIX_OK != err){
+		total++;
+		n = ListSnapshotChildren(snapshotHandle, ssName, fd, dfd);
+		Vix_ReleaseHandle(snapshotHandle);
+		snapshotHandle = VIX_INVALID_HANDLE;
+		if(n < 0){
 			goto abort;
 		}
-		dumplog(dfd, "numRootSnapshots");
-		dumplogint(dfd, numRootSnapshots);
-		if(numRootSnapshots < 1)
-			continue;
-		for(i=0;i<numRootSnapshots;i++){
-			err = VixSnapshot_GetChild(snapshotHandle,i,&childSnapshotHandle);
-			if(VIX_OK != err){
-				goto abort;
-			}
-			err = Vix_GetProperties(childSnapshotHandle,VIX_PROPERTY_SNAPSHOT_DISPLAYNAME, &snapshotName, VIX_PROPERTY_SNAPSHOT_DESCRIPTION, &snapshotDesc, VIX_PROPERTY_NONE);
-			if(VIX_OK != err){
-				goto abort;
-			}			
-			if(snapshotDesc == NULL){
-				snapshotDesc = (char *)malloc(sizeof(null) + 1);
-				bzero(snapshotDesc, sizeof(null) + 1);
-				strcpy(snapshotDesc, null);
-			}
-			AppendInfoNode(&il,snapshotName,snapshotDesc);
-			bzero(buffer, sizeof(buffer));
-			sprintf(buffer, "%s\t%s\t%s;", snapshotName, snapshotDesc, ssName);
-			dumplog(dfd, buffer);
-			Vix_FreeBuffer(snapshotName);
-			Vix_FreeBuffer(snapshotDesc);
-			ret++;
-			write(fd, buffer, strlen(buffer));
-		}
+		total += n;
 	}
-	
-	
+	ret = total;
+
 abort:
 	closelog(dfd);
-	FreeInfoList(&il);
 	if(snapshotHandle)
 		Vix_ReleaseHandle(snapshotHandle);
-	if(childSnapshotHandle){
-		Vix_ReleaseHandle(childSnapshotHandle);
-	}
 
 	return ret;
 }
@@ -304,11 +303,19 @@ int handle_esxi_session(char * request, char * response){
 			sprintf(logbuf, "To open %s", ARGUMENTS[0]);
 			dumplog(logfd, logbuf);
 			if(g_sessoninfo.state & CONNECTED_ESXI){
-				CloseVM(&g_vmTicket);
-				if(VIX_TRUE == OpenVM(&g_conTicket, ARGUMENTS[0], &g_vmTicket)){
-					strcpy(g_sessoninfo.vmx_path, ARGUMENTS[0]);
-					g_sessoninfo.state = g_sessoninfo.state | OPENED_VM;
-					dumplog(logfd, "Opened");
+				if((g_sessoninfo.state & OPENED_VM) && strcmp(g_sessoninfo.vmx_path, ARGUMENTS[0]) == 0){
+					// same vm as last time, keep the handle instead of opening again
+					dumplog(logfd, "Already opened");
+				}else{
+					CloseVM(&g_vmTicket);
+					g_sessoninfo.state = g_sessoninfo.state & ~OPENED_VM;
+					if(VIX_TRUE == OpenVM(&g_conTicket, ARGUMENTS[0], &g_vmTicket)){
+						strcpy(g_sessoninfo.vmx_path, ARGUMENTS[0]);
+						g_sessoninfo.state = g_sessoninfo.state | OPENED_VM;
+						dumplog(logfd, "Opened");
+					}
+				}
+				if(g_sessoninfo.state & OPENED_VM){
 					// Get properties as necessary
 					err = Vix_GetProperties(g_vmTicket.vmHandle,
 					VIX_PROPERTY_VM_NAME,
@@ -349,6 +356,11 @@ int handle_esxi_session(char * request, char * response){
 			if(g_sessoninfo.state & CONNECTED_ESXI){
 				if(UnregisterVM(&g_conTicket, ARGUMENTS[0]) == VIX_TRUE){
 					dumplog(logfd, "UN-Registered");
+					if((g_sessoninfo.state & OPENED_VM) && strcmp(g_sessoninfo.vmx_path, ARGUMENTS[0]) == 0){
+						// the kept handle went away with the vm
+						CloseVM(&g_vmTicket);
+						g_sessoninfo.state = g_sessoninfo.state - OPENED_VM;
+					}
 				}else{
 					dumplog(logfd, "Failed to un-register!");
 					ret = VE_008;
@@ -568,17 +580,24 @@ int handle_esxi_session(char * request, char * response){
 		case CID_DIR:
 			sprintf(logbuf, "To dir %s in debug mode", g_vmospath);
 			dumplog(logfd, logbuf);
+			//path
+			mkdir(varpath, 0777);
 			if((g_sessoninfo.state & CONNECTED_ESXI)&&(g_sessoninfo.state & OPENED_VM)&&(g_sessoninfo.state & LOGINED_VM)){
-				if(ListDirInGuest(&g_vmTicket, g_vmospath)== VIX_TRUE){
+				g_tmpfd = open(g_tmpfilepath, O_CREAT|O_TRUNC|O_WRONLY);
+				if(ListDirInGuest(&g_vmTicket, g_vmospath, g_tmpfd)== VIX_TRUE){
 					dumplog(logfd, "OK");
 				}else{
 					dumplog(logfd, "Failed");
 					ret = VE_014;
 				}
+				if(g_tmpfd){
+					close(g_tmpfd);
+				}
 			}else{
 				dumplog(logfd, "Not ready");
 				ret = VE_004;
 			}
+			sprintf(resp, "F:%s", g_tmpfilepath);
 			break;
 		case CID_CREATESS:
 			sprintf(logbuf, "To create snapshot %s(%s) for %s", ARGUMENTS[0], ARGUMENTS[1], g_sessoninfo.vmx_path);
@@ -9,6 +9,7 @@
 #include <sys/file.h>
 #include <sys/ioctl.h>
 #include <sys/wait.h>
+#include <sys/sendfile.h>
 #include <netinet/in.h>
 #include <netdb.h>
 
@@ -16,6 +17,8 @@
 
 #define TCP_PROTO 0
 #define LISTEN_NUM 10
+/* Bytes read at once when a file can not be sent with sendfile */
+#define FILEBUFLEN 65536
 
 struct sockaddr_in hostaddr;
 extern int errno;
@@ -26,6 +29,8 @@ const char respfile[]="[0]F:";
 void daemonize(int servfd);
 void reap_status();
 void do_esxi_session(int sockfd);
+int writeall(int fd, const char * buf, int len);
+long sendwhole(int sockfd, int rfd);
 
 void daemonize(int servfd){
 	int childpid, fd, fdtablesize, pid;
@@ -72,12 +77,57 @@ void reap_status(){
 	while((pid = waitpid(-1, &stat, WNOHANG))>0);
 }
 
+int writeall(int fd, const char * buf, int len){
+	/* write() until all of buf is out, returns -1 on error */
+	int n, done = 0;
+	while(done < len){
+		n = write(fd, buf + done, len - done);
+		if(n < 0 && errno == EINTR)
+			continue;
+		if(n <= 0)
+			return -1;
+		done += n;
+	}
+	return done;
+}
+
+long sendwhole(int sockfd, int rfd){
+	/* Send the whole file at its exact length, with sendfile where the kernel can, returns the bytes sent */
+	struct stat st;
+	long sent = 0;
+	ssize_t n = 0;
+	int len;
+	char filebuf[FILEBUFLEN];
+
+	if(fstat(rfd, &st) == 0){
+		while(sent < st.st_size){
+			n = sendfile(sockfd, rfd, NULL, st.st_size - sent);
+			if(n < 0 && errno == EINTR)
+				continue;
+			if(n <= 0)
+				break;
+			sent += n;
+		}
+		if(sent > 0 || st.st_size == 0)
+			return sent;
+	}
+	// sendfile is not supported for this file, copy it through user space
+	len = read(rfd, filebuf, sizeof(filebuf));
+	while(len > 0){
+		if(writeall(sockfd, filebuf, len) < 0)
+			break;
+		sent += len;
+		len = read(rfd, filebuf, sizeof(filebuf));
+	}
+	return sent;
+}
+
 void do_esxi_session(int sockfd){
 	int localfd, i, n, len;
+	long sent;
 	char logbuf[BUFMAXLEN] = "\0";
 	char msgbuf[MAXPACKLEN] = "\0";
 	char respbuf[MAXPACKLEN] = "\0";
-	char filebuf[MAXPACKLEN + 1] = "\0";
 	char *ptr = NULL;
 	int rfd;
 	char ok[]="[0]";
@@ -120,18 +170,11 @@ void do_esxi_session(int sockfd){
 			rfd = open(ptr, O_RDONLY);
 			if(rfd != -1){
 				write(sockfd, ok, strlen(ok));
+				// exact length, the client finds the end by the trailer
+				sent = sendwhole(sockfd, rfd);
 				bzero(testbuf, sizeof(testbuf));
-				sprintf(testbuf, "sent:|%s|", ok);
+				sprintf(testbuf, "sent %ld bytes of %s", sent, ptr);
 				dumplog(localfd, testbuf);
-				len = read(rfd, filebuf, MAXPACKLEN);
-				while(len > 0){
-					write(sockfd, filebuf, MAXPACKLEN);
-					bzero(testbuf, sizeof(testbuf));
-					sprintf(testbuf, "sent:|%s|", filebuf);
-					dumplog(localfd, testbuf);
-					bzero(filebuf, MAXPACKLEN + 1);
-					len = read(rfd, filebuf, MAXPACKLEN);
-				}
 				close(rfd);
 				// kill the temp file
 				remove(ptr);